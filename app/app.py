@@ -2,6 +2,7 @@ from flask import Flask, request, jsonify, current_app, g
 from flask_restful import Resource, Api
 from json import JSONEncoder
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from bson import json_util, ObjectId
 from jsonschema import validate, ValidationError
 import os
@@ -19,7 +20,17 @@ from flask_pymongo import PyMongo
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "utils")))
 # make it so that utils can be imported from anywhere
-from .utils import get_db, CustomJSONProvider, get_unittest_db
+from .utils import get_db, CustomJSONProvider, get_unittest_db, init_client_registry
+from .module_summaries import rebuild_module_summaries, SUMMARIES_COLLECTION
+from .references import migrate_references
+from .response_cache import init_response_cache
+from .indexes import apply_indexes, ensure_required_indexes, index_status, advise
+from .metrics import init_metrics
+from .attachments import init_attachment_store, get_attachment_store, sweep_attachments
+from .iv_curves import pack_collection, DTYPES
+from .iv_trends import ensure_trends_collection, rebuild_trends, TRENDS_COLLECTION
+from .burnin_timeline import ensure_timeline, rebuild_timeline, TIMELINE_COLLECTION
+from .cabling_graph import get_cabling_graph, materialize_paths, PATHS_COLLECTION
 
 # import configs as config_module
  
@@ -37,7 +48,7 @@ from .resources import (
     module_test_analysis,
     IV_scans,
 )
-from .blueprints import add_run_bp, logbook_bp, cables_bp, add_analysis_bp, webgui_bp, TBPS_blueprints, db_sync_bp, modules_on_ring
+from .blueprints import add_run_bp, logbook_bp, cables_bp, add_analysis_bp, webgui_bp, TBPS_blueprints, db_sync_bp, modules_on_ring, monitoring_bp, counters_bp, iv_analytics_bp, iv_scans_bp, burnin_timeline_bp
 from resources.burnin_cycles import BurninCyclesResource
 
 
@@ -54,22 +65,74 @@ def create_app(config_name):
     app.config["MONGO_URI"] = os.environ["MONGO_URI"]+"/"+ os.environ["MONGO_DB_NAME"]+"?authSource=admin"
     app.config["MONGO_DB_NAME"] = os.environ["MONGO_DB_NAME"]
     app.config["TESTING"] = os.environ["TESTING"]
+    # connection pool of the process-wide MongoClient shared by all the requests
+    app.config["MONGO_MAX_POOL_SIZE"] = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))
+    app.config["MONGO_MIN_POOL_SIZE"] = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+    app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+    app.config["MONGO_MAX_IDLE_TIME_MS"] = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000))
+    # cache of the responses of the heavy dashboard endpoints (TTL in seconds)
+    app.config["RESPONSE_CACHE_MAX_ENTRIES"] = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 256))
+    app.config["RESPONSE_CACHE_TTL"] = int(os.environ.get("RESPONSE_CACHE_TTL", 300))
+    # requests slower than this (ms) are logged with their MongoDB commands, 0 disables the log
+    app.config["SLOW_REQUEST_MS"] = int(os.environ.get("SLOW_REQUEST_MS", 1000))
+    # logbook attachments: "local" (files under ATTACHMENT_DIR) or "gridfs", see attachments.py
+    app.config["ATTACHMENT_BACKEND"] = os.environ.get("ATTACHMENT_BACKEND", "local")
+    app.config["ATTACHMENT_DIR"] = os.environ.get("ATTACHMENT_DIR", "/attachments")
+    # a released content used in the last ATTACHMENT_GRACE_SECONDS is kept for sweep-attachments
+    app.config["ATTACHMENT_GRACE_SECONDS"] = int(os.environ.get("ATTACHMENT_GRACE_SECONDS", 600))
+    # the local attachments are sent by the front-end proxy (X-Sendfile) instead of the worker
+    app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "0") == "1"
+    # IV scan curves stored as BSON "arrays" or as typed "binary" blobs (float64 or float32), see iv_curves.py
+    app.config["IV_STORAGE"] = os.environ.get("IV_STORAGE", "arrays")
+    app.config["IV_BINARY_DTYPE"] = os.environ.get("IV_BINARY_DTYPE", "float64")
+    if app.config["IV_BINARY_DTYPE"] not in DTYPES:
+        raise ValueError(f"IV_BINARY_DTYPE should be one of {', '.join(DTYPES)}")
+    # |V| of the currents kept in the IV trend points (/iv_trends), see iv_trends.py
+    app.config["IV_TREND_VOLTAGES"] = [float(v) for v in os.environ.get("IV_TREND_VOLTAGES", "100,300,600").split(",")]
+    # default parameters of the IV figures of merit (/iv_analytics), see iv_analytics.py
+    app.config["IV_ANALYSIS_PARAMETERS"] = {
+        "vop": float(os.environ.get("IV_OPERATING_VOLTAGE", 300)),
+        "breakdown_threshold": float(os.environ.get("IV_BREAKDOWN_THRESHOLD", 4)),
+        "breakdown_min_voltage": float(os.environ.get("IV_BREAKDOWN_MIN_VOLTAGE", 20)),
+        "reference_temperature": float(os.environ.get("IV_REFERENCE_TEMPERATURE", 20)),
+    }
+    # duration of the burn-in cycles without a BurninCycleEndDate in the timeline, see burnin_timeline.py
+    app.config["BURNIN_CYCLE_DURATION_HOURS"] = float(os.environ.get("BURNIN_CYCLE_DURATION_HOURS", 24))
     api = Api(app)
     mongo = PyMongo(app)
     app.json = CustomJSONProvider(app)
+
+    # the dicts returned by the resources are encoded like jsonify, instead of with flask_restful's json.dumps
+    @api.representation("application/json")
+    def output_json(data, code, headers=None):
+        response = app.json.response(data)
+        response.status_code = code
+        response.headers.extend(headers or {})
+        return response
     
-    # needed to clean up connections after each request at the end of application context
+    # before the client registry, which adds the command listener of the metrics to its clients
+    init_metrics(app)
+    init_client_registry(app)
+    init_response_cache(app)
+    init_attachment_store(app)
+
+    # the few indexes the app needs to be correct (the unique sessionName, the logbook text index),
+    # also without apply-indexes; a failure, e.g. duplicate sessions, is logged and the app still starts
+    with app.app_context():
+        try:
+            failed = ensure_required_indexes(get_db())
+        except PyMongoError as e:
+            failed = {"required indexes": {"all": str(e)}}
+        for collection, errors in failed.items():
+            for name, error in errors.items():
+                app.logger.warning(f"{collection}: {name} not created: {error}")
+
+    # the MongoClient is pooled and reused across requests: at the end of the
+    # application context we only drop the per-request handles, without closing it
     @app.teardown_appcontext
-    def close_db_connections(exception=None):
-        # Close connection from get_db()
-        db = g.pop('db', None)
-        if db is not None and hasattr(db, 'client'):
-            db.client.close()
-        
-        # Close connection from get_unittest_db() if it was used
-        unittest_db = g.pop('unittest_db', None)
-        if unittest_db is not None and hasattr(unittest_db, 'client'):
-            unittest_db.client.close()
+    def release_db_connections(exception=None):
+        g.pop('db', None)
+        g.pop('unittest_db', None)
 
     # Load resources
     api.add_resource(modules.ModulesResource, "/modules", "/modules/<string:moduleName>")
@@ -116,22 +179,119 @@ def create_app(config_name):
     app.register_blueprint(TBPS_blueprints.bp)
     app.register_blueprint(db_sync_bp.bp)
     app.register_blueprint(modules_on_ring.bp)
+    app.register_blueprint(monitoring_bp.bp)
+    app.register_blueprint(counters_bp.bp)
+    app.register_blueprint(iv_analytics_bp.bp)
+    app.register_blueprint(iv_scans_bp.bp)
+    app.register_blueprint(burnin_timeline_bp.bp)
 
-    # Ensure MongoDB indexes exist for performant $lookup and $sort operations.
-    # create_index is idempotent — it's a no-op if the index already exists.
-    with app.app_context():
+    # run with apply-indexes on every container start: the pipelines only $lookup ObjectId references
+    @app.cli.command("migrate-references")
+    def migrate_references_command():
+        """Converts the _id references stored as strings to ObjectIds, see scripts/migrate_object_ids.py."""
+        converted = migrate_references(get_db())
+        for collection, count in converted.items():
+            if count:
+                print(f"{collection}: {count} documents converted")
+        if any(converted.values()):
+            # the summaries embed the converted documents: they are rebuilt on the next read
+            get_db()[SUMMARIES_COLLECTION].delete_many({})
+        else:
+            print("No string references left")
+
+    @app.cli.command("rebuild-module-summaries")
+    def rebuild_module_summaries_command():
+        """Rebuilds the module_summaries collection from scratch, e.g. to backfill it."""
+        count = rebuild_module_summaries(get_db())
+        print(f"Rebuilt {count} module summaries")
+
+    # the indexes are declared in indexes.py and created once per deployment with this command,
+    # not by every worker at startup
+    @app.cli.command("apply-indexes")
+    def apply_indexes_command():
+        """Creates the indexes declared in the registry that are missing (or have other options)."""
+        # a time-series collection has to be created as such, before its indexes
+        ensure_trends_collection(get_db())
+        applied, failed = apply_indexes(get_db())
+        for collection, names in applied.items():
+            print(f"{collection}: created {', '.join(names)}")
+        for collection, errors in failed.items():
+            for name, error in errors.items():
+                print(f"{collection}: {name} not created: {error}")
+        created = sum(len(names) for names in applied.values())
+        if failed:
+            print(f"{sum(len(errors) for errors in failed.values())} indexes not created ({created} created)")
+        else:
+            print(f"Indexes up to date ({created} created)")
+        # the materialized cabling paths, then kept up to date by the cabling endpoints
+        if get_db()[PATHS_COLLECTION].estimated_document_count() == 0:
+            count = materialize_paths(get_db(), get_cabling_graph(get_db()))
+            if count:
+                print(f"{count} paths written to {PATHS_COLLECTION}")
+        # backfills the trend points, also when they were written per (module, session) before
+        trends = get_db()[TRENDS_COLLECTION]
+        if trends.find_one({"meta.IVScanId": {"$exists": False}}, {"_id": 1}) is not None or (
+            trends.estimated_document_count() == 0 and get_db()["iv_scans"].estimated_document_count() > 0
+        ):
+            count = rebuild_trends(get_db(), app.config["IV_TREND_VOLTAGES"])
+            print(f"{count} points written to {TRENDS_COLLECTION}")
+        # backfills the timeline of the cycles written before it existed
+        count = ensure_timeline(get_db(), datetime.timedelta(hours=app.config["BURNIN_CYCLE_DURATION_HOURS"]))
+        if count:
+            print(f"{count} entries written to {TIMELINE_COLLECTION}")
+
+    @app.cli.command("index-status")
+    def index_status_command():
+        """Lists the indexes declared in the registry that are missing, and the ones not declared."""
+        status = index_status(get_db())
+        for collection, diff in status.items():
+            print(f"{collection}: missing {diff['missing']}, not in the registry {diff['unlisted']}")
+        if not status:
+            print("The indexes match the registry")
+
+    @app.cli.command("index-advisor")
+    def index_advisor_command():
+        """Replays the query shapes of the app with explain() and reports the collection scans."""
+        report = advise(get_db())
+        for entry in report:
+            if "error" in entry:
+                print(f"{entry['collection']}: {entry['query']}: explain failed: {entry['error']}")
+            else:
+                print(f"{entry['collection']}: {entry['query']}: COLLSCAN of {', '.join(entry['collection_scans'])}")
+        if not report:
+            print("No collection scans")
+
+    @app.cli.command("materialize-cabling-paths")
+    def materialize_cabling_paths_command():
+        """Writes the module line paths of the cabling graph to the connection_snapshot collection."""
         db = get_db()
-        db["test_runs"].create_index("test_runName")
-        db["test_runs"].create_index("runSession")
-        db["test_runs"].create_index("runDate")
-        db["sessions"].create_index("sessionName")
-        db["module_test_analysis"].create_index("moduleTestAnalysisName")
-        db["module_tests"].create_index("test_runName")
-        db["module_tests"].create_index("moduleTestName")
-        db["module_tests"].create_index("moduleName")
-        db["modules"].create_index("moduleName")
-        db["burnin_cycles"].create_index("BurninCycleName")
-    
+        count = materialize_paths(db, get_cabling_graph(db))
+        print(f"{count} paths written to {PATHS_COLLECTION}")
+
+    @app.cli.command("sweep-attachments")
+    def sweep_attachments_command():
+        """Deletes the logbook attachments no entry references that were not used for ATTACHMENT_GRACE_SECONDS."""
+        count = sweep_attachments(get_db()["logbook"], get_attachment_store(), app.config["ATTACHMENT_GRACE_SECONDS"])
+        print(f"{count} unreferenced attachments deleted")
+
+    @app.cli.command("rebuild-iv-trends")
+    def rebuild_iv_trends_command():
+        """Rebuilds the IV trend points from all the IV scans, e.g. to backfill them or after changing IV_TREND_VOLTAGES."""
+        count = rebuild_trends(get_db(), app.config["IV_TREND_VOLTAGES"])
+        print(f"{count} points written to {TRENDS_COLLECTION}")
+
+    @app.cli.command("rebuild-burnin-timeline")
+    def rebuild_burnin_timeline_command():
+        """Rebuilds the burn-in cycle timeline from all the cycles, e.g. after changing BURNIN_CYCLE_DURATION_HOURS."""
+        count = rebuild_timeline(get_db(), datetime.timedelta(hours=app.config["BURNIN_CYCLE_DURATION_HOURS"]))
+        print(f"{count} entries written to {TIMELINE_COLLECTION}")
+
+    @app.cli.command("pack-iv-scans")
+    def pack_iv_scans_command():
+        """Packs the curves of the IV scans stored as arrays into typed binary blobs (IV_BINARY_DTYPE)."""
+        count = pack_collection(get_db()["iv_scans"], app.config["IV_BINARY_DTYPE"])
+        print(f"{count} IV scans packed")
+
     # flask-pymongo blueprint for generic mongodb queries on modules
     @app.route("/generic_module_query", methods=['POST'])
     def generic_module_query():
@@ -148,7 +308,7 @@ def create_app(config_name):
             return jsonify({"error": "No data provided"}), 400
         filtered_modules = mongo.db.modules.find(query, projection) 
     
-        return jsonify([json_util.loads(json_util.dumps(module)) for module in filtered_modules]), 200
+        return jsonify(list(filtered_modules)), 200
 
     return app
 
@@ -0,0 +1,223 @@
+# ASGI serving mode: the read-heavy GET endpoints on an async MongoDB driver, everything else on Flask
+#
+# with sync workers one slow aggregation (e.g. /fetch_all_module_test_results) holds the worker,
+# and every other client waits behind it, including the test stations posting /addRun. In this
+# mode the GETs of ASYNC_ROUTES are served on the event loop with PyMongo's async API (or Motor),
+# so a slow aggregation only waits on MongoDB, and the independent queries of a request run
+# concurrently. All the other requests, and every write, go to the Flask app of create_app,
+# run in a thread by asgiref's WsgiToAsgi, with the same resources, hooks and caches as before.
+# The handlers reuse the pipelines and the response builders of the blueprints.
+#
+#   cd deploy && uvicorn --host 0.0.0.0 --port 5000 asgi:app    (or SERVER_MODE=asgi in the Docker image)
+
+import asyncio
+import inspect
+import logging
+import re
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from bson import ObjectId
+
+try:
+    # PyMongo >= 4.9
+    from pymongo import AsyncMongoClient
+except ImportError:
+    from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+
+from .app import create_app
+from .utils import dumpb, get_server_uri
+from .module_summaries import SUMMARIES_COLLECTION
+from .blueprints.TBPS_blueprints import (
+    all_module_test_metadata_pipeline,
+    module_test_page_pipeline,
+    module_test_results_response,
+    module_test_with_session_data_pipeline,
+    session_with_related_data_pipeline,
+)
+
+logger = logging.getLogger(__name__)
+
+# returned by a handler to let the Flask app serve the request instead
+FALLBACK = object()
+
+
+async def _aggregate(collection, pipeline):
+    # aggregate is a coroutine in PyMongo's async API, and returns the cursor directly in Motor
+    cursor = collection.aggregate(pipeline)
+    if inspect.isawaitable(cursor):
+        cursor = await cursor
+    return await cursor.to_list(None)
+
+
+def _int_arg(query, name, default):
+    # as request.args.get(name, default, type=int)
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+async def _find_by_name_or_id(collection, name_field, value):
+    document = await collection.find_one({name_field: value})
+    if document is None and ObjectId.is_valid(value):
+        document = await collection.find_one({"_id": ObjectId(value)})
+    return document
+
+
+async def fetch_all_module_test_results(db, query):
+    page = _int_arg(query, "page", 1)
+    per_page = _int_arg(query, "per_page", 100)
+    module_tests_collection = db["module_tests"]
+    # the metadata (or the count) and the page are independent queries: run them concurrently
+    page_result = _aggregate(module_tests_collection, module_test_page_pipeline(page, per_page))
+    if page == 1:
+        metadata_list, page_result = await asyncio.gather(
+            _aggregate(module_tests_collection, all_module_test_metadata_pipeline()), page_result
+        )
+        total_items = len(metadata_list)
+    else:
+        metadata_list = None
+        total_items, page_result = await asyncio.gather(module_tests_collection.count_documents({}), page_result)
+    page_data_dict = {item["moduleTestName"]: item for item in page_result}
+    return module_test_results_response(metadata_list, total_items, page_data_dict, page, per_page), 200
+
+
+async def fetch_session_results(db, query, session_name):
+    result = await _aggregate(db["sessions"], session_with_related_data_pipeline(session_name))
+    if not result:
+        return {"error": f"Session {session_name} not found"}, 404
+    return result[0], 200
+
+
+async def fetch_module_test_results(db, query, module_test_id):
+    result = await _aggregate(db["module_tests"], module_test_with_session_data_pipeline(module_test_id))
+    if not result:
+        return {"error": f"Module test {module_test_id} not found"}, 404
+    return result[0], 200
+
+
+async def fetch_module_results(db, query, module_name):
+    summary = await db[SUMMARIES_COLLECTION].find_one({"moduleName": module_name})
+    if summary is None:
+        # the summary has to be built and stored: a write, left to the Flask app
+        return FALLBACK
+    return summary, 200
+
+
+async def get_module(db, query, moduleName):
+    module = await _find_by_name_or_id(db["modules"], "moduleName", moduleName)
+    if module is None:
+        module = await db["modules"].find_one({"hwId": moduleName})
+    if module is None:
+        return {"message": "Module not found"}, 404
+    return module, 200
+
+
+async def get_module_test(db, query, moduleTestName):
+    entry = await _find_by_name_or_id(db["module_tests"], "moduleTestName", moduleTestName)
+    if entry is None:
+        return {"message": "Entry not found"}, 404
+    return entry, 200
+
+
+# (url rule of the Flask route, the route label in /metrics), GET path -> handler(db, query args,
+# **path params), returning (body, status) or FALLBACK
+ASYNC_ROUTES = [
+    ("/fetch_all_module_test_results", re.compile(r"^/fetch_all_module_test_results$"), fetch_all_module_test_results),
+    ("/fetch_session_results/<session_name>", re.compile(r"^/fetch_session_results/(?P<session_name>[^/]+)$"), fetch_session_results),
+    ("/fetch_module_test_results/<module_test_id>", re.compile(r"^/fetch_module_test_results/(?P<module_test_id>[^/]+)$"), fetch_module_test_results),
+    ("/fetch_module_results/<module_name>", re.compile(r"^/fetch_module_results/(?P<module_name>[^/]+)$"), fetch_module_results),
+    ("/modules/<string:moduleName>", re.compile(r"^/modules/(?P<moduleName>[^/]+)$"), get_module),
+    ("/module_test/<string:moduleTestName>", re.compile(r"^/module_test/(?P<moduleTestName>[^/]+)$"), get_module_test),
+]
+
+
+class AsyncReadApp:
+    """ASGI app serving ASYNC_ROUTES with an async MongoClient and the rest with the Flask app."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        with flask_app.app_context():
+            self.mongo_uri = get_server_uri()
+        self.db_name = flask_app.config["MONGO_DB_NAME"]
+        metrics = self.metrics = flask_app.extensions.get("request_metrics")
+        self.client_options = {
+            "maxPoolSize": flask_app.config.get("MONGO_MAX_POOL_SIZE", 50),
+            "minPoolSize": flask_app.config.get("MONGO_MIN_POOL_SIZE", 0),
+            "waitQueueTimeoutMS": flask_app.config.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+            "maxIdleTimeMS": flask_app.config.get("MONGO_MAX_IDLE_TIME_MS", 60000),
+            # the MongoDB commands of the async routes are in /metrics as well
+            "event_listeners": [metrics.listener] if metrics is not None else [],
+        }
+        self.client = None
+
+    @property
+    def db(self):
+        # created on first use, inside the event loop of the server
+        if self.client is None:
+            self.client = AsyncMongoClient(self.mongo_uri, **self.client_options)
+        return self.client[self.db_name]
+
+    async def close(self):
+        if self.client is not None:
+            closed = self.client.close()
+            if inspect.isawaitable(closed):
+                await closed
+            self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "GET":
+            for rule, pattern, handler in ASYNC_ROUTES:
+                match = pattern.match(scope["path"])
+                if match is None:
+                    continue
+                started = time.perf_counter()
+                query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+                try:
+                    result = await handler(self.db, query, **match.groupdict())
+                except Exception as e:
+                    logger.exception("Error serving %s", scope["path"])
+                    result = {"error": f"Internal server error: {str(e)}"}, 500
+                if result is not FALLBACK:
+                    await self._send_json(send, *result)
+                    # in the request series of /metrics under the label of the Flask route
+                    if self.metrics is not None:
+                        self.metrics.record_request("GET", rule, result[1], time.perf_counter() - started)
+                    return
+                break
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _send_json(self, send, body, status):
+        body = dumpb(body)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                # as flask_cors does for the Flask routes
+                (b"access-control-allow-origin", b"*"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(config_name):
+    """Creates the Flask app of create_app and wraps it in the ASGI app."""
+    return AsyncReadApp(create_app(config_name))
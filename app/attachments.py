@@ -0,0 +1,328 @@
+# content-addressed store of the logbook attachments
+#
+# an upload is copied to the store in chunks while its SHA-256 is computed, and stored once
+# under that digest: the calibration plot attached to a hundred entries takes the space of one.
+# A logbook entry references /attachments/<digest>/<filename>, and lists its digests in
+# attachment_digests, so that a content is deleted when the last entry referencing it drops it.
+# A content never changes: the downloads carry the digest as ETag (If-None-Match answers 304)
+# and Cache-Control immutable, and support range requests. The local backend sends the file
+# with the WSGI file wrapper (sendfile(2) under gunicorn), or hands it over to the front-end
+# proxy with X-Sendfile when USE_X_SENDFILE is set, so the worker does not copy the bytes.
+#
+# Deleting a content races with an upload of the same bytes, which finds it already stored and
+# keeps no copy of its own. The uploads mark the content as used (the mtime of the file, or
+# metadata.lastUsed in GridFS), and a content is deleted in two steps: it is first moved out of
+# the way (renamed), then deleted only if it is still unreferenced and was not used for
+# ATTACHMENT_GRACE_SECONDS, or else put back. An upload that finds it moved stores its own copy.
+# The contents kept by the grace period are collected by the sweep-attachments command.
+#
+# ATTACHMENT_BACKEND selects the backend: "local" (files under ATTACHMENT_DIR) or "gridfs" (the
+# "attachments" GridFS bucket of the database, shared by all the replicas of the app).
+
+import hashlib
+import mimetypes
+import os
+import datetime
+import re
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import quote, unquote
+
+import gridfs
+from flask import Response, current_app, request, send_file
+from werkzeug.wsgi import wrap_file
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import get_db
+
+CHUNK_SIZE = 1024 * 1024
+# a content never changes under its digest: cached for a year
+MAX_AGE = 365 * 24 * 3600
+GRIDFS_BUCKET = "attachments"
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_digest(value):
+    return DIGEST_RE.match(value) is not None
+
+
+def attachment_url(digest, filename):
+    """The reference to a stored content kept in the attachments of a logbook entry."""
+    return f"/attachments/{digest}/{quote(filename)}"
+
+
+def parse_attachment_url(url):
+    """Returns (digest, filename) of an attachment_url, or (None, None) for a legacy path."""
+    parts = url.split("/", 3)
+    if len(parts) == 4 and parts[1] == "attachments" and is_digest(parts[2]):
+        return parts[2], unquote(parts[3])
+    return None, None
+
+
+def _mimetype(filename):
+    return (filename and mimetypes.guess_type(filename)[0]) or "application/octet-stream"
+
+
+def _chunks(stream, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _utcnow():
+    # naive UTC, as the datetimes read back from MongoDB
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _immutable(response):
+    if response.status_code in (200, 206, 304):
+        response.cache_control.immutable = True
+    return response
+
+
+class LocalAttachmentStore:
+    """Attachments as files under <root>/sha256/<first 2 hex digits>/<digest>."""
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "sha256")
+
+    def path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def put(self, stream, filename=None):
+        """Copies the stream into the store, returns (digest, size)."""
+        os.makedirs(self.objects, exist_ok=True)
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in _chunks(stream):
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            digest = sha256.hexdigest()
+            path = self.path(digest)
+            try:
+                # already stored, e.g. the same plot attached again: marked as used, so that a
+                # concurrent deletion puts it back
+                os.utime(path)
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                # not stored, or being deleted: this copy is stored
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # readable by the front-end proxy with X-Sendfile
+                os.chmod(tmp_path, 0o644)
+                # atomic: a concurrent upload of the same content renames the same bytes
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, size
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def delete_unused(self, digest, is_referenced, grace):
+        """
+        Deletes a content if is_referenced() is false once it is moved out of the way, and it was
+        not used for grace seconds. Returns True if it was deleted.
+        """
+        path = self.path(digest)
+        moved = f"{path}.deleting-{uuid.uuid4().hex}"
+        try:
+            os.replace(path, moved)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(moved).st_mtime < grace or is_referenced():
+            # a concurrent upload stored it again meanwhile: the same bytes
+            os.replace(moved, path)
+            return False
+        os.remove(moved)
+        return True
+
+    def digests(self):
+        """The digests of the stored contents."""
+        for _, _, names in os.walk(self.objects):
+            for name in names:
+                if is_digest(name):
+                    yield name
+
+    def send(self, digest, filename=None):
+        """The response serving the content (conditional and range requests), None if it is not stored."""
+        path = self.path(digest)
+        if not os.path.exists(path):
+            return None
+        response = send_file(
+            path, mimetype=_mimetype(filename), conditional=True, etag=digest, max_age=MAX_AGE, download_name=filename
+        )
+        return _immutable(response)
+
+
+class GridFSAttachmentStore:
+    """Attachments as the files of a GridFS bucket, named after their digest."""
+
+    def __init__(self, bucket_name=GRIDFS_BUCKET, db_getter=get_db):
+        self.bucket_name = bucket_name
+        self.db_getter = db_getter
+
+    @property
+    def bucket(self):
+        return gridfs.GridFSBucket(self.db_getter(), bucket_name=self.bucket_name)
+
+    def _files(self):
+        return self.db_getter()[f"{self.bucket_name}.files"]
+
+    def _find(self, digest):
+        return self._files().find_one({"filename": digest}, {"_id": 1, "length": 1})
+
+    def put(self, stream, filename=None):
+        """Copies the stream into the bucket, returns (digest, size)."""
+        bucket = self.bucket
+        sha256 = hashlib.sha256()
+        size = 0
+        # the digest is known at the end of the upload: the file is written under a temporary name
+        with bucket.open_upload_stream(".upload", metadata={"contentType": _mimetype(filename)}) as upload:
+            for chunk in _chunks(stream):
+                sha256.update(chunk)
+                upload.write(chunk)
+                size += len(chunk)
+            file_id = upload._id
+        digest = sha256.hexdigest()
+        # already stored: marked as used, so that a concurrent deletion puts it back
+        used = self._files().update_one({"filename": digest}, {"$set": {"metadata.lastUsed": _utcnow()}})
+        if used.matched_count:
+            bucket.delete(file_id)
+        else:
+            # not stored, or being deleted: this copy is stored
+            bucket.rename(file_id, digest)
+        return digest, size
+
+    def exists(self, digest):
+        return self._find(digest) is not None
+
+    def delete(self, digest):
+        bucket = self.bucket
+        # a concurrent upload of the same content may have stored it twice
+        for grid_file in bucket.find({"filename": digest}):
+            bucket.delete(grid_file._id)
+
+    def delete_unused(self, digest, is_referenced, grace):
+        """
+        Deletes a content if is_referenced() is false once it is moved out of the way, and it was
+        not used for grace seconds. Returns True if it was deleted.
+        """
+        files = self._files()
+        deleted = False
+        for file_id in [doc["_id"] for doc in files.find({"filename": digest}, {"_id": 1})]:
+            # renamed only if no one else is deleting it
+            if not files.update_one({"_id": file_id, "filename": digest}, {"$set": {"filename": f"{digest}.deleting"}}).modified_count:
+                continue
+            doc = files.find_one({"_id": file_id}, {"uploadDate": 1, "metadata.lastUsed": 1})
+            last_used = max(doc["uploadDate"], (doc.get("metadata") or {}).get("lastUsed") or doc["uploadDate"])
+            if (_utcnow() - last_used).total_seconds() < grace or is_referenced():
+                files.update_one({"_id": file_id}, {"$set": {"filename": digest}})
+            else:
+                self.bucket.delete(file_id)
+                deleted = True
+        return deleted
+
+    def digests(self):
+        """The digests of the stored contents."""
+        for name in self._files().distinct("filename"):
+            if is_digest(name):
+                yield name
+
+    def send(self, digest, filename=None):
+        """The response serving the content (conditional and range requests), None if it is not stored."""
+        try:
+            grid_out = self.bucket.open_download_stream_by_name(digest)
+        except gridfs.errors.NoFile:
+            return None
+        response = Response(
+            wrap_file(request.environ, grid_out, CHUNK_SIZE), mimetype=_mimetype(filename), direct_passthrough=True
+        )
+        response.content_length = grid_out.length
+        response.last_modified = grid_out.upload_date
+        response.set_etag(digest)
+        response.cache_control.public = True
+        response.cache_control.max_age = MAX_AGE
+        # 304 on If-None-Match, 206 with the requested range (GridOut is seekable)
+        response.make_conditional(request.environ, accept_ranges=True, complete_length=grid_out.length)
+        return _immutable(response)
+
+
+def init_attachment_store(app):
+    """Creates the attachment store of the app, configured from app.config."""
+    backend = app.config.get("ATTACHMENT_BACKEND", "local")
+    if backend == "local":
+        store = LocalAttachmentStore(app.config.get("ATTACHMENT_DIR", "/attachments"))
+    elif backend == "gridfs":
+        store = GridFSAttachmentStore()
+    else:
+        raise ValueError(f"Unknown ATTACHMENT_BACKEND {backend!r}, expected 'local' or 'gridfs'")
+    app.extensions["attachment_store"] = store
+    return store
+
+
+def get_attachment_store():
+    store = current_app.extensions.get("attachment_store")
+    if store is None:
+        store = init_attachment_store(current_app)
+    return store
+
+
+def store_uploads(files):
+    """
+    Stores the uploaded files of a request.
+
+    Returns:
+        {filename: attachment_url} and the list of their digests
+    """
+    store = get_attachment_store()
+    attachments = {}
+    digests = []
+    # the GUI sends all the files under the same "attachments" field
+    for _, file in files.items(multi=True):
+        if not file.filename:
+            continue
+        digest, _ = store.put(file.stream, file.filename)
+        attachments[file.filename] = attachment_url(digest, file.filename)
+        digests.append(digest)
+    return attachments, digests
+
+
+def _is_referenced(logbook_collection, digest):
+    return logbook_collection.count_documents({"attachment_digests": digest}, limit=1) > 0
+
+
+def release_attachment(logbook_collection, digest):
+    """
+    Deletes a content from the store if no logbook entry references it anymore, unless it was used
+    within ATTACHMENT_GRACE_SECONDS (it is then left to sweep_attachments).
+    """
+    if not _is_referenced(logbook_collection, digest):
+        grace = current_app.config.get("ATTACHMENT_GRACE_SECONDS", 600)
+        get_attachment_store().delete_unused(digest, lambda: _is_referenced(logbook_collection, digest), grace)
+
+
+def sweep_attachments(logbook_collection, store, grace):
+    """Deletes the stored contents no logbook entry references that were not used for grace seconds, returns how many."""
+    referenced = set(logbook_collection.distinct("attachment_digests"))
+    deleted = 0
+    for digest in list(store.digests()):
+        if digest not in referenced and store.delete_unused(digest, lambda: _is_referenced(logbook_collection, digest), grace):
+            deleted += 1
+    return deleted
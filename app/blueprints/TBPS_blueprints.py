@@ -12,219 +12,79 @@ from jsonschema import validate, ValidationError
 from flask import request, jsonify, Blueprint
 from bson import ObjectId
 from utils import get_db, cable_templates_schema, cables_schema
+from module_summaries import get_module_summary
+from response_cache import cached_response
+from testing_flow import build_testing_flow
+from references import in_reference_order
+from burnin_timeline import session_cycle_events
 
 bp = Blueprint("fetch_TBPS_data", __name__)
 
-def get_module_with_related_data(modules_collection, module_name):
-    pipeline = [
-        # Stage 1: Match the specific module by name
+def session_with_related_data_pipeline(session_name):
+    """Aggregation pipeline on the sessions collection joining the session with its runs, module tests, modules and analyses."""
+    return [
+        # Stage 1: Match the specific session by name
         {
             "$match": {
-                "moduleName": module_name
-            }
-        },
-        # Stage 2: Unwind the _moduleTest_id array
-        {
-            "$unwind": {
-                "path": "$_moduleTest_id",
-                "preserveNullAndEmptyArrays": True
-            }
-            
-        },
-        # Stage 3: Define the testId field as the single entries in the _moduleTests_id array
-        {
-            "$addFields": {
-                "testId": "$_moduleTest_id"
-            }
-        },
-        # convert the testId to an ObjectId
-        {
-            "$addFields": {
-                "testId": { "$toObjectId": "$testId" }
-            }
-        },
-        # Stage 4: Lookup the moduleTests documents using the extracted ID
-        {
-            "$lookup": {
-                "from": "module_tests",
-                "localField": "testId",
-                "foreignField": "_id",
-                "as": "testDetails"
-            }
-        },
-        # Stage 5: Add first test detail to the document
-        {
-            "$addFields": {
-                "testDetail": { "$arrayElemAt": ["$testDetails", 0] }
+                "sessionName": session_name
             }
         },
-        # Stage 6: Lookup the test_run document
+        # Stage 2: Lookup the test_runs documents referenced by the _test_run_id array
+        # (ObjectIds, matched directly on the _id index)
         {
             "$lookup": {
                 "from": "test_runs",
-                "localField": "testDetail.test_runName",
-                "foreignField": "test_runName",
-                "as": "testRun"
-            }
-        },
-        # Stage 7: Add test run to document
-        {
-            "$addFields": {
-                "run": { "$arrayElemAt": ["$testRun", 0] }
-            }
-        },
-        # Stage 8: Lookup the session
-        {
-            "$lookup": {
-                "from": "sessions",
-                "localField": "run.runSession",
-                "foreignField": "sessionName",
-                "as": "sessionData"
-            }
-        },
-        # Stage 9: Add session to document
-        {
-            "$addFields": {
-                "session": { "$arrayElemAt": ["$sessionData", 0] }
-            }
-        },
-        # Stage 10: Get the last analysis ID
-        {
-            "$addFields": {
-                "lastAnalysisId": { 
-                    "$arrayElemAt": ["$testDetail.analysesList", -1] 
-                }
-            }
-        },
-        # Stage 11: Lookup the analysis
-        {
-            "$lookup": {
-                "from": "module_test_analysis",
-                "localField": "lastAnalysisId",
-                "foreignField": "moduleTestAnalysisName",
-                "as": "analysisData"
-            }
-        },
-        # Stage 12: Add analysis to document
-        {
-            "$addFields": {
-                "analysis": { "$arrayElemAt": ["$analysisData", 0] }
+                "localField": "_test_run_id",
+                "foreignField": "_id",
+                "as": "runDetails"
             }
         },
-        # Stage 13: Create a combined test document
+        # in the order of the _test_run_id array
         {
             "$addFields": {
-                "combinedTest": {
-                    "name": "$testDetail.moduleTestName",
-                    "id": "$testId",
-                    "details": "$testDetail",
-                    "run": "$run",
-                    "session": "$session",
-                    "analysis": "$analysis"
-                }
-            }
-        },
-        # Stage 14: Group back to rebuild the module with all tests
-        {
-            "$group": {
-                "_id": "$_id",
-                "moduleName": { "$first": "$moduleName" },
-                "position": { "$first": "$position" },
-                "status": { "$first": "$status" },
-                "type": { "$first": "$type" },
-                "crateSide": { "$first": "$crateSide" },
-                "tests": { "$push": "$combinedTest" }
+                "runDetails": in_reference_order("$runDetails", "$_test_run_id")
             }
         },
-        # Stage 15: Clean up by removing unnecessary fields
-        {
-            "$project": {
-                "moduleTests": 0
-            }
-        }
-    ]
-    
-    result = modules_collection.aggregate(pipeline)
-    return list(result)[0] if result else None
-
-
-def get_session_with_related_data(sessions_collection, session_name):
-    pipeline = [
-        # Stage 1: Match the specific session by name
-        {
-            "$match": {
-                "sessionName": session_name
-            }
-        },
-        # Stage 2: Unwind the _test_run_id array
+        # Stage 3: One document per run
         {
             "$unwind": {
-                "path": "$_test_run_id",
+                "path": "$runDetails",
                 "preserveNullAndEmptyArrays": True
             }
         },
-        # Stage 3: Define the runId field as the single entries in the _test_run_id array
-        {
-            "$addFields": {
-                "runId": "$_test_run_id"
-            }
-        },
-        # Convert the runId to an ObjectId
         {
             "$addFields": {
-                "runId": { "$toObjectId": "$runId" }
+                "runDetail": "$runDetails"
             }
         },
-        # Stage 4: Lookup the test_runs documents using the extracted ID
+        # Stage 4: Lookup the moduleTests documents referenced by the _moduleTest_id array of the run
         {
             "$lookup": {
-                "from": "test_runs",
-                "localField": "runId",
+                "from": "module_tests",
+                "localField": "runDetail._moduleTest_id",
                 "foreignField": "_id",
-                "as": "runDetails"
+                "as": "moduleTestDetails"
             }
         },
-        # Stage 5: Add first run detail to the document
+        # in the order of the _moduleTest_id array of the run
         {
             "$addFields": {
-                "runDetail": { "$arrayElemAt": ["$runDetails", 0] }
+                "moduleTestDetails": in_reference_order("$moduleTestDetails", "$runDetail._moduleTest_id")
             }
         },
-        # Stage 6: Unwind the _moduleTest_id array from the run
+        # Stage 5: One document per module test
         {
             "$unwind": {
-                "path": "$runDetail._moduleTest_id",
+                "path": "$moduleTestDetails",
                 "preserveNullAndEmptyArrays": True
             }
         },
-        # Stage 7: Define the moduleTestId field
         {
             "$addFields": {
-                "moduleTestId": "$runDetail._moduleTest_id"
+                "moduleTest": "$moduleTestDetails"
             }
         },
-        # Convert the moduleTestId to an ObjectId
-        {
-            "$addFields": {
-                "moduleTestId": { "$toObjectId": "$moduleTestId" }
-            }
-        },
-        # Stage 8: Lookup the moduleTests documents
-        {
-            "$lookup": {
-                "from": "module_tests",
-                "localField": "moduleTestId",
-                "foreignField": "_id",
-                "as": "moduleTestDetails"
-            }
-        },
-        # Stage 9: Add module test to document
-        {
-            "$addFields": {
-                "moduleTest": { "$arrayElemAt": ["$moduleTestDetails", 0] }
-            }
-        },
-        # Stage 10: Lookup the module document
+        # Stage 6: Lookup the module document
         {
             "$lookup": {
                 "from": "modules",
@@ -233,13 +93,13 @@ def get_session_with_related_data(sessions_collection, session_name):
                 "as": "moduleData"
             }
         },
-        # Stage 11: Add module to document
+        # Stage 7: Add module to document
         {
             "$addFields": {
                 "module": { "$arrayElemAt": ["$moduleData", 0] }
             }
         },
-        # Stage 12: Get the last analysis ID
+        # Stage 8: Get the last analysis ID
         {
             "$addFields": {
                 "lastAnalysisId": { 
@@ -247,7 +107,7 @@ def get_session_with_related_data(sessions_collection, session_name):
                 }
             }
         },
-        # Stage 13: Lookup the analysis
+        # Stage 9: Lookup the analysis
         {
             "$lookup": {
                 "from": "module_test_analysis",
@@ -256,13 +116,13 @@ def get_session_with_related_data(sessions_collection, session_name):
                 "as": "analysisData"
             }
         },
-        # Stage 14: Add analysis to document
+        # Stage 10: Add analysis to document
         {
             "$addFields": {
                 "analysis": { "$arrayElemAt": ["$analysisData", 0] }
             }
         },
-        # Stage 15: Create a combined module test document with run info
+        # Stage 11: Create a combined module test document with run info
         {
             "$addFields": {
                 "combined_module_test": {
@@ -279,7 +139,7 @@ def get_session_with_related_data(sessions_collection, session_name):
                 }
             }
         },
-        # Stage 16: Group directly to final session structure with a single module_tests array
+        # Stage 12: Group directly to final session structure with a single module_tests array
         {
             "$group": {
                 "_id": "$_id",
@@ -303,7 +163,7 @@ def get_session_with_related_data(sessions_collection, session_name):
                 "module_tests": { "$push": "$combined_module_test" }
             }
         },
-        # Stage 17: Final projection to clean up the output
+        # Stage 13: Final projection to clean up the output
         {
             "$project": {
                 "_id": 0,
@@ -319,12 +179,13 @@ def get_session_with_related_data(sessions_collection, session_name):
             }
         }
     ]
-    
-    result = sessions_collection.aggregate(pipeline)
+
+def get_session_with_related_data(sessions_collection, session_name):
+    result = sessions_collection.aggregate(session_with_related_data_pipeline(session_name))
     return list(result)[0] if result else None
 
-def get_module_test_with_session_data(module_tests_collection, module_test_id):
-    pipeline = [
+def module_test_with_session_data_pipeline(module_test_id):
+    return [
         # Stage 1: Match the specific module test by ID
         {
             "$match": {
@@ -401,8 +262,9 @@ def get_module_test_with_session_data(module_tests_collection, module_test_id):
             }
         }
     ]
-    
-    result = module_tests_collection.aggregate(pipeline)
+
+def get_module_test_with_session_data(module_tests_collection, module_test_id):
+    result = module_tests_collection.aggregate(module_test_with_session_data_pipeline(module_test_id))
     return list(result)[0] if result else None
 
 def get_all_module_test_with_session_data(module_tests_collection):
@@ -507,10 +369,11 @@ def fetch_module_results(module_name):
     if not module_name: 
         return jsonify({"error": "Module name is required"}), 400
 
-    db = get_db()
-    modules_collection = db["modules"]
-    module = get_module_with_related_data(modules_collection, module_name)
-    return module, 200 if module else 404
+    # a single read of the materialized summary (see module_summaries.py)
+    module = get_module_summary(get_db(), module_name)
+    if not module:
+        return jsonify({"error": "Module not found"}), 404
+    return module, 200
 
 @bp.route("/fetch_session_results/<session_name>", methods=["GET"])
 def fetch_session_results(session_name):
@@ -532,9 +395,9 @@ def fetch_module_test_results(module_test_id):
     module_test = get_module_test_with_session_data(module_tests_collection, module_test_id)
     return module_test, 200 if module_test else 404
 
-def get_all_module_test_metadata(module_tests_collection):
+def all_module_test_metadata_pipeline():
     """
-    Fetch lightweight metadata for all module tests to support frontend filtering/search
+    Lightweight metadata of all module tests to support frontend filtering/search
     without loading full documents.
 
     Optimization: uses a $lookup pipeline with $project inside the sub-pipeline
@@ -542,7 +405,7 @@ def get_all_module_test_metadata(module_tests_collection):
     rather than pulling entire run documents.  With an index on
     test_runs.test_runName this becomes an indexed nested-loop join.
     """
-    pipeline = [
+    return [
         # Project only the field needed for the join before the $lookup
         {"$project": {
             "moduleTestName": 1,
@@ -572,11 +435,14 @@ def get_all_module_test_metadata(module_tests_collection):
             "_id": 0
         }}
     ]
-    return list(module_tests_collection.aggregate(pipeline))
 
-def get_module_test_page(module_tests_collection, page, per_page):
+def get_all_module_test_metadata(module_tests_collection):
+    """Fetch lightweight metadata for all module tests (see all_module_test_metadata_pipeline)."""
+    return list(module_tests_collection.aggregate(all_module_test_metadata_pipeline()))
+
+def module_test_page_pipeline(page, per_page):
     """
-    Fetch full data for a specific page of module tests, applying heavy lookups only
+    Full data for a specific page of module tests, applying heavy lookups only
     to the requested slice.
 
     Optimization: uses sub-pipeline $lookup (with $project) so MongoDB fetches
@@ -584,7 +450,7 @@ def get_module_test_page(module_tests_collection, page, per_page):
     session + analysis lookups only run on the already-paginated slice.
     """
     skip = (page - 1) * per_page
-    pipeline = [
+    return [
         # 1. Join with runs for sorting — use sub-pipeline to limit fetched fields
         {"$lookup": {
             "from": "test_runs",
@@ -670,37 +536,23 @@ def get_module_test_page(module_tests_collection, page, per_page):
             "moduleTestLog": 1
         }}
     ]
-    
-    result = list(module_tests_collection.aggregate(pipeline))
+
+def get_module_test_page(module_tests_collection, page, per_page):
+    """Fetch full data for a specific page of module tests (see module_test_page_pipeline)."""
+    result = list(module_tests_collection.aggregate(module_test_page_pipeline(page, per_page)))
     return {item["moduleTestName"]: item for item in result}
 
-@bp.route("/fetch_all_module_test_results", methods=["GET"])
-def fetch_all_module_test_results():
-    db = get_db()
-    module_tests_collection = db["module_tests"]
-    
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 100, type=int)
-    
+def module_test_results_response(metadata_list, total_items, page_data_dict, page, per_page):
+    """Builds the /fetch_all_module_test_results response (metadata_list is only given on page 1)."""
     response_data = {
         "module_tests": {}
     }
-    
-    # 1. Fetch Metadata (Only on page 1 to allow frontend to build filter lists)
-    if page == 1:
-        metadata_list = get_all_module_test_metadata(module_tests_collection)
+    if metadata_list is not None:
         response_data["module_tests"]["all_names"] = [m["moduleTestName"] for m in metadata_list]
         response_data["module_tests"]["all_module_names"] = [m.get("moduleName") for m in metadata_list]
         response_data["module_tests"]["all_types"] = [m.get("runType") for m in metadata_list]
         response_data["module_tests"]["unique_types"] = list(set(m.get("runType") for m in metadata_list if m.get("runType")))
         response_data["module_tests"]["is_from_session1"] = [m.get("sessionName") == "session1" for m in metadata_list]
-        total_items = len(metadata_list)
-    else:
-        # For other pages, get count efficiently
-        total_items = module_tests_collection.count_documents({})
-    
-    # 2. Fetch Page Data (Efficiently)
-    page_data_dict = get_module_test_page(module_tests_collection, page, per_page)
     
     # Fill response
     response_data["module_tests"]["current_names"] = list(page_data_dict.keys())
@@ -712,10 +564,33 @@ def fetch_all_module_test_results():
         "per_page": per_page,
         "total_pages": (total_items + per_page - 1) // per_page
     }
+    return response_data
+
+@bp.route("/fetch_all_module_test_results", methods=["GET"])
+def fetch_all_module_test_results():
+    db = get_db()
+    module_tests_collection = db["module_tests"]
     
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 100, type=int)
+    
+    # 1. Fetch Metadata (Only on page 1 to allow frontend to build filter lists)
+    if page == 1:
+        metadata_list = get_all_module_test_metadata(module_tests_collection)
+        total_items = len(metadata_list)
+    else:
+        # For other pages, get count efficiently
+        metadata_list = None
+        total_items = module_tests_collection.count_documents({})
+    
+    # 2. Fetch Page Data (Efficiently)
+    page_data_dict = get_module_test_page(module_tests_collection, page, per_page)
+    
+    response_data = module_test_results_response(metadata_list, total_items, page_data_dict, page, per_page)
     return jsonify(response_data), 200
 
 @bp.route("/fetch_all_module_test_results_optimized", methods=["GET"])
+@cached_response(get_db, ["module_tests", "test_runs", "sessions", "module_test_analysis"])
 def fetch_all_module_test_results_optimized():
     """
     Optimized endpoint with server-side filtering and pagination.
@@ -882,13 +757,14 @@ def fetch_all_module_test_results_optimized():
 
 
 @bp.route("/fetch_session_testing_flow/<session_name>", methods=["GET"])
+@cached_response(get_db, ["sessions", "test_runs", "module_tests", "burnin_cycles"])
 def fetch_session_testing_flow(session_name):
     """
     Fetch the complete testing flow for all modules in a session using MongoDB aggregation.
     Returns module tests and burn-in cycles sorted by timestamp for visualization.
     
-    This uses two efficient pipelines (one for test runs, one for burn-in cycles) then
-    combines the results in Python. The matrix building is done in Python as it requires
+    This uses a pipeline for the test runs and an indexed lookup of the burn-in cycle timeline,
+    then combines the results in Python. The matrix building is done in Python as it requires
     complex nested logic that's more readable and maintainable in Python than in MongoDB.
     """
     if not session_name:
@@ -946,232 +822,11 @@ def fetch_session_testing_flow(session_name):
         
         module_test_events = list(test_runs_collection.aggregate(test_events_pipeline))
         
-        # PIPELINE 2: Get all burn-in cycles for this session
-        burnin_cycles_collection = db["burnin_cycles"]
-        burnin_events_pipeline = [
-            # Match cycles that contain the session name
-            {"$match": {"BurninCycleName": {"$regex": f".*{session_name}.*"}}},
-            
-            # Unwind the modules array to create one event per module
-            {"$unwind": {"path": "$BurninCycleModules", "preserveNullAndEmptyArrays": False}},
-            
-            # Project the fields we need, including temperature label generation
-            {"$project": {
-                "_id": 0,
-                "type": {"$literal": "cycle"},
-                "timestamp": "$BurninCycleDate",
-                "module_name": "$BurninCycleModules",
-                "cycle_name": "$BurninCycleName",
-                "temperatures": "$BurninCycleTemperatures",
-                # Create event_name with temperature info
-                "event_name": {
-                    "$cond": {
-                        "if": {"$and": [
-                            {"$ifNull": ["$BurninCycleTemperatures.low", False]},
-                            {"$ifNull": ["$BurninCycleTemperatures.high", False]}
-                        ]},
-                        "then": {
-                            "$concat": [
-                                "Cycle ",
-                                {"$toString": "$BurninCycleTemperatures.low"},
-                                "°C/",
-                                {"$toString": "$BurninCycleTemperatures.high"},
-                                "°C"
-                            ]
-                        },
-                        "else": "Cycle"
-                    }
-                }
-            }},
-            
-            # Sort by timestamp
-            {"$sort": {"timestamp": 1}}
-        ]
-        
-        burnin_events = list(burnin_cycles_collection.aggregate(burnin_events_pipeline))
-        
-        # Combine and sort all events (MongoDB did most of the work!)
-        all_events = module_test_events + burnin_events
-        
-        # Sort by timestamp - handle both datetime objects and strings
-        def get_timestamp(event):
-            ts = event.get("timestamp")
-            if ts is None:
-                return datetime.datetime.min
-            if isinstance(ts, str):
-                try:
-                    return datetime.datetime.fromisoformat(ts.replace('Z', '+00:00'))
-                except:
-                    return datetime.datetime.min
-            return ts
-        
-        all_events.sort(key=get_timestamp)
-        
-        # Build a time-segmented structure with test type aggregation
-        # First, identify burn-in cycles to use as segment boundaries
-        # Group cycle events by their cycle name (since same cycle applies to all modules)
-        cycle_groups = {}
-        for event in all_events:
-            if event.get("type") == "cycle":
-                cycle_name = event.get("cycle_name")
-                if cycle_name not in cycle_groups:
-                    cycle_groups[cycle_name] = {
-                        "cycle_name": cycle_name,
-                        "event_name": event.get("event_name"),
-                        "timestamp": event.get("timestamp"),
-                        "temperatures": event.get("temperatures"),
-                        "modules": []
-                    }
-                cycle_groups[cycle_name]["modules"].append(event.get("module_name"))
+        # Burn-in events of the session's cycles, from the cycle timeline (see burnin_timeline.py)
+        burnin_events = session_cycle_events(db, session_name)
         
-        # Convert to list and sort by timestamp
-        cycle_events = sorted(cycle_groups.values(), key=lambda x: get_timestamp({"timestamp": x["timestamp"]}))
-        test_events = [e for e in all_events if e.get("type") == "test"]
-        
-        # Create segments: each segment is either a group of tests or a burn-in cycle
-        segments = []
-        
-        if not cycle_events:
-            # No cycles, all tests in one segment
-            if test_events:
-                segments.append({
-                    "type": "test_group",
-                    "events": test_events,
-                    "start_time": get_timestamp(test_events[0]) if test_events else None,
-                    "end_time": get_timestamp(test_events[-1]) if test_events else None
-                })
-        else:
-            # Add test segment before first cycle
-            first_cycle_time = get_timestamp({"timestamp": cycle_events[0]["timestamp"]})
-            tests_before_first_cycle = [e for e in test_events if get_timestamp(e) < first_cycle_time]
-            if tests_before_first_cycle:
-                segments.append({
-                    "type": "test_group",
-                    "events": tests_before_first_cycle,
-                    "start_time": get_timestamp(tests_before_first_cycle[0]),
-                    "end_time": get_timestamp(tests_before_first_cycle[-1])
-                })
-            
-            # Interleave cycles and test groups
-            for i, cycle in enumerate(cycle_events):
-                # Add the cycle itself
-                segments.append({
-                    "type": "cycle",
-                    "cycle_data": cycle,
-                    "timestamp": get_timestamp({"timestamp": cycle["timestamp"]})
-                })
-                
-                # Add tests between this cycle and the next (or end)
-                current_cycle_time = get_timestamp({"timestamp": cycle["timestamp"]})
-                if i < len(cycle_events) - 1:
-                    next_cycle_time = get_timestamp({"timestamp": cycle_events[i + 1]["timestamp"]})
-                    tests_in_segment = [e for e in test_events 
-                                       if current_cycle_time < get_timestamp(e) < next_cycle_time]
-                else:
-                    # Tests after last cycle
-                    tests_in_segment = [e for e in test_events 
-                                       if get_timestamp(e) > current_cycle_time]
-                
-                if tests_in_segment:
-                    segments.append({
-                        "type": "test_group",
-                        "events": tests_in_segment,
-                        "start_time": get_timestamp(tests_in_segment[0]),
-                        "end_time": get_timestamp(tests_in_segment[-1])
-                    })
-        
-        # Now build the column structure
-        # Each segment becomes columns (test types for test_group, single column for cycle)
-        columns = []
-        
-        for seg_idx, segment in enumerate(segments):
-            if segment["type"] == "cycle":
-                # Single column for the cycle (applies to all modules in the cycle)
-                cycle_data = segment["cycle_data"]
-                columns.append({
-                    "type": "cycle",
-                    "column_id": f"seg_{seg_idx}_cycle",
-                    "event_name": cycle_data["event_name"],
-                    "timestamp": segment["timestamp"],
-                    "cycle_name": cycle_data["cycle_name"],
-                    "temperatures": cycle_data["temperatures"],
-                    "modules": cycle_data["modules"]  # List of modules in this cycle
-                })
-            else:  # test_group
-                # Group tests by test_type within this segment
-                test_types_in_segment = {}
-                for event in segment["events"]:
-                    test_type = event.get("test_type", "Unknown")
-                    if test_type not in test_types_in_segment:
-                        test_types_in_segment[test_type] = []
-                    test_types_in_segment[test_type].append(event)
-                
-                # Create a column for each test type in this segment
-                for test_type, type_events in sorted(test_types_in_segment.items()):
-                    columns.append({
-                        "type": "test_group",
-                        "column_id": f"seg_{seg_idx}_{test_type}",
-                        "test_type": test_type,
-                        "event_name": test_type,
-                        "start_time": segment["start_time"],
-                        "end_time": segment["end_time"],
-                        "test_events": type_events  # All events of this type in this segment
-                    })
-        
-        # Build the flow matrix with the new column structure
-        module_flows = {module: [] for module in modules_list}
-        
-        for event in all_events:
-            module_name = event.get("module_name")
-            if module_name in module_flows:
-                module_flows[module_name].append(event)
-        
-        flow_matrix = []
-        for module in modules_list:
-            row = {"module_name": module, "columns": {}}
-            
-            for col_idx, column in enumerate(columns):
-                col_key = f"col_{col_idx}"
-                
-                if column["type"] == "cycle":
-                    # Check if this module participated in this cycle
-                    if module in column["modules"]:
-                        row["columns"][col_key] = {
-                            "present": True,
-                            "type": "cycle",
-                            "event_name": column["event_name"],
-                            "cycle_name": column["cycle_name"],
-                            "temperatures": column["temperatures"]
-                        }
-                    else:
-                        row["columns"][col_key] = {"present": False}
-                        
-                else:  # test_group
-                    # Find all tests of this type for this module in this segment
-                    test_type = column["test_type"]
-                    module_tests_in_column = [
-                        e for e in column["test_events"]
-                        if e.get("module_name") == module
-                    ]
-                    
-                    if module_tests_in_column:
-                        # Count tests by status
-                        passed = sum(1 for t in module_tests_in_column if t.get("run_status") == "done")
-                        failed = sum(1 for t in module_tests_in_column if t.get("run_status") != "done")
-                        
-                        row["columns"][col_key] = {
-                            "present": True,
-                            "type": "test_group",
-                            "test_type": test_type,
-                            "count": len(module_tests_in_column),
-                            "passed": passed,
-                            "failed": failed,
-                            "tests": module_tests_in_column  # List of all tests
-                        }
-                    else:
-                        row["columns"][col_key] = {"present": False}
-            
-            flow_matrix.append(row)
+        # Segment the events into columns and build the flow matrix (see testing_flow.py)
+        columns, flow_matrix = build_testing_flow(modules_list, module_test_events, burnin_events)
         
         response = {
             "session_name": session_name,
@@ -1196,6 +851,7 @@ def fetch_session_testing_flow(session_name):
 
 
 @bp.route("/fetch_sessions_for_testing_flow", methods=["GET"])
+@cached_response(get_db, ["sessions", "test_runs"])
 def fetch_sessions_for_testing_flow():
     """
     Fetch all sessions annotated with metadata useful for the testing flow page:
@@ -1321,10 +977,6 @@ def fetch_sessions_for_testing_flow():
 
         sessions = list(sessions_collection.aggregate(pipeline))
 
-        # Convert ObjectId to string for JSON serialization
-        for s in sessions:
-            s["_id"] = str(s["_id"])
-
         return jsonify(sessions), 200
 
     except Exception as e:
@@ -7,6 +7,8 @@ from jsonschema import validate, ValidationError
 from flask import request, jsonify, Blueprint
 from bson import ObjectId
 from utils import get_db
+from module_summaries import refresh_module_summaries
+from response_cache import bump_generations
 
 bp = Blueprint("add_analysis", __name__)
 
@@ -24,17 +26,15 @@ def addAnalysis():
     module_test_analysis = module_test_analysis_collection.find_one({"moduleTestAnalysisName": moduleTestAnalysisName})
     # get the module_testName from the module_test_analysis entry
     module_testName = module_test_analysis["moduleTestName"]
-    # get the module_test entry from the collection
-    module_test = module_tests_collection.find_one({"moduleTestName": module_testName})
-    # add the analysis to the list of analyses of the module_test
-    # if the list of analyses doesn't exist, create it
-    if "analysesList" not in module_test:
-        module_test["analysesList"] = []
-    module_test["analysesList"].append(moduleTestAnalysisName)
-    # set the reference_analysis of the module_test to the analysis
-    module_test["referenceAnalysis"] = moduleTestAnalysisName
-    # drop the _id from module_test so that it can be inserted in the collection
-    module_test.pop("_id")
-    # update the module_test entry in the collection
-    module_tests_collection.update_one({"moduleTestName": module_testName}, {"$set": module_test})
+    # add the analysis to the list of analyses of the module_test (created if it doesn't exist)
+    # and set the reference_analysis of the module_test to the analysis
+    # only these two fields are written, the references of the module test are left as they are
+    module_test = module_tests_collection.find_one_and_update(
+        {"moduleTestName": module_testName},
+        {"$push": {"analysesList": moduleTestAnalysisName}, "$set": {"referenceAnalysis": moduleTestAnalysisName}},
+        projection={"moduleName": 1},
+    )
+    # the latest analysis is part of the module summary
+    refresh_module_summaries(get_db(), [module_test["moduleName"]])
+    bump_generations(get_db(), "module_tests")
     return {"message": f"Analysis {moduleTestAnalysisName} added to module test {module_testName}"}, 200
\ No newline at end of file
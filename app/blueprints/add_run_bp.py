@@ -6,169 +6,282 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from jsonschema import validate, ValidationError
 from flask import request, jsonify, Blueprint
 from bson import ObjectId
-from utils import get_db, cable_templates_schema, cables_schema
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+from utils import get_db, cable_templates_schema, cables_schema, run_in_transaction
+from module_summaries import refresh_module_summaries, invalidate_module_summaries
+from response_cache import bump_generations
+from counters import next_name, parse_name, advance_counter
+from references import as_object_id
 
 bp = Blueprint("add_run", __name__)
 
-def process_run(run_key, data, testRuns_collection, modules_collection, moduleTests_collection, sessions_collection):
-     # Process test run data
-        run_entry = {
-            # run date includes seconds
-            "runDate": datetime.datetime.strptime(data["runDate"], "%Y-%m-%dT%H:%M:%S"),
-            "test_runName": run_key,
-            "runSession": data["runSession"],
-            "runStatus": data["runStatus"],
-            "runType": data["runType"],
-            "runBoards": data["runBoards"],
-            "_moduleTest_id": [],
-            "moduleTestName": [],
-            "runFile": data["runFile"],
-            "runConfiguration": data["runConfiguration"],
-        }
-        # get the ObjectId of the session
-        session = sessions_collection.find_one({"sessionName": data["runSession"]})
-        # return error if session does not exist
-        if not session:
+def _remove_run0_references(old_run0, modules_collection, moduleTests_collection, sessions_collection, session=None):
+    """Removes the references to the old run0 from the sessions, module_tests and modules collections."""
+    # remove the old run0 from the session document
+    sessions_collection.update_one(
+        {"sessionName": old_run0["runSession"]},
+        # the references written before the ObjectId migration were strings
+        {"$pull": {"test_runName": "run0", "_test_run_id": {"$in": [old_run0["_id"], str(old_run0["_id"])]}}},
+        session=session,
+    )
+    # remove the old run0 module tests
+    moduleTests_collection.delete_many(
+        {"_id": {"$in": [as_object_id(module_test_id) for module_test_id in old_run0["_moduleTest_id"]]}},
+        session=session,
+    )
+    # remove the references to the module tests from the modules collection
+    # the module name is extracted from moduleTestName = module_key + "__" + run_key
+    pulls = {}
+    for moduleTest, moduleTestId in zip(old_run0["moduleTestName"], old_run0["_moduleTest_id"]):
+        names, ids = pulls.setdefault(moduleTest.split("__")[0], ([], []))
+        names.append(moduleTest)
+        ids.extend([as_object_id(moduleTestId), str(moduleTestId)])
+    if pulls:
+        modules_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"moduleName": module_name},
+                    {"$pull": {"moduleTestName": {"$in": names}, "_moduleTest_id": {"$in": ids}}},
+                )
+                for module_name, (names, ids) in pulls.items()
+            ],
+            ordered=False,
+            session=session,
+        )
+
+
+def process_run(run_key, data, testRuns_collection, modules_collection, moduleTests_collection, sessions_collection, old_run0=None):
+    """
+    Ingests a test run and its module tests as one batch.
+
+    All the lookups (session, modules, existing module tests) are done up front with
+    a single query each, so that a bad request is rejected before anything is written.
+    The writes are then done with one bulk operation per collection inside a
+    multi-document transaction. If old_run0 is given, its references are removed in
+    the same transaction.
+    """
+    # Process test run data
+    run_entry = {
+        # run date includes seconds
+        "runDate": datetime.datetime.strptime(data["runDate"], "%Y-%m-%dT%H:%M:%S"),
+        "test_runName": run_key,
+        "runSession": data["runSession"],
+        "runStatus": data["runStatus"],
+        "runType": data["runType"],
+        "runBoards": data["runBoards"],
+        "_moduleTest_id": [],
+        "moduleTestName": [],
+        "runFile": data["runFile"],
+        "runConfiguration": data["runConfiguration"],
+    }
+    # get the ObjectId of the session
+    session_doc = sessions_collection.find_one({"sessionName": data["runSession"]}, {"_id": 1})
+    # return error if session does not exist
+    if not session_doc:
+        return (
+            jsonify(
+                {
+                    "message": "Session does not exist. Please try again.",
+                    "sessionName": data["runSession"],
+                }
+            ),
+            400,
+        )
+    # add the session ObjectId as str to the run entry (as in the testRun schema)
+    run_entry["_runSession_id"] = str(session_doc["_id"])
+
+    # Collect the module tests of the run
+    skipped_modules_count = 0
+    module_tests = []
+    for board_and_optical_group, (module_key, hw_id) in data["runModules"].items():
+        if module_key == -1:
+            skipped_modules_count += 1
+            continue
+        # cast hw_id to str
+        hw_id = str(hw_id)
+        # split board_and_optical_group into board and optical_group
+        # format is board_optical0 and i want to store board and 0, without the optical
+        board, optical_group = board_and_optical_group.split("_optical")
+        module_tests.append(
+            {
+                # create the module testName as (module_name)__(test_runName)
+                "moduleTestName": module_key + "__" + run_key,
+                "test_runName": run_key,
+                "moduleName": module_key,
+                "noise": data["runNoise"].get(hw_id, {}),
+                "board": board,
+                "opticalGroupName": int(optical_group),
+            }
+        )
+
+    # get the ObjectIds of all the modules with a single query
+    module_names = [entry["moduleName"] for entry in module_tests]
+    module_ids = {
+        doc["moduleName"]: doc["_id"]
+        for doc in modules_collection.find({"moduleName": {"$in": module_names}}, {"moduleName": 1})
+    }
+    for module_name in module_names:
+        if module_name not in module_ids:
+            return (
+                jsonify(
+                    {
+                        "message": "Module does not exist. Please try again.",
+                        "moduleName": module_name,
+                    }
+                ),
+                400,
+            )
+
+    # the same module twice in the payload would give two module tests with the same name
+    seen_tests = set()
+    for entry in module_tests:
+        if entry["moduleTestName"] in seen_tests:
             return (
                 jsonify(
                     {
-                        "message": "Session does not exist. Please try again.",
-                        "sessionName": data["runSession"],
+                        "message": "Module test Name repeated in the run. Please try again.",
+                        "moduleTestName": entry["moduleTestName"],
                     }
                 ),
                 400,
             )
-        session_id = session["_id"]
-        # add the session ObjectId as str to the run entryrunSession_id
-        run_entry["_runSession_id"] = str(session_id)
-        if run_key != "run0":
-            run_id = testRuns_collection.insert_one(run_entry).inserted_id
+        seen_tests.add(entry["moduleTestName"])
+
+    # check all the module testNames at once
+    # the module tests of the old run0 are going to be deleted, so they do not count
+    replaced_ids = set(str(i) for i in old_run0["_moduleTest_id"]) if old_run0 else set()
+    existing_tests = {
+        doc["moduleTestName"]: doc["_id"]
+        for doc in moduleTests_collection.find(
+            {"moduleTestName": {"$in": [entry["moduleTestName"] for entry in module_tests]}},
+            {"moduleTestName": 1},
+        )
+        if str(doc["_id"]) not in replaced_ids
+    }
+    for entry in module_tests:
+        # if it exists, return an error, unless it is a run0 that gets replaced
+        if entry["moduleTestName"] in existing_tests and not entry["moduleTestName"].endswith("run0"):
+            return (
+                jsonify(
+                    {
+                        "message": "Module test Name already exists. Please try again.",
+                        "moduleTestName": entry["moduleTestName"],
+                    }
+                ),
+                400,
+            )
+
+    # the ObjectIds are generated here, so that the run entry is written once with all its references
+    # we are adding a run0 which already exists, so we keep its ObjectId and update it
+    run_id = old_run0["_id"] if old_run0 else ObjectId()
+    test_writes = []
+    inserted_test_ids = []
+    for entry in module_tests:
+        entry["_test_run_id"] = run_id
+        entry["_module_id"] = module_ids[entry["moduleName"]]
+        if entry["moduleTestName"] in existing_tests:
+            print(f"Module test {entry['moduleTestName']} already exists, updating the entry")
+            test_id = existing_tests[entry["moduleTestName"]]
+            test_writes.append(UpdateOne({"_id": test_id}, {"$set": entry}))
         else:
-            # we are adding a run0, so we do not delete it
-            # we simply update the run0 entry if it exists
-            if testRuns_collection.count_documents({"test_runName": "run0"}) != 0:
-                run_id = testRuns_collection.find_one_and_update(
-                    {"test_runName": "run0"},
-                    {"$set": run_entry},
-                    upsert=True,
-                    return_document=True,
-                )["_id"]
-            else:
-                # if it does not exist, we create it
-                run_id = testRuns_collection.insert_one(run_entry).inserted_id
+            test_id = ObjectId()
+            inserted_test_ids.append(test_id)
+            test_writes.append(InsertOne(dict(entry, _id=test_id)))
+        run_entry["moduleTestName"].append(entry["moduleTestName"])
+        run_entry["_moduleTest_id"].append(test_id)
 
+    def write_run(session):
+        if old_run0:
+            _remove_run0_references(old_run0, modules_collection, moduleTests_collection, sessions_collection, session)
+            testRuns_collection.update_one({"_id": run_id}, {"$set": run_entry}, session=session)
+        else:
+            testRuns_collection.insert_one(dict(run_entry, _id=run_id), session=session)
         # update the session entry by appending to the test_runName list
         # and to _test_run_id the ObjectId of the test run
         sessions_collection.update_one(
             {"sessionName": data["runSession"]},
-            {"$push": {"test_runName": run_key, "_test_run_id": str(run_id)}},
+            {"$push": {"test_runName": run_key, "_test_run_id": run_id}},
+            session=session,
         )
-
-        # Process each module test
-        skipped_modules_count = 0
-        for board_and_optical_group, (module_key, hw_id) in data["runModules"].items():
-            if module_key == -1:
-                # print("a moduleID is -1, skipping")
-                skipped_modules_count += 1
-                continue
-            else:
-                # cast hw_id to str
-                hw_id = str(hw_id)
-                # split board_and_optical_group into board and optical_group
-                # format is board_optical0 and i want to store board and 0, without the optical
-                board, optical_group = board_and_optical_group.split("_optical")
-                optical_group = int(optical_group)
-                # Update or find the module to get its ObjectId
-                # module_doc = modules_collection.find_one_and_update(
-                #     {"moduleName": module_key},
-                #     {"$set": {"hardwareName": hw_id}},
-                #     upsert=True,
-                #     return_document=True,
-                # )
-                module_doc = modules_collection.find_one({"moduleName": module_key})
-
-                # module_tests_names_list = module_doc.get("moduleTestName", [])
-                # print(f"module_tests_names_list: {module_tests_names_list}")
-                # module_tests_ids_list = module_doc.get("_moduleTest_id", [])
-                # print(f"module_tests_ids_list: {module_tests_ids_list}")
-                # create the module testName as
-                # (module_name)__(test_runName)
-                moduleTestName = module_key + "__" + run_key
-                # create the module test entry
-                module_test_entry = {
-                    "moduleTestName": moduleTestName,
-                    "_test_run_id": run_id,
-                    "test_runName": run_key,
-                    "_module_id": module_doc["_id"],
-                    "moduleName": module_key,
-                    "noise": data["runNoise"].get(hw_id,{}),
-                    "board": board,
-                    "opticalGroupName": optical_group,
-                }
-                # check if the module testName already exists
-                # if it does, return an error
-                if (moduleTests_collection.count_documents({"moduleTestName": moduleTestName}) != 0) & (not moduleTestName.endswith("run0")):
-                    return (
-                        jsonify(
-                            {
-                                "message": "Module test Name already exists. Please try again.",
-                                "moduleTestName": moduleTestName,
-                            }
-                        ),
-                        400,
+        if test_writes:
+            moduleTests_collection.bulk_write(test_writes, ordered=False, session=session)
+            # update the module entries by appending to the moduleTestName list
+            # module test Name and to _moduleTest_id the ObjectId of the module test
+            modules_collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"moduleName": entry["moduleName"]},
+                        {"$addToSet": {"moduleTestName": name, "_moduleTest_id": test_id}},
                     )
-                elif (moduleTests_collection.count_documents({"moduleTestName": moduleTestName}) != 0) & (moduleTestName.endswith("run0")):
-                    # replace the entry with the new one
-                    print(f"Module test {moduleTestName} already exists, updating the entry")
-                    try:
-                        moduleTests_collection.update_one(
-                            {"moduleTestName": moduleTestName}, {"$set": module_test_entry}
-                        )
-                    except Exception as e:
-                        return (
-                            jsonify(
-                                {
-                                    "message": f"Error updating module test {moduleTestName}: {str(e)}",
-                                }
-                            ),
-                            500,
-                        )
-                    # get the ObjectId of the module test
-                    test_id = moduleTests_collection.find_one({"moduleTestName": moduleTestName})["_id"]
-                else:
-                    test_id = moduleTests_collection.insert_one(module_test_entry).inserted_id
-                    
-                run_entry["moduleTestName"].append(moduleTestName)
-                run_entry["_moduleTest_id"].append(str(test_id))
-
-                # update the module entry by appending to the moduleTestName list
-                # module test Name and to _moduleTest_id the ObjectId of the module test
-                # if moduleTestName not in module_tests_names_list:
-                #     module_tests_names_list.append(moduleTestName)
-                # if str(test_id) not in module_tests_ids_list:
-                #     module_tests_ids_list.append(str(test_id))
-                # print(f"Adding module test {moduleTestName} with id {test_id} to module {module_key}")
-                modules_collection.update_one(
-                    {"moduleName": module_key},
-                    {"$addToSet": {"moduleTestName": moduleTestName, "_moduleTest_id": str(test_id)}},
+                    for entry, name, test_id in zip(module_tests, run_entry["moduleTestName"], run_entry["_moduleTest_id"])
+                ],
+                ordered=False,
+                session=session,
+            )
+
+    def ingest(session):
+        if session is not None:
+            return write_run(session)
+        # standalone server, no transaction: undo what can be undone if one of the writes fails
+        try:
+            write_run(None)
+        except PyMongoError:
+            if inserted_test_ids:
+                inserted_names = [name for name in run_entry["moduleTestName"] if name not in existing_tests]
+                moduleTests_collection.delete_many({"_id": {"$in": inserted_test_ids}})
+                modules_collection.update_many(
+                    {"moduleName": {"$in": module_names}},
+                    {
+                        "$pull": {
+                            "moduleTestName": {"$in": inserted_names},
+                            "_moduleTest_id": {"$in": inserted_test_ids},
+                        }
+                    },
+                )
+            if not old_run0:
+                testRuns_collection.delete_one({"_id": run_id})
+                sessions_collection.update_one(
+                    {"sessionName": data["runSession"]},
+                    {"$pull": {"test_runName": run_key, "_test_run_id": run_id}},
                 )
+            raise
 
-        # Update the test run with module test mongo ObjectIds and names
-        testRuns_collection.update_one(
-            {"_id": run_id}, {"$set": {"moduleTestName": run_entry["moduleTestName"], "_moduleTest_id": run_entry["_moduleTest_id"]}}
-        )
+    try:
+        run_in_transaction(testRuns_collection.database, ingest)
+    except PyMongoError as e:
         return (
             jsonify(
                 {
-                    "message": "Test run and module tests added successfully",
-                    "test_runName": run_key,
-                    "run_id": str(run_id),
-                    "skipped_modules_count": skipped_modules_count,
+                    "message": f"Error adding test run {run_key}: {str(e)}",
                 }
             ),
-            201,
+            500,
         )
 
+    # keep the module summaries in sync: the modules of the run are recomputed, while the other
+    # modules of the session only embed the session document, so they are just invalidated
+    db = testRuns_collection.database
+    touched_modules = module_names + ([name.split("__")[0] for name in old_run0["moduleTestName"]] if old_run0 else [])
+    touched_sessions = [data["runSession"]] + ([old_run0["runSession"]] if old_run0 else [])
+    invalidate_module_summaries(
+        db, {"tests.run.runSession": {"$in": touched_sessions}, "moduleName": {"$nin": touched_modules}}
+    )
+    refresh_module_summaries(db, touched_modules)
+    bump_generations(db, "test_runs", "module_tests", "modules", "sessions")
+
+    return (
+        jsonify(
+            {
+                "message": "Test run and module tests added successfully",
+                "test_runName": run_key,
+                "run_id": str(run_id),
+                "skipped_modules_count": skipped_modules_count,
+            }
+        ),
+        201,
+    )
+
 
 @bp.route("/addRun", methods=["POST"])
 def add_run():
@@ -180,11 +293,11 @@ def add_run():
     data = request.get_json()
 
     # generate the test_runName
-    # check if the runNumber is in the data
+    # without a runNumber, the run gets the next one of the runs counter
     if "runNumber" not in data:
-        return jsonify({"message": "runNumber is missing"}), 400
+        data["runNumber"] = next_name(get_db(), "run")
     # check that the "runNumber" follows the format "run" + number
-    if not data["runNumber"].startswith("run"):
+    if not isinstance(data["runNumber"], str) or not data["runNumber"].startswith("run"):
         return jsonify({"message": "runNumber should start with 'run'"}), 400
     # check that the "runNumber" follows the format "run" + number
     if not data["runNumber"][3:].isdigit():
@@ -204,41 +317,12 @@ def add_run():
         )
 
     if run_key != "run0":
+        # the numbers chosen by the test stations are never handed out by the counter
+        number = parse_name("run", run_key)
+        if number is not None:
+            advance_counter(get_db(), "run", number)
         return process_run(run_key, data, testRuns_collection, modules_collection, moduleTests_collection, sessions_collection)
-    else:
-        # we are adding a run0
-        # it is our test run, so if it exists, we delete it
-        if testRuns_collection.count_documents({"test_runName": "run0"}) != 0:
-            # get the old run0 doc
-            old_run0 = testRuns_collection.find_one({"test_runName": "run0"})
-            # testRuns_collection.delete_one({"test_runName": "run0"})
-
-            # before running the process_run, we need to remove the references to the old run0 in the modules, sessions and module_tests collections
-            # remove the old run0 from the session document
-            sessions_collection.update_one(
-                {"sessionName": old_run0["runSession"]},
-                {"$pull": {"test_runName": "run0", "_test_run_id": str(old_run0["_id"])}},
-            )
-            
-            # # remove the old run0 from the module_test documents
-            for module_test_id, module_test_name in zip(old_run0["_moduleTest_id"], old_run0["moduleTestName"]):
-                moduleTests_collection.delete_one({"_id": ObjectId(module_test_id)})
-                # print(f"Deleted module test with id {module_test_id} from module_tests collection (name was {module_test_name})")
-                
-            # remove the reference to the modules test from the modules collection
-            # extract the module_id from moduleTestName = module_key + "__" + run_key
-
-            for module_id in old_run0["moduleTestName"]:
-                module_name = module_id.split("__")[0]
-                for moduleTest, moduleTestId in zip(old_run0["moduleTestName"], old_run0["_moduleTest_id"]):
-                    if moduleTest.startswith(module_name):
-                        # first check if the moduleTest is in the moduleTestName list field of the module
-                        if moduleTest in modules_collection.find_one({"moduleName": module_name})["moduleTestName"]:
-                            # remove the moduleTest from the module
-                            # print(f"Removing moduleTest {moduleTest} from module {module_name}")
-                            modules_collection.update_one(
-                                {"moduleName": module_name},
-                                {"$pull": {"moduleTestName": moduleTest, "_moduleTest_id": str(moduleTestId)}},
-                                )
-       
-        return process_run(run_key, data, testRuns_collection, modules_collection, moduleTests_collection, sessions_collection)
\ No newline at end of file
+    # we are adding a run0
+    # it is our test run, so if it exists, its references are replaced in the same transaction
+    old_run0 = testRuns_collection.find_one({"test_runName": "run0"})
+    return process_run(run_key, data, testRuns_collection, modules_collection, moduleTests_collection, sessions_collection, old_run0=old_run0)
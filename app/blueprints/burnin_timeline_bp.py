@@ -0,0 +1,47 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from flask import request, jsonify, Blueprint
+from utils import get_db
+from burnin_timeline import TimelineQueryError, module_cycles, modules_at, parse_time_arg
+
+bp = Blueprint("burnin_timeline", __name__)
+
+
+@bp.route("/burnin_timeline/modules/<module_name>", methods=["GET"])
+def burnin_timeline_module(module_name):
+    """
+    The burn-in cycles a module went through, from the burnin_timeline entries. See burnin_timeline.py.
+
+    Query parameters:
+    - from, to: ISO 8601 dates, the cycles overlapping this range (optional)
+
+    Returns:
+    - {"moduleName": ..., "cycles": [entries in time order]}
+    """
+    try:
+        start = parse_time_arg(request.args, "from")
+        end = parse_time_arg(request.args, "to")
+    except TimelineQueryError as e:
+        return jsonify({"error": str(e)}), 400
+    cycles = module_cycles(get_db(), module_name, start, end)
+    return jsonify({"moduleName": module_name, "cycles": cycles}), 200
+
+
+@bp.route("/burnin_timeline/chamber", methods=["GET"])
+def burnin_timeline_chamber():
+    """
+    The modules in the burn-in chamber at a given time, with the cycle they were in.
+
+    Query parameters:
+    - at: ISO 8601 date (required)
+
+    Returns:
+    - {"at": ..., "modules": [entries by moduleName]}
+    """
+    try:
+        time = parse_time_arg(request.args, "at", required=True)
+    except TimelineQueryError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"at": time, "modules": modules_at(get_db(), time)}), 200
@@ -6,6 +6,7 @@ from jsonschema import validate, ValidationError
 from flask import request, jsonify, Blueprint
 from bson import ObjectId
 from utils import get_db, cable_templates_schema, cables_schema
+from cabling_graph import get_cabling_graph, CablingError
 
 bp = Blueprint("cables_bp", __name__)
 
@@ -39,11 +40,7 @@ def connect_cables():
     - If the cables or cable templates are not found, returns a JSON response with an "error" field indicating the missing cables or templates (status code 404).
     - If the provided ports are invalid or the lines are already connected, returns a JSON response with an "error" field indicating the issue (status code 400).
     """
-    # Function code goes here
     data = request.get_json()
-    cables_collection = get_db()["cables"]
-    modules_collection = get_db()["modules"]
-    templates_collection = get_db()["cable_templates"]
 
     # check that data includes the necessary fields
     if "cable1" not in data or "cable2" not in data:
@@ -51,100 +48,12 @@ def connect_cables():
     if "port1" not in data or "port2" not in data:
         return jsonify({"error": "Both cables must have ports!"}), 400
 
-    cable1_name = data["cable1"]
-    cable2_name = data["cable2"]
-    port1 = data["port1"]
-    port2 = data["port2"]
-
-    module_in_detSide = False
-
-    # Retrieve the cables from the database
-    cable1 = cables_collection.find_one({"name": cable1_name})
-    # excpet for the case of not found, in which case we will try to find it in modules
-    if not cable1:
-        cable1 = modules_collection.find_one({"moduleName": cable1_name})
-        module_in_detSide = True
-        # if cable 1 is module but it does not have a 'type' field, set it to 'module'
-        if cable1:
-            if "type" not in cable1:
-                cable1["type"] = "module"
-            template1 = templates_collection.find_one({"type": cable1["type"]})
-            # if the cable is a module, it may not have been initialized with a crateSide
-            if "crateSide" not in cable1:
-                cable1["crateSide"] = {
-                    str(i): [] for i in range(1, template1["lines"] + 1)
-                }
-
-    cable2 = cables_collection.find_one({"name": cable2_name})
-    if not cable2:
-        cable2 = modules_collection.find_one({"moduleName": cable2_name})
-        if cable2:
-            raise Exception("Module should always be passed in detSide")
-
-    if cable1 and cable2:
-        # Retrieve the cable templates from the database
-        template1 = templates_collection.find_one({"type": cable1["type"]})
-        template2 = templates_collection.find_one({"type": cable2["type"]})
-
-        if template1 and template2:
-            # check that port1 and port2 are valid
-            if port1 not in template1["crateSide"] or port2 not in template2["detSide"]:
-                return jsonify({"error": "Invalid port"}), 400
-
-            # Get the lines for the specified ports
-            lines1 = template1["crateSide"][port1]
-            lines2 = template2["detSide"][port2]
-
-            # first check that the lines are free
-            for line1 in lines1:
-                if line1 != -1:
-                    line1 = str(line1)
-                    if cable1["crateSide"][line1] != []:
-                        return (
-                            jsonify(
-                                {
-                                    "error": f"Cable {cable1_name} line {line1} is already connected to {cable1['crateSide'][line1][0]}"
-                                }
-                            ),
-                            400,
-                        )
-
-            for line2 in lines2:
-                if line2 != -1:
-                    line2 = str(line2)
-                    if cable2["detSide"][line2] != []:
-                        return (
-                            jsonify(
-                                {
-                                    "error": f"Cable {cable2_name} line {line2} is already connected to {cable2['detSide'][line2][0]}"
-                                }
-                            ),
-                            400,
-                        )
-
-            # Update the cable connections
-            for line1, line2 in zip(lines1, lines2):
-                if line1 != -1 and line2 != -1:
-                    line1 = str(line1)
-                    line2 = str(line2)
-                    cable1["crateSide"][line1] = [cable2_name, int(line2)]
-                    cable2["detSide"][line2] = [cable1_name, int(line1)]
-
-            # Update the cables in the database
-            if module_in_detSide:
-                modules_collection.update_one(
-                    {"moduleName": cable1_name}, {"$set": cable1}
-                )
-            else:
-                cables_collection.update_one({"name": cable1_name}, {"$set": cable1})
-
-            cables_collection.update_one({"name": cable2_name}, {"$set": cable2})
-
-            return jsonify({"message": "Cables connected successfully"}), 200
-        else:
-            return jsonify({"error": "Invalid cable templates"}), 400
-    else:
-        return jsonify({"error": "Cables not found"}), 404
+    db = get_db()
+    try:
+        get_cabling_graph(db).connect(db, data["cable1"], data["port1"], data["cable2"], data["port2"])
+    except CablingError as e:
+        return jsonify({"error": e.message}), e.status
+    return jsonify({"message": "Cables connected successfully"}), 200
 
 
 @bp.route("/disconnect", methods=["POST"])
@@ -165,108 +74,13 @@ def disconnect_cables():
     """
 
     data = request.get_json()
-    cables_collection = get_db()["cables"]
-    modules_collection = get_db()["modules"]
-    templates_collection = get_db()["cable_templates"]
 
     # check that data includes the necessary fields
     if "cable1" not in data or "cable2" not in data:
         return jsonify({"error": "Both cables must be specified"}), 400
 
-    cable1_name = data["cable1"]
-    cable2_name = data["cable2"]
-
-    module_in_detSide = False
-    # Retrieve the cables from the database
-    cable1 = cables_collection.find_one({"name": cable1_name})
-    if not cable1:
-        cable1 = modules_collection.find_one({"moduleName": cable1_name})
-        module_in_detSide = True
-        if cable1:
-            if "type" not in cable1:
-                cable1["type"] = "module"
-            template1 = templates_collection.find_one({"type": cable1["type"]})
-            if "crateSide" not in cable1:
-                cable1["crateSide"] = {
-                    str(i): [] for i in range(1, template1["lines"] + 1)
-                }
-
-    cable2 = cables_collection.find_one({"name": cable2_name})
-    if not cable2:
-        cable2 = modules_collection.find_one({"moduleName": cable2_name})
-        if cable2:
-            raise Exception("Module should always be passed in detSide")
-
-    if not cable1 or not cable2:
-        return jsonify({"error": "Cables not found"}), 404
-
-    # check if data includes ports
-    if "port1" in data and "port2" in data:
-        port1 = data["port1"]
-        port2 = data["port2"]
-        # Retrieve the cable templates from the database
-        template1 = templates_collection.find_one({"type": cable1["type"]})
-        template2 = templates_collection.find_one({"type": cable2["type"]})
-
-        if template1 and template2:
-            # check that port1 and port2 are valid
-            if port1 not in template1["crateSide"] or port2 not in template2["detSide"]:
-                return jsonify({"error": "Invalid port"}), 400
-
-            # Get the lines for the specified ports
-            lines1 = template1["crateSide"][port1]
-            lines2 = template2["detSide"][port2]
-
-            # Update the cable connections
-            for line1, line2 in zip(lines1, lines2):
-                if line1 != -1 and line2 != -1:
-                    line1 = str(line1)
-                    line2 = str(line2)
-                    if cable1["crateSide"][line1] == [cable2_name, int(line2)]:
-                        cable1["crateSide"][line1] = []
-                        cable2["detSide"][line2] = []
-                    else:
-                        return (
-                            jsonify(
-                                {
-                                    "error": "Cables are not connected, so I cannot disconnect them"
-                                }
-                            ),
-                            400,
-                        )
-
-            # Update the cables in the database
-            if module_in_detSide:
-                modules_collection.update_one(
-                    {"moduleName": cable1_name}, {"$set": cable1}
-                )
-            else:
-                cables_collection.update_one({"name": cable1_name}, {"$set": cable1})
-            cables_collection.update_one({"name": cable2_name}, {"$set": cable2})
-
-            return jsonify({"message": "Cables disconnected successfully"}), 200
-        else:
-            return jsonify({"error": "Invalid cable templates"}), 400
-
-    elif "port1" not in data and "port2" not in data:
-        if cable1 and cable2:
-            # Disconnect the cables
-            for line, connection in cable1["crateSide"].items():
-                if len(connection)> 0 and connection[0] == cable2_name:
-                    cable1["crateSide"][str(line)] = []
-                    cable2["detSide"][str(connection[1])] = []
-
-        # Update the cables in the database
-        if module_in_detSide:
-            modules_collection.update_one({"moduleName": cable1_name}, {"$set": cable1})
-        else:
-            cables_collection.update_one({"name": cable1_name}, {"$set": cable1})
-        cables_collection.update_one({"name": cable2_name}, {"$set": cable2})
-
-        return jsonify({"message": "Cables disconnected successfully"}), 200
-
     # if we get a port for one cable and not the other return an error
-    else:
+    if ("port1" in data) != ("port2" in data):
         return (
             jsonify(
                 {"error": "Both cables must have ports, or no ports should be passed!"}
@@ -274,6 +88,66 @@ def disconnect_cables():
             400,
         )
 
+    db = get_db()
+    try:
+        get_cabling_graph(db).disconnect(
+            db, data["cable1"], data["cable2"], data.get("port1"), data.get("port2")
+        )
+    except CablingError as e:
+        return jsonify({"error": e.message}), e.status
+    return jsonify({"message": "Cables disconnected successfully"}), 200
+
+# upper bound of the operations of a bulk request
+MAX_BULK_OPERATIONS = 5000
+
+
+@bp.route("/connect_bulk", methods=["POST"])
+def connect_cables_bulk():
+    """
+    Connects many pairs of cables at once, e.g. to recable a ring after an intervention.
+
+    This route expects a JSON payload with the following fields:
+    - "operations": list of {"cable1", "port1", "cable2", "port2"} (or [cable1, port1, cable2, port2]),
+      applied in order, each one checked against the lines left by the ones before.
+    - "atomic" (optional, default true): if any operation fails nothing is written, otherwise
+      the failed operations are skipped and the others written.
+
+    All the changed cables and modules are written at once, in a transaction.
+
+    Returns:
+    - {"written": bool, "results": [{"index", "status", "error" (on failure)}]}, one result per operation,
+      with status code 200, or 400 if an atomic request was not written because an operation failed.
+    """
+    return _apply_bulk("connect")
+
+
+@bp.route("/disconnect_bulk", methods=["POST"])
+def disconnect_cables_bulk():
+    """As /connect_bulk, disconnecting the pairs of cables (the ports are optional, as in /disconnect)."""
+    return _apply_bulk("disconnect")
+
+
+def _apply_bulk(action):
+    data = request.get_json()
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations must be a non-empty list"}), 400
+    if len(operations) > MAX_BULK_OPERATIONS:
+        return jsonify({"error": f"At most {MAX_BULK_OPERATIONS} operations per request"}), 400
+    # [cable1, port1, cable2, port2] as a shorthand
+    operations = [
+        dict(zip(("cable1", "port1", "cable2", "port2"), operation)) if isinstance(operation, list) else operation
+        for operation in operations
+    ]
+    atomic = data.get("atomic", True)
+    if not isinstance(atomic, bool):
+        return jsonify({"error": "atomic must be true or false"}), 400
+
+    db = get_db()
+    results, written = get_cabling_graph(db).apply_bulk(db, action, operations, atomic=atomic)
+    failed = any("error" in result for result in results)
+    return jsonify({"written": written, "results": results}), 400 if atomic and failed else 200
+
 @bp.route("/disconnect_all", methods=["POST"])
 def disconnect_all_ports():
     return _disconnect_all("all")
@@ -290,84 +164,78 @@ def _disconnect_all(side_to_disconnect):
     """ 
     this function disconnects all the ports of a given cable or module
     also deleting its connections in the other cables/modules.
-    It can disconnect all, just crateSide or just detSide
+    It can disconnect all, just crateSide or just detSide.
+    All the touched documents are written with a single bulk_write per collection.
     """
     data = request.get_json()
-    cables_collection = get_db()["cables"]
-    modules_collection = get_db()["modules"]
-    templates_collection = get_db()["cable_templates"]
-    
+
     if "cable" not in data:
         return jsonify({"error": "Cable must be specified"}), 400
-    
-    cable_name = data["cable"]
-    # retrive the cable from the database
-    cable = cables_collection.find_one({"name": cable_name})
-    is_module = False
-    if not cable:
-        cable = modules_collection.find_one({"moduleName": cable_name})
-        if cable:
-            is_module = True
-            if "type" not in cable:
-                cable["type"] = "module"
-            template = templates_collection.find_one({"type": cable["type"]})
-            if "crateSide" not in cable:
-                cable["crateSide"] = {
-                    str(i): [] for i in range(1, template["lines"] + 1)
-                }
-                
-    if not cable:
-        return jsonify({"error": "Cable not found"}), 404
-    
-    # disconnect all the ports in crateSide
-    if side_to_disconnect in ["all", "crateSide"] and "crateSide" in cable:
-        for line, connection in cable["crateSide"].items():
-            if len(connection) > 0:
-                other_cable_is_module = False
-                other_cable = cables_collection.find_one({"name": connection[0]})
-                if not other_cable:
-                    other_cable = modules_collection.find_one({"moduleName": connection[0]})
-                    if other_cable:
-                        other_cable_is_module = True
-
-                if other_cable:
-                    if "detSide" in other_cable and str(connection[1]) in other_cable["detSide"]:
-                        other_cable["detSide"][str(connection[1])] = []
-                        if other_cable_is_module:
-                            modules_collection.update_one({"moduleName": connection[0]}, {"$set": other_cable})
-                        else:
-                            cables_collection.update_one({"name": connection[0]}, {"$set": other_cable})
-
-                cable["crateSide"][str(line)] = []
-            
-    # now the detSide
-    if side_to_disconnect in ["all", "detSide"] and "detSide" in cable:
-        for line, connection in cable["detSide"].items():
-            if len(connection) > 0:
-                other_cable_is_module = False
-                other_cable = cables_collection.find_one({"name": connection[0]})
-                if not other_cable:
-                    other_cable = modules_collection.find_one({"moduleName": connection[0]})
-                    if other_cable:
-                        other_cable_is_module = True
-                        
-                if other_cable:
-                    if "crateSide" in other_cable and str(connection[1]) in other_cable["crateSide"]:
-                        other_cable["crateSide"][str(connection[1])] = []
-                        if other_cable_is_module:
-                            modules_collection.update_one({"moduleName": connection[0]}, {"$set": other_cable})
-                        else:
-                            cables_collection.update_one({"name": connection[0]}, {"$set": other_cable})
-                cable["detSide"][str(line)] = []
-            
-    # update the cable in the database
-    if is_module:
-        modules_collection.update_one({"moduleName": cable_name}, {"$set": cable})
-    else:
-        cables_collection.update_one({"name": cable_name}, {"$set": cable})
-    
+
+    db = get_db()
+    try:
+        get_cabling_graph(db).disconnect_all(db, data["cable"], side_to_disconnect)
+    except CablingError as e:
+        return jsonify({"error": e.message}), e.status
     return jsonify({"message": "All ports disconnected successfully"}), 200
 
+@bp.route("/cabling_paths/module/<module_name>", methods=["GET"])
+def module_paths(module_name):
+    """
+    Returns the paths of the connected crateSide lines of a module, from the in-memory path index:
+    [{"module", "line", "module_port", "chain": [hops as in /snapshot], "end": {"cable", "type", "line", "port"}}]
+
+    Query parameters:
+    - end_type: only the paths ending on a cable of this type, e.g. end_type=FC7 (optional)
+    """
+    db = get_db()
+    try:
+        paths = get_cabling_graph(db).paths_of_module(module_name, request.args.get("end_type"))
+    except CablingError as e:
+        return jsonify({"error": e.message}), e.status
+    return jsonify(paths), 200
+
+
+@bp.route("/cabling_paths/modules", methods=["POST"])
+def modules_paths():
+    """
+    Returns the paths of many modules at once, e.g. the FC7 optical groups of the modules of a run:
+    {"modules": [names], "end_type": "FC7" (optional)} -> {module: [paths]}, unknown modules are omitted.
+    """
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("modules"), list):
+        return jsonify({"error": "modules must be a list of module names"}), 400
+    db = get_db()
+    graph = get_cabling_graph(db)
+    result = {}
+    for module_name in data["modules"]:
+        try:
+            result[module_name] = graph.paths_of_module(module_name, data.get("end_type"))
+        except CablingError:
+            continue
+    return jsonify(result), 200
+
+
+@bp.route("/cabling_paths/cable/<cable_name>", methods=["GET"])
+def cable_paths(cable_name):
+    """
+    Returns the paths of the module lines going through a cable, e.g. the modules landing on an FC7,
+    from the in-memory path index.
+
+    Query parameters:
+    - port and side: only the lines of this port of the cable, e.g. port=OG0&side=detSide (optional)
+    - end_type: only the paths ending on a cable of this type (optional)
+    """
+    db = get_db()
+    try:
+        paths = get_cabling_graph(db).paths_through_cable(
+            cable_name, request.args.get("side", "detSide"), request.args.get("port"), request.args.get("end_type")
+        )
+    except CablingError as e:
+        return jsonify({"error": e.message}), e.status
+    return jsonify(paths), 200
+
+
 @bp.route("/snapshot", methods=["POST"])
 def snapshot():
     """
@@ -402,191 +270,17 @@ def snapshot():
         - 404 Not Found: If the specified cable is not found
         - 400 Bad Request: If an invalid cable template is encountered
     """
-    
+
     data = request.get_json()
-    cables_collection = get_db()["cables"]
-    modules_collection = get_db()["modules"]
-    templates_collection = get_db()["cable_templates"]
 
     # check that data includes the necessary fields
     if "cable" not in data or "side" not in data:
         return jsonify({"error": "Cable, port and side must be specified"}), 400
 
-    cable1_name = data["cable"]
-    side = data["side"]
-    port = data.get("port")  # Port is optional
-
-    if side not in ["crateSide", "detSide"]:
-        return jsonify({"error": "Invalid side"}), 400
-    
-    otherSide = "crateSide" if side == "detSide" else "detSide"
-
-    module_in_detSide = False
-    # Retrieve the cables from the database
-    cable1 = cables_collection.find_one({"name": cable1_name})
-    if not cable1:
-        cable1 = modules_collection.find_one({"moduleName": cable1_name})
-        module_in_detSide = True
-        if cable1:
-            if "type" not in cable1:
-                cable1["type"] = "module"
-            template1 = templates_collection.find_one({"type": cable1["type"]})
-
-    if not cable1:
-        return jsonify({"error": "Cable not found"}), 404
-
-    template1 = templates_collection.find_one({"type": cable1["type"]})
-
-    if not template1:
-        return jsonify({"error": "Invalid cable template"}), 400
-
-    cables_visited = []
-    cables_visited.append(cable1_name)
-
-    # Get the lines for all the ports
-    lines1 = template1["lines"]
-    all_lines = [line for line in range(1, lines1 + 1)]
-
-    # If port is specified, filter lines to only include those from the specified port
-    if port:
-        if side == "crateSide" and "crateSide" in template1:
-            if port in template1["crateSide"]:
-                all_lines = [line for line in template1["crateSide"][port] if line != -1]
-            else:
-                return jsonify({"error": f"Port {port} not found in crateSide"}), 400
-        elif side == "detSide" and "detSide" in template1:
-            if port in template1["detSide"]:
-                all_lines = [line for line in template1["detSide"][port] if line != -1]
-            else:
-                return jsonify({"error": f"Port {port} not found in detSide"}), 400
-
-    # snapshot is a dict
-    snapshot = {}
-    # since we can have multiple lines per port, we can have multiple cables
-    # so we keep track of the current line
-    for line in all_lines:
-        snapshot[line] = {}
-
-        # When port is specified, use it directly instead of searching
-        if port:
-            if side == "crateSide":
-                snapshot[line]["crate_port"] = port
-            elif side == "detSide":
-                snapshot[line]["det_port"] = port
-        else:
-            # Original behavior when no port is specified
-            if "crateSide" in template1:
-                for p, tlines in template1["crateSide"].items():
-                    if line in tlines:
-                        snapshot[line]["crate_port"] = p
-                        break
-            
-            if "detSide" in template1:
-                for p, tlines in template1["detSide"].items():
-                    if line in tlines:
-                        snapshot[line]["det_port"] = p
-                        break
-
-        snapshot[line]["connections"] = []
-        current_cable = cable1
-
-        if side not in current_cable:
-            continue
-        if current_cable[side] == {}:
-            continue
-        if current_cable[side][str(line)] == []:
-            continue
-
-        next_cable = cables_collection.find_one(
-            {"name": current_cable[side][str(line)][0]}
-        )
-
-        # if the next cable search is empty, search in modules
-        if not next_cable:
-            next_cable = modules_collection.find_one(
-                {"moduleName": current_cable[side][str(line)][0]}
-            )
-
-        next_line = current_cable[side][str(line)][1]
-        next_template = templates_collection.find_one({"type": next_cable["type"]})
-
-        crate_ports = []
-        det_ports = []
-
-        #
-        if "crateSide" in next_template:
-            for p, lines in next_template["crateSide"].items():
-                if next_line in lines:
-                    crate_ports.append(p)
-                
-        if "detSide" in next_template:
-            for p, lines in next_template["detSide"].items():
-                if next_line in lines:
-                    det_ports.append(p)
-
-        # append the next cable and line
-        snapshot[line]["connections"].append(
-            {
-                "cable": current_cable[side][str(line)][0],
-                "line": next_line,
-                "det_port": det_ports,
-                "crate_port": crate_ports,
-            }
-        )
-        while True:
-            # update the current cable, port, and line
-            current_cable = next_cable
-            current_line = next_line
-
-            if side not in current_cable:
-                break
-            if current_cable[side] == {}:
-                break
-            if current_cable[side][str(current_line)] == []:
-                break
-
-
-            next_cable = cables_collection.find_one(
-                {"name": current_cable[side][str(current_line)][0]}
-            )
-
-            # if the next cable search is empty, search in modules
-            if not next_cable:
-                next_cable = modules_collection.find_one(
-                    {"moduleName": current_cable[side][str(current_line)][0]}
-                )
-
-            if not next_cable:
-                break
-
-            # get the lines
-            next_line = current_cable[side][str(current_line)][1]
-            next_template = templates_collection.find_one({"type": next_cable["type"]})
-
-
-            # if next_cable["name"] starts with F it means it's an FC7
-            # and we should log which port the line corresponds to
-            crate_ports = []
-            det_ports = []
-
-            if "crateSide" in next_template:
-                for p, lines in next_template["crateSide"].items():
-                    if next_line in lines:
-                        crate_ports.append(p)
-                        
-
-            if "detSide" in next_template:
-                for p, lines in next_template["detSide"].items():
-                    if next_line in lines:
-                        det_ports.append(p)
-
-            snapshot[line]["connections"].append(
-                {
-                    "cable": current_cable[side][str(current_line)][0],
-                    "line": next_line,
-                    "det_port": det_ports,
-                    "crate_port": crate_ports,
-                }
-            )
-
+    # the lines are followed on the in-memory cabling graph, without database round trips
+    db = get_db()
+    try:
+        snapshot = get_cabling_graph(db).snapshot(db, data["cable"], data["side"], data.get("port"))
+    except CablingError as e:
+        return jsonify({"error": e.message}), e.status
     return (jsonify(snapshot), 200)
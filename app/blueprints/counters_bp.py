@@ -0,0 +1,25 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from flask import request, jsonify, Blueprint
+from utils import get_db
+from counters import reserve_range, format_names, CounterError
+
+bp = Blueprint("counters", __name__)
+
+
+@bp.route("/counters/<string:counter>/reserve", methods=["POST"])
+def reserve(counter):
+    """
+    Reserves count consecutive names of a counter (session, run or burnin_cycle) in one round trip,
+    e.g. to create many sessions from a script: the reserved sessionNames are then kept by POST /sessions.
+
+    Body: {"count": <n>} (default 1)
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        numbers = reserve_range(get_db(), counter, data.get("count", 1))
+    except CounterError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"counter": counter, "numbers": numbers, "names": format_names(counter, numbers)}), 200
@@ -0,0 +1,56 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from flask import request, jsonify, Blueprint, current_app
+from utils import get_db
+from iv_analytics import DEFAULT_PARAMETERS, AnalyticsQueryError, analyze_scans, parse_analytics_query, rank_scans
+from iv_trends import TrendQueryError, parse_trend_query, trend_series
+
+bp = Blueprint("iv_analytics", __name__)
+
+
+@bp.route("/iv_analytics", methods=["POST"])
+def iv_analytics():
+    """
+    Ranks the IV scans (by default the latest of each module) by a figure of merit: the current
+    at the operating voltage, raw (I_vop) or at the reference temperature (I_vop_norm), the
+    breakdown voltage (V_breakdown) or the hysteresis between the ramps. See iv_analytics.py.
+
+    Body: {"modules": [...], "sessions": [...], "IVScanIds": [...], "parameters": {"vop": 300, ...},
+           "latest": true, "sort": "I_vop_norm", "order": "asc", "ranges": {"V_breakdown": {"min": 400}},
+           "limit": 100}, all optional
+    """
+    try:
+        parsed = parse_analytics_query(request.get_json(silent=True) or {})
+    except AnalyticsQueryError as e:
+        return jsonify({"error": str(e)}), 400
+    # the defaults of the deployment, overridden by the ones of the request
+    parameters = dict(current_app.config.get("IV_ANALYSIS_PARAMETERS", DEFAULT_PARAMETERS), **parsed["parameters"])
+    scans = analyze_scans(get_db()["iv_scans"], parsed["query"], parameters)
+    results = rank_scans(
+        scans, parsed["sort"], parsed["descending"], parsed["ranges"], parsed["latest"], parsed["limit"]
+    )
+    return jsonify({"parameters": parameters, "count": len(results), "results": results}), 200
+
+
+@bp.route("/iv_trends", methods=["POST"])
+def iv_trends():
+    """
+    The evolution of the IV scans of many modules across their sessions, from the iv_trends rollup
+    points: the |I| at the reference voltages (IV_TREND_VOLTAGES), the temperature and the humidity.
+    See iv_trends.py.
+
+    Body: {"modules": [...], "from": "2024-01-01T00:00:00", "to": ..., "bucket": "scan" | "session" | "day" |
+           "week" | "month", "voltages": [300]}, modules required
+
+    Returns:
+    - {"voltages": [...], "bucket": ..., "series": {nameLabel: [points in date order]}}
+    """
+    voltages = current_app.config["IV_TREND_VOLTAGES"]
+    try:
+        parsed = parse_trend_query(request.get_json(silent=True), voltages)
+        series = trend_series(get_db(), parsed)
+    except TrendQueryError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"voltages": parsed["voltages"], "bucket": parsed["bucket"], "series": series}), 200
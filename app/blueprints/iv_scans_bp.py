@@ -0,0 +1,47 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from flask import request, jsonify, Blueprint, current_app
+from utils import get_db
+from iv_ingest import INGEST_MODES, ingest_scans, read_ndjson
+from iv_trends import refresh_trends
+
+bp = Blueprint("iv_scans_bp", __name__)
+
+
+@bp.route("/iv_scans/bulk", methods=["POST"])
+def iv_scans_bulk():
+    """
+    Inserts many IV scans at once, e.g. a whole session of the probe station or a past campaign.
+
+    This route expects either:
+    - a JSON list of scans, or {"scans": [...], "mode": "insert" | "upsert"}
+    - an NDJSON body (Content-Type: application/x-ndjson), one scan per line, read as a stream
+    The mode can also be given as ?mode=. With "insert" (default) the scans whose IVScanId
+    already exists are reported and left as they are, with "upsert" they are replaced.
+
+    Returns:
+    - {"inserted", "updated", "failed", "results": [{"index", "IVScanId", "status", "error" (on failure)}]},
+      one result per scan, see iv_ingest.py
+    """
+    mode = request.args.get("mode")
+    if request.mimetype == "application/x-ndjson":
+        scans = read_ndjson(request.stream)
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            mode = mode or data.get("mode")
+            data = data.get("scans")
+        if not isinstance(data, list):
+            return jsonify({"error": "Expected a list of scans, {\"scans\": [...]} or an NDJSON body"}), 400
+        scans = data
+    mode = mode or "insert"
+    if mode not in INGEST_MODES:
+        return jsonify({"error": f"mode should be one of {', '.join(INGEST_MODES)}"}), 400
+
+    dtype = current_app.config["IV_BINARY_DTYPE"] if current_app.config.get("IV_STORAGE") == "binary" else None
+    touched = set()
+    report = ingest_scans(get_db()["iv_scans"], scans, mode, dtype, touched=touched)
+    refresh_trends(get_db(), touched)
+    return jsonify(report), 200
@@ -4,6 +4,7 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from jsonschema import validate, ValidationError
 from flask import request, jsonify, Blueprint
+from pymongo.errors import OperationFailure
 import re
 from utils import get_db
 
@@ -15,17 +16,139 @@ def SearchLogBookByText():
     data = request.get_json()
     pattern = data.get("modules")
     rexp = re.compile(pattern, re.IGNORECASE)
-    logs = logbook_collection.find({"event": rexp})
-    logs1 = logbook_collection.find({"details": rexp})
-    result = set()
-    for i in logs:
-        result.add(str(i["_id"]))
-    for i in logs1:
-        result.add(str(i["_id"]))
-    results = list(result)
+    # a single pass over the collection, returning the ids only (see /searchLogBook for a ranked search)
+    logs = logbook_collection.find({"$or": [{"event": rexp}, {"details": rexp}]}, {"_id": 1})
+    results = [str(i["_id"]) for i in logs]
     return jsonify(results), 200
 
 
+# fields of the entries returned by /searchLogBook by default
+SEARCH_FIELDS = ["timestamp", "event", "details", "operator", "station", "sessionName", "involved_modules"]
+MAX_PER_PAGE = 200
+
+
+class SearchQueryError(ValueError):
+    """Raised when the body of a logbook search is not valid."""
+
+
+def logbook_search_pipeline(text=None, modules=None, date_from=None, date_to=None, page=1, per_page=20, fields=None):
+    """
+    Aggregation pipeline of a logbook search, returning a single {"total", "results"} document.
+
+    Args:
+        text: words to search in event, details and involved_modules with the text index,
+            the results are ranked by relevance (then most recent first); all the entries if None
+        modules: only the entries involving one of these modules
+        date_from, date_to: only the entries with a timestamp in this range (ISO 8601 strings, inclusive)
+        page, per_page: the page of the results to return (from 1)
+        fields: fields of the entries to return (SEARCH_FIELDS by default)
+    """
+    match = {}
+    if text:
+        # $text has to be in the first stage of the pipeline
+        match["$text"] = {"$search": text}
+    if modules:
+        match["involved_modules"] = {"$in": modules}
+    if date_from or date_to:
+        match["timestamp"] = {}
+        if date_from:
+            match["timestamp"]["$gte"] = date_from
+        if date_to:
+            match["timestamp"]["$lte"] = date_to
+
+    projection = {field: 1 for field in fields or SEARCH_FIELDS}
+    if text:
+        sort = {"score": {"$meta": "textScore"}, "timestamp": -1}
+        projection["score"] = {"$meta": "textScore"}
+    else:
+        sort = {"timestamp": -1}
+    return [
+        {"$match": match},
+        {
+            "$facet": {
+                "total": [{"$count": "count"}],
+                "results": [
+                    {"$sort": sort},
+                    {"$skip": (page - 1) * per_page},
+                    {"$limit": per_page},
+                    {"$project": projection},
+                ],
+            }
+        },
+        {"$project": {"total": {"$ifNull": [{"$arrayElemAt": ["$total.count", 0]}, 0]}, "results": 1}},
+    ]
+
+
+def parse_search(data):
+    """Checks the body of a logbook search, returns the keyword arguments of logbook_search_pipeline."""
+    if not isinstance(data, dict):
+        raise SearchQueryError("Invalid input, expected a JSON object")
+    text = data.get("text")
+    if text is not None and not isinstance(text, str):
+        raise SearchQueryError("text should be a string")
+    modules = data.get("modules")
+    if isinstance(modules, str):
+        modules = [modules]
+    if modules is not None and not (isinstance(modules, list) and all(isinstance(m, str) for m in modules)):
+        raise SearchQueryError("modules should be a list of module names")
+    for key in ("from", "to"):
+        if data.get(key) is not None and not isinstance(data[key], str):
+            raise SearchQueryError(f"{key} should be an ISO 8601 timestamp")
+    page, per_page = data.get("page", 1), data.get("per_page", 20)
+    if not isinstance(page, int) or page < 1:
+        raise SearchQueryError("page should be a positive integer")
+    if not isinstance(per_page, int) or not 1 <= per_page <= MAX_PER_PAGE:
+        raise SearchQueryError(f"per_page should be an integer between 1 and {MAX_PER_PAGE}")
+    fields = data.get("fields")
+    if fields is not None and not (isinstance(fields, list) and all(isinstance(f, str) for f in fields)):
+        raise SearchQueryError("fields should be a list of field names")
+    return {
+        "text": text.strip() if text else None,
+        "modules": modules,
+        "date_from": data.get("from"),
+        "date_to": data.get("to"),
+        "page": page,
+        "per_page": per_page,
+        "fields": fields,
+    }
+
+
+@bp.route("/searchLogBook", methods=["POST"])
+def SearchLogBook():
+    """
+    Ranked, paginated search of the logbook with the text index, in a single query.
+
+    Body (all optional):
+    - text: words to search in event, details and involved_modules ("quoted phrases" and -excluded words
+      as in MongoDB $text searches)
+    - modules: list of module names, only the entries involving one of them
+    - from, to: ISO 8601 timestamps, only the entries in this range
+    - page, per_page: page of the results (default 1 and 20)
+    - fields: fields of the entries to return
+
+    Returns:
+        {"total", "page", "per_page", "results": [entries with their _id, and score when searching text]}
+    """
+    try:
+        search = parse_search(request.get_json())
+    except SearchQueryError as e:
+        return jsonify({"error": str(e)}), 400
+    logbook_collection = get_db()["logbook"]
+    try:
+        result = next(logbook_collection.aggregate(logbook_search_pipeline(**search)))
+    except OperationFailure as e:
+        # IndexNotFound: the text index is created by the apply-indexes command
+        if e.code != 27:
+            raise
+        return jsonify({"error": "The logbook text index is missing, run flask apply-indexes"}), 503
+    return jsonify({
+        "total": result["total"],
+        "page": search["page"],
+        "per_page": search["per_page"],
+        "results": result["results"],
+    }), 200
+
+
 @bp.route("/searchLogBookByModuleNames", methods=["POST"])
 def SearchLogBookByModuleNames():
     logbook_collection = get_db()["logbook"]
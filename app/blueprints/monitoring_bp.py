@@ -0,0 +1,36 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from flask import jsonify, Blueprint, Response
+from utils import get_client_registry
+from response_cache import get_response_cache
+from metrics import get_metrics
+
+bp = Blueprint("monitoring", __name__)
+
+
+@bp.route("/db_pool/stats", methods=["GET"])
+def db_pool_stats():
+    """
+    Returns the connection pool statistics of the MongoClients used by this worker process:
+    connections opened/closed, checkouts, checkout failures and time spent waiting for a connection.
+    Each gunicorn worker has its own pool, so the stats refer to the worker that serves the request.
+    """
+    return jsonify(get_client_registry().stats()), 200
+
+
+@bp.route("/response_cache/stats", methods=["GET"])
+def response_cache_stats():
+    """Returns the hits, misses and evictions of the response cache of this worker process."""
+    return jsonify(get_response_cache().stats()), 200
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Returns, in the Prometheus text format, the latency histograms of the requests by route, the
+    MongoDB time and commands of each route, and the duration, failures and returned documents of
+    the MongoDB commands by collection, as seen by this worker process.
+    """
+    return Response(get_metrics().render(), mimetype="text/plain; version=0.0.4")
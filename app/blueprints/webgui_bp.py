@@ -1,7 +1,11 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, jsonify
 # send_from_directory is used to send files from a directory
 from flask import send_from_directory, current_app
 import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from attachments import get_attachment_store, is_digest
 
 bp = Blueprint('main', __name__)
 
@@ -14,7 +18,17 @@ def homeGUI():
 
 @bp.route('/attachments/<filename>')
 def getAttachment(filename):
-    return send_from_directory("/attachments", filename)
+    # files saved before the content-addressed store, by timestamp and name
+    return send_from_directory(current_app.config.get("ATTACHMENT_DIR", "/attachments"), filename)
+
+
+@bp.route('/attachments/<digest>/<path:filename>')
+def getStoredAttachment(digest, filename):
+    # the name only sets the content type, the digest is the content (and the ETag)
+    response = get_attachment_store().send(digest, filename) if is_digest(digest) else None
+    if response is None:
+        return jsonify({"error": "Attachment not found"}), 404
+    return response
 
 
 @bp.route('/session_testing_flow')
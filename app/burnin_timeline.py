@@ -0,0 +1,215 @@
+# timeline of the burn-in cycles: which module was in the chamber, and when
+#
+# a burn-in cycle lists its modules in BurninCycleModules, so the cycles of a module, or the
+# modules in the chamber at a given time, could only be found by scanning and unwinding the
+# cycles. The burnin_timeline collection keeps one entry per (cycle, module): the start of the
+# cycle (BurninCycleDate), its end and its temperatures, indexed on (moduleName, start) and
+# (end, start). The entries of a cycle are rewritten on every write of /burnin_cycles.
+# The end is BurninCycleEndDate when the cycle has one. Otherwise it is estimated as the start
+# plus BURNIN_CYCLE_DURATION_HOURS, cut at the start of the next cycle of the module (a module
+# is in one cycle at a time), and the entry is flagged with endEstimated.
+
+import datetime
+
+from flask import current_app
+from pymongo import ASCENDING, UpdateOne
+
+TIMELINE_COLLECTION = "burnin_timeline"
+
+
+class TimelineQueryError(ValueError):
+    """Raised when the query args of a timeline lookup are not valid."""
+
+
+def parse_cycle_date(value):
+    """
+    The naive UTC datetime of a date of a cycle ("2024-01-15", "2024-01-15T10:00:00Z", ...),
+    None if it has none.
+    """
+    if not isinstance(value, datetime.datetime):
+        try:
+            value = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def cycle_duration():
+    """The duration of the cycles without an end date (BURNIN_CYCLE_DURATION_HOURS)."""
+    return datetime.timedelta(hours=current_app.config["BURNIN_CYCLE_DURATION_HOURS"])
+
+
+def timeline_entries(cycle):
+    """The timeline entries of a burn-in cycle, one per module, with the end still to estimate if it has none."""
+    end = parse_cycle_date(cycle.get("BurninCycleEndDate"))
+    entry = {
+        "cycle_id": cycle["_id"],
+        "BurninCycleName": cycle.get("BurninCycleName"),
+        # the raw date, the timestamp of the events of the testing flow
+        "BurninCycleDate": cycle.get("BurninCycleDate"),
+        "start": parse_cycle_date(cycle.get("BurninCycleDate")),
+        "end": end,
+        "endEstimated": end is None,
+        "status": cycle.get("BurninCycleStatus"),
+        "temperatures": cycle.get("BurninCycleTemperatures"),
+        "temperature": cycle.get("BurninCycleTemperature"),
+        "minTemperature": cycle.get("BurninCycleMinTemperature"),
+        "maxTemperature": cycle.get("BurninCycleMaxTemperature"),
+        "humidity": cycle.get("BurninCycleHumidity"),
+    }
+    return [dict(entry, moduleName=module) for module in dict.fromkeys(cycle.get("BurninCycleModules") or [])]
+
+
+def _estimate_ends(timeline, modules, duration):
+    """Sets the estimated ends of the entries of the modules (all of them if None), returns the number changed."""
+    query = {"start": {"$ne": None}}
+    if modules is not None:
+        if not modules:
+            return 0
+        query["moduleName"] = {"$in": list(modules)}
+    entries = timeline.find(query, {"moduleName": 1, "start": 1, "end": 1, "endEstimated": 1}).sort(
+        [("moduleName", ASCENDING), ("start", ASCENDING)]
+    )
+    requests = []
+
+    def estimate(entry, next_entry):
+        end = entry["start"] + duration
+        if next_entry is not None and next_entry["moduleName"] == entry["moduleName"] and next_entry["start"] > entry["start"]:
+            end = min(end, next_entry["start"])
+        if end != entry.get("end"):
+            requests.append(UpdateOne({"_id": entry["_id"]}, {"$set": {"end": end}}))
+
+    previous = None
+    for entry in entries:
+        if previous is not None and previous.get("endEstimated"):
+            estimate(previous, entry)
+        previous = entry
+    if previous is not None and previous.get("endEstimated"):
+        estimate(previous, None)
+    if requests:
+        timeline.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def update_timeline(db, cycle_ids, duration):
+    """
+    Rewrites the timeline entries of the cycles (by _id) from burnin_cycles, e.g. after a write of
+    these cycles: a deleted cycle loses its entries. The estimated ends of the other cycles of
+    their modules are updated too.
+    """
+    cycle_ids = list(cycle_ids)
+    timeline = db[TIMELINE_COLLECTION]
+    modules = set(timeline.distinct("moduleName", {"cycle_id": {"$in": cycle_ids}}))
+    timeline.delete_many({"cycle_id": {"$in": cycle_ids}})
+    entries = [entry for cycle in db["burnin_cycles"].find({"_id": {"$in": cycle_ids}}) for entry in timeline_entries(cycle)]
+    if entries:
+        timeline.insert_many(entries, ordered=False)
+    modules.update(entry["moduleName"] for entry in entries)
+    _estimate_ends(timeline, modules, duration)
+    return len(entries)
+
+
+def refresh_timeline(db, cycle_ids):
+    """update_timeline with the cycle duration of the app (BURNIN_CYCLE_DURATION_HOURS)."""
+    return update_timeline(db, cycle_ids, cycle_duration())
+
+
+def rebuild_timeline(db, duration, batch_size=500):
+    """Rebuilds the burnin_timeline collection from all the cycles, returns the number of entries."""
+    timeline = db[TIMELINE_COLLECTION]
+    timeline.delete_many({})
+    count = 0
+    batch = []
+    for cycle in db["burnin_cycles"].find().batch_size(batch_size):
+        batch += timeline_entries(cycle)
+        if len(batch) >= batch_size:
+            timeline.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        timeline.insert_many(batch, ordered=False)
+        count += len(batch)
+    _estimate_ends(timeline, None, duration)
+    return count
+
+
+def ensure_timeline(db, duration):
+    """Builds the timeline if it is empty while there are cycles, e.g. on the first start. Returns the number of entries built."""
+    if db[TIMELINE_COLLECTION].estimated_document_count() == 0 and db["burnin_cycles"].estimated_document_count() > 0:
+        return rebuild_timeline(db, duration)
+    return 0
+
+
+def parse_time_arg(args, key, required=False):
+    """The datetime of an ISO 8601 query arg, None if it is not given."""
+    value = args.get(key)
+    if value is None:
+        if required:
+            raise TimelineQueryError(f"{key} is required")
+        return None
+    parsed = parse_cycle_date(value)
+    if parsed is None:
+        raise TimelineQueryError(f"{key} should be an ISO 8601 date")
+    return parsed
+
+
+# the entries of the responses, without the ids
+TIMELINE_PROJECTION = {"_id": 0, "cycle_id": 0}
+
+
+def module_cycles(db, module, start=None, end=None):
+    """The timeline entries of a module overlapping [start, end] (either bound optional), in time order."""
+    query = {"moduleName": module}
+    if end is not None:
+        query["start"] = {"$lte": end}
+    if start is not None:
+        query["end"] = {"$gte": start}
+    return list(db[TIMELINE_COLLECTION].find(query, TIMELINE_PROJECTION).sort("start", ASCENDING))
+
+
+def modules_at(db, time):
+    """The timeline entries of the modules in the chamber at time (start <= time < end), by module."""
+    query = {"end": {"$gt": time}, "start": {"$lte": time}}
+    return list(db[TIMELINE_COLLECTION].find(query, TIMELINE_PROJECTION).sort("moduleName", ASCENDING))
+
+
+def session_cycle_events(db, session_name):
+    """
+    The burn-in events of the testing flow of a session: one per module in each cycle whose name
+    contains the session name, as the build_testing_flow input.
+    """
+    pipeline = [
+        # the regex is matched on the keys of the BurninCycleName index, not on the documents
+        {"$match": {"BurninCycleName": {"$regex": f".*{session_name}.*"}}},
+        {"$project": {
+            "_id": 0,
+            "type": {"$literal": "cycle"},
+            "timestamp": "$BurninCycleDate",
+            "module_name": "$moduleName",
+            "cycle_name": "$BurninCycleName",
+            "temperatures": "$temperatures",
+            # "Cycle <low>°C/<high>°C" when the cycle has both temperatures
+            "event_name": {
+                "$cond": {
+                    "if": {"$and": [
+                        {"$ifNull": ["$temperatures.low", False]},
+                        {"$ifNull": ["$temperatures.high", False]},
+                    ]},
+                    "then": {
+                        "$concat": [
+                            "Cycle ",
+                            {"$toString": "$temperatures.low"},
+                            "°C/",
+                            {"$toString": "$temperatures.high"},
+                            "°C",
+                        ]
+                    },
+                    "else": "Cycle",
+                }
+            },
+        }},
+        {"$sort": {"timestamp": 1}},
+    ]
+    return list(db[TIMELINE_COLLECTION].aggregate(pipeline))
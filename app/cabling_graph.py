@@ -0,0 +1,654 @@
+import copy
+import os
+import sys
+import threading
+from flask import current_app
+from pymongo import DeleteOne, ReplaceOne, UpdateOne, ReturnDocument
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import run_in_transaction
+
+SIDES = ("crateSide", "detSide")
+# collections whose content is mirrored by the cabling graph
+GRAPH_COLLECTIONS = ["cables", "modules", "cable_templates"]
+# materialized paths of the module lines (ConnectionSnapshot documents), see materialize_paths
+PATHS_COLLECTION = "connection_snapshot"
+
+
+class CablingError(Exception):
+    """An error in a cabling operation, carrying the HTTP status to return."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def cabling_generation(db):
+    """
+    Returns the generation counter bumped by every write of the cabling data going
+    through the API, with a single indexed read of the metadata collection.
+    """
+    meta = db["metadata"].find_one({"name": "cabling_graph"}, {"generation": 1})
+    return meta.get("generation", 0) if meta else 0
+
+
+def collection_uuids(db):
+    """Returns the uuids of the cabling collections, which change when a collection is dropped."""
+    collections = db.list_collections(filter={"name": {"$in": GRAPH_COLLECTIONS}})
+    return tuple(sorted((c["name"], str(c.get("info", {}).get("uuid"))) for c in collections))
+
+
+def invalidate_cabling_graph(db):
+    """
+    Bumps the cabling generation counter, so that the cabling graph of every
+    worker is reloaded on its next use. Returns the new generation.
+    """
+    meta = db["metadata"].find_one_and_update(
+        {"name": "cabling_graph"},
+        {"$inc": {"generation": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return meta["generation"]
+
+
+class CablingGraph:
+    """
+    In-memory mirror of the cabling map of a db.
+
+    Every endpoint (cable or module) is stored with its type and its crateSide and
+    detSide adjacency, i.e. {line: [other endpoint, other line]}, so that following a
+    line through the whole chain needs no database round trip. The port of each line
+    is precomputed for every cable template.
+
+    Changes done through connect/disconnect are applied to the graph and written
+    through to the database; every other change bumps the generation counter in the
+    metadata collection, and the graph is reloaded when the generation is outdated. Only
+    the generation is read on each use; the uuids of the collections are read on reload, and
+    a write through that does not find its documents (e.g. a collection dropped outside the
+    API) marks the graph stale, so that it is reloaded on the next use.
+
+    The path index holds, for every connected crateSide line of every module, the chain
+    of cables up to the crate end (e.g. an FC7 optical group), and for every line of every
+    cable the module lines whose chain goes through it. It is built with the graph and
+    updated on connect/disconnect for the chains going through the touched endpoints; the
+    documents of these module lines in the PATHS_COLLECTION are rewritten at the same time.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.generation = None
+        self.uuids = None
+        self.stale = True
+        self.cables = {}
+        self.modules = {}
+        self.templates = {}
+        self.ports_of_line = {}
+        # (module, line) -> path, see _path
+        self.paths = {}
+        # (cable or module, line) -> {(module, line)} of the paths going through it
+        self.paths_through = {}
+
+    # ---------------------------------------------------------------- loading
+
+    def load(self, db):
+        self.uuids = collection_uuids(db)
+        templates = {t["type"]: t for t in db["cable_templates"].find({}, {"_id": 0})}
+        ports_of_line = {}
+        for cable_type, template in templates.items():
+            ports_of_line[cable_type] = {}
+            for side in SIDES:
+                index = {}
+                for port, lines in template.get(side, {}).items():
+                    for line in lines:
+                        if line != -1:
+                            index.setdefault(line, []).append(port)
+                ports_of_line[cable_type][side] = index
+
+        projection = {"_id": 0, "type": 1, "crateSide": 1, "detSide": 1}
+        cables = {}
+        for doc in db["cables"].find({}, dict(projection, name=1)):
+            cables[doc["name"]] = self._endpoint("cable", doc["name"], doc)
+        modules = {}
+        for doc in db["modules"].find({}, dict(projection, moduleName=1)):
+            modules[doc["moduleName"]] = self._endpoint("module", doc["moduleName"], doc)
+
+        self.templates = templates
+        self.ports_of_line = ports_of_line
+        self.cables = cables
+        self.modules = modules
+        self.stale = False
+        self._build_path_index()
+
+    def _endpoint(self, kind, name, doc):
+        return {
+            "kind": kind,
+            "name": name,
+            # modules may not have been initialized with a type
+            "type": doc.get("type", "module" if kind == "module" else None),
+            "crateSide": doc.get("crateSide"),
+            "detSide": doc.get("detSide"),
+        }
+
+    def ensure_fresh(self, db):
+        generation = cabling_generation(db)
+        with self.lock:
+            if self.stale or generation != self.generation:
+                self.load(db)
+                self.generation = generation
+
+    # ---------------------------------------------------------------- lookups
+
+    def find(self, name):
+        """Cables take precedence over modules with the same name."""
+        endpoint = self.cables.get(name)
+        if endpoint is None:
+            endpoint = self.modules.get(name)
+        return endpoint
+
+    def lookup(self, db, name):
+        """
+        Like find, but if the name is unknown it checks the database for endpoints
+        added without going through the API (e.g. modules imported by db_sync),
+        and reloads the graph if needed.
+        """
+        endpoint = self.find(name)
+        if endpoint is None and (
+            db["cables"].find_one({"name": name}, {"_id": 1})
+            or db["modules"].find_one({"moduleName": name}, {"_id": 1})
+        ):
+            self.load(db)
+            endpoint = self.find(name)
+        return endpoint
+
+    def ports(self, cable_type, side, line):
+        return list(self.ports_of_line.get(cable_type, {}).get(side, {}).get(line, []))
+
+    def _init_module_crateSide(self, endpoint):
+        # a module may not have been initialized with a crateSide
+        template = self.templates.get(endpoint["type"])
+        if endpoint["kind"] == "module" and endpoint["crateSide"] is None and template:
+            endpoint["crateSide"] = {str(i): [] for i in range(1, template["lines"] + 1)}
+
+    # ---------------------------------------------------------------- writes
+
+    def _write_sides(self, db, endpoints, session=None):
+        """Writes the sides of the given endpoints, with a single bulk_write per collection."""
+        requests = {"cables": [], "modules": []}
+        seen = set()
+        for endpoint in endpoints:
+            key = (endpoint["kind"], endpoint["name"])
+            if key in seen:
+                continue
+            seen.add(key)
+            fields = {side: endpoint[side] for side in SIDES if endpoint[side] is not None}
+            if endpoint["kind"] == "module":
+                fields["type"] = endpoint["type"]
+                requests["modules"].append(UpdateOne({"moduleName": endpoint["name"]}, {"$set": fields}))
+            else:
+                requests["cables"].append(UpdateOne({"name": endpoint["name"]}, {"$set": fields}))
+        missed = False
+        for collection, ops in requests.items():
+            if ops:
+                result = db[collection].bulk_write(ops, ordered=False, session=session)
+                missed = missed or result.matched_count < len(ops)
+        if missed:
+            # the documents were removed or their collection dropped behind the graph
+            self.stale = True
+            if collection_uuids(db) != self.uuids:
+                raise CablingError("A cabling collection was dropped in the meantime, please try again", 409)
+            raise CablingError("The cabling data changed in the meantime, please try again", 409)
+
+    def _bump_generation(self, db):
+        """Bumps the generation after a write through, keeping the graph fresh if nobody else wrote."""
+        try:
+            generation = invalidate_cabling_graph(db)
+        except Exception:
+            self.stale = True
+            raise
+        if self.generation is not None and generation == self.generation + 1:
+            # nobody else wrote in the meantime: the graph is up to date
+            self.generation = generation
+        else:
+            self.stale = True
+
+    def _persist(self, db, endpoints):
+        """Writes the sides of the given endpoints through to the database."""
+        try:
+            self._write_sides(db, endpoints)
+        except Exception:
+            # the graph may now differ from the database
+            self.stale = True
+            raise
+        self._write_paths(db, self._reindex_paths(endpoints))
+        self._bump_generation(db)
+
+    def _resolve_pair(self, db, cable1_name, cable2_name):
+        # make sure both endpoints are known before resolving them
+        self.lookup(db, cable1_name)
+        self.lookup(db, cable2_name)
+        cable1 = self.cables.get(cable1_name)
+        if cable1 is None:
+            cable1 = self.modules.get(cable1_name)
+            if cable1 is not None:
+                self._init_module_crateSide(cable1)
+        cable2 = self.cables.get(cable2_name)
+        if cable2 is None and cable2_name in self.modules:
+            raise Exception("Module should always be passed in detSide")
+        return cable1, cable2
+
+    def _port_lines(self, cable1, port1, cable2, port2):
+        template1 = self.templates.get(cable1["type"])
+        template2 = self.templates.get(cable2["type"])
+        if not template1 or not template2:
+            raise CablingError("Invalid cable templates", 400)
+        if port1 not in template1.get("crateSide", {}) or port2 not in template2.get("detSide", {}):
+            raise CablingError("Invalid port", 400)
+        return template1["crateSide"][port1], template2["detSide"][port2]
+
+    def _connect_lines(self, cable1, port1, cable2, port2):
+        """Connects the lines of the ports on the given endpoints, after checking that they are all free."""
+        lines1, lines2 = self._port_lines(cable1, port1, cable2, port2)
+
+        # first check that the lines are free
+        for line1 in lines1:
+            if line1 != -1:
+                connection = (cable1["crateSide"] or {}).get(str(line1), [])
+                if connection != []:
+                    raise CablingError(
+                        f"Cable {cable1['name']} line {line1} is already connected to {connection[0]}"
+                    )
+        for line2 in lines2:
+            if line2 != -1:
+                connection = (cable2["detSide"] or {}).get(str(line2), [])
+                if connection != []:
+                    raise CablingError(
+                        f"Cable {cable2['name']} line {line2} is already connected to {connection[0]}"
+                    )
+
+        # Update the cable connections
+        if cable1["crateSide"] is None:
+            cable1["crateSide"] = {}
+        if cable2["detSide"] is None:
+            cable2["detSide"] = {}
+        for line1, line2 in zip(lines1, lines2):
+            if line1 != -1 and line2 != -1:
+                cable1["crateSide"][str(line1)] = [cable2["name"], int(line2)]
+                cable2["detSide"][str(line2)] = [cable1["name"], int(line1)]
+
+    def connect(self, db, cable1_name, port1, cable2_name, port2):
+        with self.lock:
+            cable1, cable2 = self._resolve_pair(db, cable1_name, cable2_name)
+            if not cable1 or not cable2:
+                raise CablingError("Cables not found", 404)
+            self._connect_lines(cable1, port1, cable2, port2)
+            self._persist(db, [cable1, cable2])
+
+    def _disconnect_lines(self, cable1, cable2, port1=None, port2=None):
+        """
+        Disconnects the lines of the ports (all the lines between the two endpoints if no ports
+        are given) on the given endpoints, after checking that they are all connected.
+        """
+        crate_side = cable1["crateSide"] or {}
+        det_side = cable2["detSide"] or {}
+
+        if port1 is not None and port2 is not None:
+            lines1, lines2 = self._port_lines(cable1, port1, cable2, port2)
+            pairs = [
+                (str(line1), str(line2))
+                for line1, line2 in zip(lines1, lines2)
+                if line1 != -1 and line2 != -1
+            ]
+            # check all the lines before touching the graph
+            for line1, line2 in pairs:
+                if crate_side.get(line1) != [cable2["name"], int(line2)]:
+                    raise CablingError("Cables are not connected, so I cannot disconnect them")
+        else:
+            pairs = [
+                (line, str(connection[1]))
+                for line, connection in crate_side.items()
+                if len(connection) > 0 and connection[0] == cable2["name"]
+            ]
+
+        for line1, line2 in pairs:
+            crate_side[line1] = []
+            det_side[line2] = []
+
+    def disconnect(self, db, cable1_name, cable2_name, port1=None, port2=None):
+        with self.lock:
+            cable1, cable2 = self._resolve_pair(db, cable1_name, cable2_name)
+            if not cable1 or not cable2:
+                raise CablingError("Cables not found", 404)
+            self._disconnect_lines(cable1, cable2, port1, port2)
+            self._persist(db, [cable1, cable2])
+
+    def apply_bulk(self, db, action, operations, atomic=True):
+        """
+        Applies a list of connect or disconnect operations, {"cable1", "port1", "cable2", "port2"}
+        (the ports are optional to disconnect), in order. Each operation is checked against one
+        in-memory copy of the touched endpoints, including the changes of the operations before it,
+        and all the changed cables and modules are then written at once, in a transaction.
+        With atomic, nothing is written if an operation fails; otherwise the failed ones are skipped.
+
+        Returns:
+            (results, written): one {"index", "status", "error"} per operation (error only on failure),
+            and whether the changes were written
+        """
+        apply_lines = self._connect_lines if action == "connect" else self._disconnect_lines
+        with self.lock:
+            # (kind, name) -> copy of the endpoint with the changes of the batch
+            working = {}
+            changed = set()
+
+            def working_copy(endpoint):
+                key = (endpoint["kind"], endpoint["name"])
+                if key not in working:
+                    working[key] = dict(endpoint, **{side: copy.deepcopy(endpoint[side]) for side in SIDES})
+                return working[key]
+
+            results = []
+            for index, operation in enumerate(operations):
+                if not isinstance(operation, dict) or "cable1" not in operation or "cable2" not in operation:
+                    results.append({"index": index, "status": 400, "error": "Both cables must be specified"})
+                    continue
+                try:
+                    cable1_name, cable2_name = operation["cable1"], operation["cable2"]
+                    ports = (operation.get("port1"), operation.get("port2"))
+                    if action == "connect" and None in ports:
+                        raise CablingError("Both cables must have ports!")
+                    if (ports[0] is None) != (ports[1] is None):
+                        raise CablingError("Both cables must have ports, or no ports should be passed!")
+                    self.lookup(db, cable1_name)
+                    self.lookup(db, cable2_name)
+                    cable1 = self.find(cable1_name)
+                    if cable2_name not in self.cables and cable2_name in self.modules:
+                        raise CablingError("Module should always be passed in detSide")
+                    cable2 = self.cables.get(cable2_name)
+                    if not cable1 or not cable2:
+                        raise CablingError("Cables not found", 404)
+                    cable1, cable2 = working_copy(cable1), working_copy(cable2)
+                    self._init_module_crateSide(cable1)
+                    # the lines are all checked before any is changed: a failed operation leaves no trace
+                    apply_lines(cable1, ports[0], cable2, ports[1])
+                except CablingError as e:
+                    results.append({"index": index, "status": e.status, "error": e.message})
+                    continue
+                changed.update([(cable1["kind"], cable1["name"]), (cable2["kind"], cable2["name"])])
+                results.append({"index": index, "status": 200})
+
+            failed = any("error" in result for result in results)
+            if not changed or (atomic and failed):
+                return results, False
+
+            endpoints = [working[key] for key in changed]
+            try:
+                run_in_transaction(db, lambda session: self._write_sides(db, endpoints, session))
+            except Exception:
+                # without a replica set there is no transaction, and a part may have been written
+                self.stale = True
+                raise
+            # the graph takes the written copies
+            for endpoint in endpoints:
+                graph = self.modules if endpoint["kind"] == "module" else self.cables
+                graph[endpoint["name"]] = endpoint
+            self._write_paths(db, self._reindex_paths(endpoints))
+            self._bump_generation(db)
+            return results, True
+
+    def disconnect_all(self, db, cable_name, side_to_disconnect):
+        """
+        Disconnects all the lines of a given cable or module on the requested side
+        ("all", "crateSide" or "detSide"), also deleting its connections in the other
+        cables/modules, with a single write per collection.
+        """
+        with self.lock:
+            cable = self.lookup(db, cable_name)
+            if not cable:
+                raise CablingError("Cable not found", 404)
+            self._init_module_crateSide(cable)
+
+            touched = [cable]
+            for side, other_side in (("crateSide", "detSide"), ("detSide", "crateSide")):
+                if side_to_disconnect not in ["all", side] or cable[side] is None:
+                    continue
+                for line, connection in cable[side].items():
+                    if len(connection) > 0:
+                        other_cable = self.find(connection[0])
+                        if other_cable and other_cable[other_side] is not None \
+                                and str(connection[1]) in other_cable[other_side]:
+                            other_cable[other_side][str(connection[1])] = []
+                            touched.append(other_cable)
+                        cable[side][str(line)] = []
+
+            self._persist(db, touched)
+
+    # ---------------------------------------------------------------- snapshot
+
+    def snapshot(self, db, cable_name, side, port=None):
+        """
+        Follows every line of a cable on the given side through the whole chain.
+        See cables_bp.snapshot for the structure of the result.
+        """
+        if side not in SIDES:
+            raise CablingError("Invalid side", 400)
+        with self.lock:
+            return self._snapshot(db, cable_name, side, port)
+
+    def _snapshot(self, db, cable_name, side, port):
+        cable1 = self.lookup(db, cable_name)
+        if not cable1:
+            raise CablingError("Cable not found", 404)
+        template1 = self.templates.get(cable1["type"])
+        if not template1:
+            raise CablingError("Invalid cable template", 400)
+
+        all_lines = list(range(1, template1["lines"] + 1))
+        # If port is specified, filter lines to only include those from the specified port
+        if port and side in template1:
+            if port not in template1[side]:
+                raise CablingError(f"Port {port} not found in {side}", 400)
+            all_lines = [line for line in template1[side][port] if line != -1]
+
+        snapshot = {}
+        for line in all_lines:
+            entry = {}
+            if port:
+                entry["crate_port" if side == "crateSide" else "det_port"] = port
+            else:
+                crate_ports = self.ports(cable1["type"], "crateSide", line)
+                if crate_ports:
+                    entry["crate_port"] = crate_ports[0]
+                det_ports = self.ports(cable1["type"], "detSide", line)
+                if det_ports:
+                    entry["det_port"] = det_ports[0]
+            entry["connections"] = self._follow(cable1, side, line)
+            snapshot[line] = entry
+
+        return snapshot
+
+    def _follow(self, cable, side, line):
+        """Follows a line of an endpoint on the given side through the whole chain, returns the hops."""
+        connections = []
+        current_cable = cable
+        current_line = line
+        visited = {(cable["name"], line)}
+        while True:
+            connection = (current_cable[side] or {}).get(str(current_line), [])
+            if connection == []:
+                break
+            next_cable = self.find(connection[0])
+            if not next_cable:
+                break
+            next_line = connection[1]
+            connections.append(
+                {
+                    "cable": connection[0],
+                    "line": next_line,
+                    "det_port": self.ports(next_cable["type"], "detSide", next_line),
+                    "crate_port": self.ports(next_cable["type"], "crateSide", next_line),
+                }
+            )
+            # protect against loops in inconsistent cabling maps
+            if (connection[0], next_line) in visited:
+                break
+            visited.add((connection[0], next_line))
+            current_cable = next_cable
+            current_line = next_line
+        return connections
+
+    # ---------------------------------------------------------------- path index
+
+    def _path(self, module, line):
+        """The chain of a crateSide line of a module to the crate end, None if the line is not connected."""
+        chain = self._follow(module, "crateSide", line)
+        if not chain:
+            return None
+        end = chain[-1]
+        return {
+            "module": module["name"],
+            "line": line,
+            "module_port": self.ports(module["type"], "crateSide", line),
+            "chain": chain,
+            "end": {
+                "cable": end["cable"],
+                "type": (self.find(end["cable"]) or {}).get("type"),
+                "line": end["line"],
+                "port": end["det_port"][0] if end["det_port"] else None,
+            },
+        }
+
+    def _index_path(self, module_name, line):
+        """(Re)computes the path of a module line and its entries in paths_through."""
+        key = (module_name, line)
+        old = self.paths.pop(key, None)
+        if old is not None:
+            for node in [key] + [(hop["cable"], hop["line"]) for hop in old["chain"]]:
+                through = self.paths_through.get(node)
+                if through is not None:
+                    through.discard(key)
+                    if not through:
+                        del self.paths_through[node]
+        module = self.modules.get(module_name)
+        path = self._path(module, line) if module is not None else None
+        if path is None:
+            return
+        self.paths[key] = path
+        for node in [key] + [(hop["cable"], hop["line"]) for hop in path["chain"]]:
+            self.paths_through.setdefault(node, set()).add(key)
+
+    def _build_path_index(self):
+        self.paths = {}
+        self.paths_through = {}
+        for name, module in self.modules.items():
+            for line, connection in (module["crateSide"] or {}).items():
+                if connection:
+                    self._index_path(name, int(line))
+
+    def _reindex_paths(self, endpoints):
+        """Updates the paths going through the lines of the given (just changed) endpoints, returns their (module, line)."""
+        keys = set()
+        for endpoint in endpoints:
+            for side in SIDES:
+                for line in endpoint[side] or {}:
+                    keys.update(self.paths_through.get((endpoint["name"], int(line)), ()))
+            if endpoint["kind"] == "module":
+                keys.update(
+                    (endpoint["name"], int(line))
+                    for line, connection in (endpoint["crateSide"] or {}).items() if connection
+                )
+        for module_name, line in keys:
+            self._index_path(module_name, line)
+        return keys
+
+    def _write_paths(self, db, keys):
+        """Rewrites the PATHS_COLLECTION documents of the given module lines, deleted if no longer connected."""
+        requests = []
+        for module_name, line in sorted(keys):
+            query = {"module": module_name, "line": line}
+            path = self.paths.get((module_name, line))
+            if path is None:
+                requests.append(DeleteOne(query))
+            else:
+                requests.append(ReplaceOne(query, snapshot_document(path), upsert=True))
+        if requests:
+            db[PATHS_COLLECTION].bulk_write(requests, ordered=False)
+
+    def paths_of_module(self, module_name, end_type=None):
+        """The paths of the connected lines of a module, optionally only those ending on a cable type (e.g. FC7)."""
+        with self.lock:
+            module = self.modules.get(module_name)
+            if module is None:
+                raise CablingError("Module not found", 404)
+            lines = sorted(int(line) for line, connection in (module["crateSide"] or {}).items() if connection)
+            paths = [self.paths[(module_name, line)] for line in lines if (module_name, line) in self.paths]
+        return [path for path in paths if end_type is None or path["end"]["type"] == end_type]
+
+    def paths_through_cable(self, cable_name, side=None, port=None, end_type=None):
+        """
+        The paths going through any line of a cable (the crate end or an intermediate cable),
+        or through the lines of one of its ports on the given side.
+        """
+        with self.lock:
+            cable = self.find(cable_name)
+            if cable is None:
+                raise CablingError("Cable not found", 404)
+            if port is not None:
+                if side not in SIDES:
+                    raise CablingError("Invalid side", 400)
+                template = self.templates.get(cable["type"]) or {}
+                if port not in template.get(side, {}):
+                    raise CablingError(f"Port {port} not found in {side}", 400)
+                lines = [line for line in template[side][port] if line != -1]
+            else:
+                lines = range(1, (self.templates.get(cable["type"]) or {}).get("lines", 0) + 1)
+            keys = set()
+            for line in lines:
+                keys.update(self.paths_through.get((cable_name, line), ()))
+            paths = [self.paths[key] for key in sorted(keys)]
+        return [path for path in paths if end_type is None or path["end"]["type"] == end_type]
+
+
+def snapshot_document(path):
+    """The ConnectionSnapshot document of the path of a module line."""
+    return dict(
+        path,
+        First=path["module"],
+        Last=path["end"]["cable"],
+        Chain=[path["module"]] + [hop["cable"] for hop in path["chain"]],
+    )
+
+
+def materialize_paths(db, graph):
+    """
+    Replaces the content of the PATHS_COLLECTION with the paths of the graph, one ConnectionSnapshot
+    document per connected module line, for the clients reading the cabling from MongoDB.
+    The cabling endpoints then keep it up to date, the other writes of the sides need a new run.
+
+    Returns:
+        the number of paths written
+    """
+    with graph.lock:
+        docs = [snapshot_document(graph.paths[key]) for key in sorted(graph.paths)]
+
+    def replace(session):
+        db[PATHS_COLLECTION].delete_many({}, session=session)
+        if docs:
+            db[PATHS_COLLECTION].insert_many(docs, session=session)
+
+    run_in_transaction(db, replace)
+    return len(docs)
+
+
+_graphs_lock = threading.Lock()
+
+
+def get_cabling_graph(db):
+    """Returns the up to date cabling graph of the db, shared by the requests of this process."""
+    graphs = current_app.extensions.setdefault("cabling_graphs", {})
+    graph = graphs.get(db.name)
+    if graph is None:
+        with _graphs_lock:
+            graph = graphs.setdefault(db.name, CablingGraph())
+    graph.ensure_fresh(db)
+    return graph
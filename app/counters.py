@@ -0,0 +1,148 @@
+# atomic counters handing out the numbers of the sessions, runs and burn-in cycles
+#
+# each counter is a field of the {"name": "metadata"} document of the metadata collection
+# (lastSessionNumber was already there), incremented with a single find_one_and_update, so
+# that concurrent requests never get the same number and no read-modify-write is needed.
+# A counter that does not exist yet is first seeded with the highest number already in use.
+# The ranges reserved by the clients are recorded in counter_reservations, and each of their
+# names can be claimed once, e.g. by POST /sessions.
+
+import re
+
+from pymongo import ReturnDocument
+
+METADATA_DOC = {"name": "metadata"}
+
+# counter -> (field of the metadata document, prefix of the names, collection, name field)
+COUNTERS = {
+    "session": ("lastSessionNumber", "session", "sessions", "sessionName"),
+    "run": ("lastRunNumber", "run", "test_runs", "test_runName"),
+    "burnin_cycle": ("lastBurninCycleNumber", "BC", "burnin_cycles", "BurninCycleName"),
+}
+
+# upper bound of the numbers reserved in one call
+MAX_RESERVE = 1000
+# the ranges reserved by the clients: {"counter", "first", "last", "claimed": [numbers used]}
+RESERVATIONS_COLLECTION = "counter_reservations"
+
+# (database name, counter) already seeded by this process
+_seeded = set()
+
+
+class CounterError(Exception):
+    """Raised on an unknown counter or an invalid number of ids to reserve."""
+
+
+def _counter(name):
+    if name not in COUNTERS:
+        raise CounterError(f"Unknown counter '{name}', expected one of {sorted(COUNTERS)}")
+    return COUNTERS[name]
+
+
+def _highest_number_in_use(db, name):
+    """Returns the highest number of the names of the counter already in the database (0 if none)."""
+    _, prefix, collection, name_field = _counter(name)
+    pattern = re.compile(rf"^{re.escape(prefix)}(\d+)$")
+    highest = 0
+    # only the names with the prefix, from the index on the name field
+    for doc in db[collection].find({name_field: {"$regex": f"^{re.escape(prefix)}"}}, {name_field: 1, "_id": 0}):
+        match = pattern.match(str(doc.get(name_field, "")))
+        if match:
+            highest = max(highest, int(match.group(1)))
+    return highest
+
+
+def _ensure_seeded(db, name):
+    # checked once per process and database, so that a reservation is a single round trip
+    if (db.name, name) in _seeded:
+        return
+    field = _counter(name)[0]
+    if (db["metadata"].find_one(METADATA_DOC, {field: 1}) or {}).get(field) is None:
+        # $max makes the seeding idempotent when several workers do it at the same time
+        _advance(db, field, _highest_number_in_use(db, name))
+    _seeded.add((db.name, name))
+
+
+def _advance(db, field, number):
+    db["metadata"].update_one(METADATA_DOC, {"$max": {field: number}}, upsert=True)
+
+
+def advance_counter(db, name, number):
+    """Makes sure that the counter will never hand out a number lower than or equal to number."""
+    # seeded first: a counter created by this call would miss the higher numbers already in use
+    _ensure_seeded(db, name)
+    _advance(db, _counter(name)[0], number)
+
+
+def reserve_numbers(db, name, count=1):
+    """
+    Atomically reserves count consecutive numbers of the counter, in one round trip.
+
+    Returns:
+        the list of the reserved numbers
+    """
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= MAX_RESERVE:
+        raise CounterError(f"count must be an integer between 1 and {MAX_RESERVE}")
+    field = _counter(name)[0]
+    _ensure_seeded(db, name)
+    doc = db["metadata"].find_one_and_update(
+        METADATA_DOC,
+        {"$inc": {field: count}},
+        upsert=True,
+        projection={field: 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    last = doc[field]
+    return list(range(last - count + 1, last + 1))
+
+
+def format_names(name, numbers):
+    """Returns the names of the counter with the given numbers (e.g. ["session12", "session13"])."""
+    prefix = _counter(name)[1]
+    return [f"{prefix}{number}" for number in numbers]
+
+
+def reserve_names(db, name, count=1):
+    """Reserves count names of the counter."""
+    return format_names(name, reserve_numbers(db, name, count))
+
+
+def next_name(db, name):
+    """Returns a new, never handed out name of the counter."""
+    return reserve_names(db, name)[0]
+
+
+def parse_name(name, value):
+    """Returns the number of a name of the counter (e.g. 12 for "session12"), None if it does not match."""
+    prefix = _counter(name)[1]
+    match = re.match(rf"^{re.escape(prefix)}(\d+)$", str(value))
+    return int(match.group(1)) if match else None
+
+
+def reserve_range(db, name, count=1):
+    """
+    Reserves count consecutive numbers of the counter for a client (POST /counters/<c>/reserve),
+    and records the range so that the names can be claimed later with claim_reserved.
+
+    Returns:
+        the list of the reserved numbers
+    """
+    numbers = reserve_numbers(db, name, count)
+    db[RESERVATIONS_COLLECTION].insert_one({"counter": name, "first": numbers[0], "last": numbers[-1], "claimed": []})
+    return numbers
+
+
+def claim_reserved(db, name, value):
+    """
+    Claims a name of a recorded reservation. True only the first time for a name of a range
+    handed out by reserve_range, the names handed out by next_name are never claimable.
+    """
+    number = parse_name(name, value)
+    if number is None:
+        return False
+    # atomic: of two requests claiming the same name, only one matches the $ne
+    result = db[RESERVATIONS_COLLECTION].update_one(
+        {"counter": name, "first": {"$lte": number}, "last": {"$gte": number}, "claimed": {"$ne": number}},
+        {"$push": {"claimed": number}},
+    )
+    return result.modified_count == 1
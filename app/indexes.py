@@ -0,0 +1,363 @@
+# declarative registry of the MongoDB indexes of every collection, and an index advisor
+#
+# the indexes are created by the `apply-indexes` CLI command (run once per deployment, see the
+# Dockerfile), not by every worker at startup. Only the REQUIRED_INDEXES, which the app relies on
+# to be correct rather than fast, are also ensured by create_app. `index-status` lists the missing and the unlisted
+# indexes, and `index-advisor` replays the query shapes of the app with explain() and reports
+# the ones that would scan a whole collection.
+
+import datetime
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from module_summaries import module_summary_pipeline
+
+
+def _index(keys, **options):
+    """IndexModel with a name derived from the keys, as create_index does."""
+    if isinstance(keys, str):
+        keys = [(keys, ASCENDING)]
+    return IndexModel(keys, name="_".join(f"{field}_{direction}" for field, direction in keys), **options)
+
+
+# collection -> indexes
+INDEXES = {
+    "modules": [
+        _index("moduleName"),
+        # hwId is optional
+        _index("hwId", sparse=True),
+        _index([("status", ASCENDING), ("details.LOCATION", ASCENDING)]),
+    ],
+    "sessions": [
+        # the session numbers come from an atomic counter, the index guarantees they are never reused
+        _index("sessionName", unique=True),
+    ],
+    "test_runs": [
+        _index("test_runName"),
+        _index([("runSession", ASCENDING), ("runDate", ASCENDING)]),
+        _index("runDate"),
+        _index("runType"),
+    ],
+    "module_tests": [
+        _index("moduleTestName"),
+        _index("test_runName"),
+        _index("moduleName"),
+        _index("_test_run_id"),
+    ],
+    "module_test_analysis": [
+        _index("moduleTestAnalysisName"),
+        _index("moduleTestName"),
+    ],
+    "burnin_cycles": [
+        _index("BurninCycleName"),
+        _index("BurninCycleModules"),
+        _index("BurninCycleDate"),
+    ],
+    "iv_scans": [
+        _index("IVScanId"),
+        _index("nameLabel"),
+        # IV analytics of the scans of a session
+        _index("sessionName"),
+    ],
+    "cables": [
+        _index("name"),
+    ],
+    "cable_templates": [
+        _index("type"),
+    ],
+    "crates": [
+        _index("name"),
+    ],
+    "logbook": [
+        _index("involved_modules"),
+        _index("timestamp"),
+        # the entries still referencing an attachment of the content-addressed store
+        _index("attachment_digests"),
+        # the search box of the logbook (/searchLogBook), matches in the event rank first
+        _index(
+            [("event", TEXT), ("details", TEXT), ("involved_modules", TEXT)],
+            weights={"event": 5, "involved_modules": 3, "details": 1},
+        ),
+    ],
+    "metadata": [
+        _index("name"),
+    ],
+    # the ranges of names reserved by the clients, see counters.py
+    "counter_reservations": [
+        _index([("counter", ASCENDING), ("first", ASCENDING)]),
+    ],
+    # materialized cabling paths (materialize-cabling-paths, then rewritten by the cabling endpoints)
+    "connection_snapshot": [
+        # the documents of the module lines rewritten by a connect or a disconnect
+        _index([("module", ASCENDING), ("line", ASCENDING)]),
+        _index("First"),
+        _index("Last"),
+        _index("Chain"),
+    ],
+    # IV trend points (a time-series collection, created by ensure_trends_collection in apply-indexes)
+    "iv_trends": [
+        _index([("meta.nameLabel", ASCENDING), ("date", ASCENDING)]),
+        # the point of a scan, rewritten on every write of the scan
+        _index("meta.IVScanId"),
+    ],
+    # burn-in cycle timeline, one entry per (cycle, module), see burnin_timeline.py
+    "burnin_timeline": [
+        _index([("moduleName", ASCENDING), ("start", ASCENDING)]),
+        # the modules in the chamber at a time: the entries ending after it are the recent ones
+        _index([("end", ASCENDING), ("start", ASCENDING)]),
+        _index("cycle_id"),
+        # the cycles of a session in the testing flow
+        _index("BurninCycleName"),
+    ],
+    "module_summaries": [
+        _index("moduleName"),
+        # used to find the summaries made stale by a write on the related collections
+        _index("tests.name"),
+        _index("tests.details.test_runName"),
+        _index("tests.details.analysesList"),
+        _index("tests.run.runSession"),
+    ],
+}
+
+
+def _keys(index):
+    """
+    The keys of an index (a list_indexes entry or an IndexModel document) as a tuple. The server
+    stores a text index as {"_fts": "text", "_ftsx": 1} with the fields in its weights: they
+    are turned back into (field, "text") pairs, in a stable order.
+    """
+    keys = tuple(index["key"].items())
+    if ("_fts", "text") in keys:
+        fields = index.get("weights") or {}
+        keys = tuple(key for key in keys if key[0] not in ("_fts", "_ftsx")) + tuple((field, TEXT) for field in sorted(fields))
+    elif TEXT in index["key"].values():
+        keys = tuple(key for key in keys if key[1] != TEXT) + tuple(sorted(key for key in keys if key[1] == TEXT))
+    return keys
+
+
+def _same_options(existing, model):
+    wanted = model.document
+    if "weights" in wanted and existing.get("weights") != wanted["weights"]:
+        return False
+    return all(bool(existing.get(option)) == bool(wanted.get(option)) for option in ("unique", "sparse"))
+
+
+def _duplicates(collection, model):
+    """One set of key values shared by several documents, which a unique index would reject, None if there is none."""
+    fields = [field for field, _ in model.document["key"].items()]
+    pipeline = []
+    if model.document.get("sparse"):
+        pipeline.append({"$match": {field: {"$exists": True} for field in fields}})
+    pipeline += [
+        {"$group": {"_id": {field.replace(".", "_"): f"${field}" for field in fields}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 1},
+    ]
+    return next(collection.aggregate(pipeline, allowDiskUse=True), None)
+
+
+def _restore(collection, info):
+    """Recreates a dropped index from its list_indexes entry."""
+    options = {option: value for option, value in info.items() if option not in ("key", "v", "ns")}
+    collection.create_indexes([IndexModel(list(_keys(info)), **options)])
+
+
+def _replace_index(collection, info, model):
+    """
+    Replaces an index by one on the same keys with other options. The server cannot hold both
+    at once, so the old one is dropped first, and recreated if the new one cannot be built.
+
+    Returns:
+        None, or the error that left the old index in place
+    """
+    if model.document.get("unique"):
+        duplicate = _duplicates(collection, model)
+        if duplicate is not None:
+            return f"{duplicate['count']} documents share the key {duplicate['_id']}, the existing index is kept"
+    collection.drop_index(info["name"])
+    try:
+        collection.create_indexes([model])
+    except OperationFailure as e:
+        # e.g. a duplicate written since the check
+        _restore(collection, info)
+        return f"{e}, the existing index is kept"
+    return None
+
+
+def apply_indexes(db, collections=None):
+    """
+    Creates the indexes of the registry, with one createIndexes command per collection.
+    An existing index on the same keys with different options (e.g. not unique) is replaced,
+    unless the new one cannot be built: the old one is then kept, and the error reported.
+
+    Returns:
+        ({collection: names of the indexes created or replaced}, {collection: {name: error}})
+    """
+    applied = {}
+    failed = {}
+    for collection in collections or INDEXES:
+        existing = {
+            _keys(info): info
+            for info in db[collection].list_indexes()
+        }
+        to_create = []
+        for model in INDEXES[collection]:
+            keys = _keys(model.document)
+            info = existing.get(keys)
+            if info is not None and _same_options(info, model):
+                continue
+            if info is not None:
+                # create_index fails if an index with the same keys and other options exists
+                error = _replace_index(db[collection], info, model)
+                if error is None:
+                    applied.setdefault(collection, []).append(model.document["name"])
+                else:
+                    failed.setdefault(collection, {})[model.document["name"]] = error
+                continue
+            to_create.append(model)
+        if to_create:
+            try:
+                applied.setdefault(collection, []).extend(db[collection].create_indexes(to_create))
+            except OperationFailure as e:
+                failed.setdefault(collection, {}).update({model.document["name"]: str(e) for model in to_create})
+    return applied, failed
+
+
+# the collections whose indexes are needed for the app to behave correctly: the unique sessionName,
+# and the text index without which /searchLogBook fails
+REQUIRED_INDEXES = ("sessions", "logbook")
+
+
+def ensure_required_indexes(db):
+    """
+    apply_indexes on the REQUIRED_INDEXES collections, for the deployments that do not run
+    apply-indexes (flask run, the tests). One list_indexes per collection when they exist.
+
+    Returns:
+        the failures, as apply_indexes
+    """
+    return apply_indexes(db, REQUIRED_INDEXES)[1]
+
+
+def index_status(db):
+    """
+    Compares the indexes of the database with the registry.
+
+    Returns:
+        {collection: {"missing": [names], "unlisted": [names]}} for the collections that differ
+    """
+    status = {}
+    for collection, models in INDEXES.items():
+        existing = {_keys(info): info for info in db[collection].list_indexes()}
+        declared = {_keys(model.document): model for model in models}
+        missing = [
+            model.document["name"]
+            for keys, model in declared.items()
+            if keys not in existing or not _same_options(existing[keys], model)
+        ]
+        unlisted = [info["name"] for keys, info in existing.items() if keys not in declared and keys != (("_id", 1),)]
+        if missing or unlisted:
+            status[collection] = {"missing": missing, "unlisted": unlisted}
+    return status
+
+
+# the query shapes of the app, replayed by the advisor: (collection, description, find filter or pipeline, sort)
+# the values do not matter to the query planner, only the fields
+QUERY_SHAPES = [
+    ("modules", "GET /modules/<moduleName>", {"moduleName": "PS_1"}, None),
+    ("modules", "GET /modules/<hwId>", {"hwId": "1"}, None),
+    ("modules", "/modules_on_ring", {"status": "MOUNTED", "details.LOCATION": "IT-Pisa[INFN Pisa]"}, None),
+    ("sessions", "GET /sessions/<sessionName>", {"sessionName": "session1"}, None),
+    ("test_runs", "GET /test_run/<test_runName>", {"test_runName": "run1"}, None),
+    ("test_runs", "testing flow of a session", {"runSession": "session1"}, [("runDate", ASCENDING)]),
+    ("test_runs", "runs by type", {"runType": "IV"}, [("runDate", DESCENDING)]),
+    ("module_tests", "GET /module_test/<moduleTestName>", {"moduleTestName": "PS_1__run1"}, None),
+    ("module_tests", "module tests of a module", {"moduleName": "PS_1"}, None),
+    ("module_tests", "module tests of a run", {"_test_run_id": ObjectId()}, None),
+    ("module_test_analysis", "GET /module_test_analysis/<name>", {"moduleTestAnalysisName": "PS_1__run1__V1"}, None),
+    ("burnin_cycles", "GET /burnin_cycles/<name>", {"BurninCycleName": "BC1"}, None),
+    ("burnin_cycles", "burn-in cycles of a module", {"BurninCycleModules": "PS_1"}, [("BurninCycleDate", ASCENDING)]),
+    ("iv_scans", "GET /iv_scans/<IVScanId>", {"IVScanId": "1"}, None),
+    ("iv_scans", "GET /iv_scans/<nameLabel>", {"nameLabel": "PS_1"}, None),
+    ("cables", "GET /cables/<name>", {"name": "C1"}, None),
+    ("cable_templates", "GET /cable_templates/<type>", {"type": "module"}, None),
+    ("crates", "GET /crates/<name>", {"name": "crate1"}, None),
+    ("logbook", "logbook entries of a module", {"involved_modules": "PS_1"}, None),
+    ("logbook", "entries referencing an attachment", {"attachment_digests": "0" * 64}, None),
+    ("logbook", "/searchLogBook", {"$text": {"$search": "cooling"}}, None),
+    ("metadata", "counters and generations", {"name": "metadata"}, None),
+    ("counter_reservations", "claim of a reserved name", {"counter": "session", "first": {"$lte": 1}, "last": {"$gte": 1}}, None),
+    ("iv_trends", "/iv_trends", {"meta.nameLabel": {"$in": ["PS_1"]}}, [("date", ASCENDING)]),
+    ("iv_trends", "trend point of a scan", {"meta.IVScanId": {"$in": ["IVS001"]}}, None),
+    ("burnin_timeline", "cycles of a module", {"moduleName": "PS_1", "start": {"$lte": datetime.datetime(2024, 1, 1)}}, [("start", ASCENDING)]),
+    ("burnin_timeline", "modules in the chamber", {"end": {"$gt": datetime.datetime(2024, 1, 1)}, "start": {"$lte": datetime.datetime(2024, 1, 1)}}, None),
+    ("burnin_timeline", "testing flow of a session", {"BurninCycleName": {"$regex": ".*session1.*"}}, None),
+    ("module_summaries", "/fetch_module_results", {"moduleName": "PS_1"}, None),
+    ("modules", "module summary pipeline", module_summary_pipeline({"moduleName": "PS_1"}), None),
+]
+
+
+def _plan_nodes(plan):
+    """Yields the nodes of a query plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan
+        for key in ("inputStage", "queryPlan", "winningPlan"):
+            if key in plan:
+                yield from _plan_nodes(plan[key])
+        for child in plan.get("inputStages", []):
+            yield from _plan_nodes(child)
+
+
+def _collection_scans(explain):
+    """Returns the collections scanned in full according to an explain() output of a find or an aggregate."""
+    scans = []
+    planner = explain.get("queryPlanner")
+    if planner is None and explain.get("stages"):
+        planner = explain["stages"][0].get("$cursor", {}).get("queryPlanner")
+    if planner is not None:
+        for node in _plan_nodes(planner.get("winningPlan", {})):
+            if node["stage"] == "COLLSCAN":
+                scans.append(planner.get("namespace", "").split(".", 1)[-1])
+            # a $lookup pushed down to the query engine: without an index it is a nested loop join
+            elif node["stage"] == "EQ_LOOKUP" and node.get("strategy") == "NestedLoopJoin":
+                scans.append(node.get("foreignCollection", "").split(".", 1)[-1])
+    # with executionStats, the $lookup stages report the scans of the joined collection
+    for stage in explain.get("stages", []):
+        lookup = stage.get("$lookup")
+        if lookup is not None and stage.get("collectionScans"):
+            scans.append(lookup.get("from"))
+    return scans
+
+
+def advise(db, shapes=QUERY_SHAPES):
+    """
+    Replays the query shapes with explain() and reports the ones doing a collection scan.
+
+    Returns:
+        list of {"collection", "query", "collection_scans"} for the shapes that scan a collection
+    """
+    report = []
+    for collection, description, query, sort in shapes:
+        if isinstance(query, list):
+            command = {"aggregate": collection, "pipeline": query, "cursor": {}}
+            verbosity = "executionStats"
+        else:
+            command = {"find": collection, "filter": query}
+            if sort:
+                command["sort"] = dict(sort)
+            verbosity = "queryPlanner"
+        try:
+            explain = db.command("explain", command, verbosity=verbosity)
+        except OperationFailure as e:
+            report.append({"collection": collection, "query": description, "error": str(e)})
+            continue
+        scans = _collection_scans(explain)
+        if scans:
+            report.append({"collection": collection, "query": description, "collection_scans": scans})
+    return report
@@ -0,0 +1,302 @@
+# figures of merit of the IV scans, computed in batch over many scans at once
+#
+# the curves of the selected scans are stacked into 2D numpy arrays (one row per scan, padded with
+# NaN) and every figure is computed for all the rows with array operations:
+# - I_vop: the current at the operating voltage, interpolated on the ramp up
+# - I_vop_norm: the same, scaled to the reference temperature from the temperature of the scan
+#   (averageTemperature, or the mean of TEMP_DEGC) with the usual silicon bulk current scaling
+# - V_breakdown: the first voltage of the ramp up where the log-derivative d ln|I| / d ln|V|
+#   exceeds the threshold
+# - hysteresis: the relative difference of the currents at the operating voltage on the ramp
+#   down and on the ramp up, for the scans with a ramp down
+# The voltages and currents are taken in absolute value: the sensors are reverse biased.
+# The figures are cached in the ivAnalysis field of the scans, with the parameters they were
+# computed with, and recomputed when the parameters change or the curves are updated.
+# The default parameters of a deployment are set with IV_OPERATING_VOLTAGE, IV_BREAKDOWN_THRESHOLD,
+# IV_BREAKDOWN_MIN_VOLTAGE and IV_REFERENCE_TEMPERATURE.
+
+import math
+import os
+import sys
+
+import numpy as np
+from pymongo import UpdateOne
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from iv_curves import unpack_scan
+
+ANALYSIS_FIELD = "ivAnalysis"
+FIGURES = ("I_vop", "I_vop_norm", "V_breakdown", "hysteresis")
+# silicon band gap (eV) and Boltzmann constant (eV/K) of the temperature scaling of the current
+BAND_GAP = 1.21
+BOLTZMANN = 8.617333e-5
+DEFAULT_PARAMETERS = {
+    # |V| of the operating point
+    "vop": 300.0,
+    # log-derivative threshold of the breakdown
+    "breakdown_threshold": 4.0,
+    # the breakdown is not searched below this |V|, where the curves are noisy
+    "breakdown_min_voltage": 20.0,
+    # °C
+    "reference_temperature": 20.0,
+}
+# number of scans whose curves are loaded and stacked at once by analyze_scans
+ANALYSIS_BATCH_SIZE = 500
+
+
+class AnalyticsQueryError(ValueError):
+    """Raised when the body of an IV analytics query is not valid."""
+
+
+def stack_curves(scans, names=("VOLTS", "CURRNT_NAMP")):
+    """
+    Stacks the curves of the unpacked scans into one (scans x points) float array per name,
+    padded with NaN, and returns them with the number of points of each scan.
+    """
+    lengths = np.array([len(scan.get("data", {}).get(names[0], ())) for scan in scans], dtype=np.intp)
+    width = int(lengths.max()) if len(scans) else 0
+    stacked = {}
+    for name in names:
+        array = np.full((len(scans), width), np.nan)
+        for row, scan in enumerate(scans):
+            values = np.asarray(scan.get("data", {}).get(name, ()), dtype=float)
+            n = min(len(values), lengths[row])
+            array[row, :n] = values[:n]
+        stacked[name] = array
+    return stacked, lengths
+
+
+def _crossing(volts, current, mask, vop, rising):
+    """
+    The current of each row interpolated at |V| = vop, at the first point of the mask reaching
+    vop (rising: |V| >= vop, else |V| <= vop). NaN for the rows that do not reach it.
+    """
+    reached = mask & ((volts >= vop) if rising else (volts <= vop))
+    found = reached.any(axis=1)
+    j = np.argmax(reached, axis=1)
+    # the previous point, in the same ramp
+    i = np.where(mask[np.arange(len(j)), np.maximum(j - 1, 0)], np.maximum(j - 1, 0), j)
+    v0, v1 = np.take_along_axis(volts, i[:, None], 1)[:, 0], np.take_along_axis(volts, j[:, None], 1)[:, 0]
+    c0, c1 = np.take_along_axis(current, i[:, None], 1)[:, 0], np.take_along_axis(current, j[:, None], 1)[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(v1 != v0, (vop - v0) / (v1 - v0), 1.0)
+    return np.where(found, c0 + t * (c1 - c0), np.nan)
+
+
+def scale_current(current, temperature, reference_temperature):
+    """Scales currents measured at temperature (°C) to the reference temperature (°C)."""
+    t = np.asarray(temperature, dtype=float) + 273.15
+    t_ref = reference_temperature + 273.15
+    return current * (t_ref / t) ** 2 * np.exp(-BAND_GAP / (2 * BOLTZMANN) * (1 / t_ref - 1 / t))
+
+
+def _scan_averages(scans, average_field, curve_name):
+    averages = []
+    for scan in scans:
+        average = scan.get(average_field)
+        if average is None:
+            curve = np.asarray(scan.get("data", {}).get(curve_name, ()), dtype=float)
+            average = float(np.nanmean(curve)) if curve.size else math.nan
+        averages.append(average)
+    return np.array(averages, dtype=float)
+
+
+def scan_temperatures(scans):
+    """averageTemperature of each scan, or the mean of its TEMP_DEGC curve, NaN without either."""
+    return _scan_averages(scans, "averageTemperature", "TEMP_DEGC")
+
+
+def scan_humidities(scans):
+    """averageHumidity of each scan, or the mean of its RH_PRCNT curve, NaN without either."""
+    return _scan_averages(scans, "averageHumidity", "RH_PRCNT")
+
+
+def prepare_curves(scans):
+    """
+    The stacked |V| and |I| of the unpacked scans, with the masks of their ramp up (up to the
+    highest |V| of each scan) and ramp down (from it), or None if the scans have no points.
+    """
+    stacked, lengths = stack_curves(scans)
+    volts, current = np.abs(stacked["VOLTS"]), np.abs(stacked["CURRNT_NAMP"])
+    if volts.shape[1] == 0:
+        return None
+    columns = np.arange(volts.shape[1])
+    valid = (columns < lengths[:, None]) & ~np.isnan(volts) & ~np.isnan(current)
+    peak = np.argmax(np.where(valid, volts, -np.inf), axis=1)
+    return {
+        "volts": volts,
+        "current": current,
+        "up": valid & (columns <= peak[:, None]),
+        "down": valid & (columns >= peak[:, None]),
+    }
+
+
+def currents_at(scans, voltages):
+    """The |I| of the unpacked scans at each of the |V| voltages on the ramp up, as a (scans x voltages) array."""
+    curves = prepare_curves(scans) if scans else None
+    if curves is None:
+        return np.full((len(scans), len(voltages)), np.nan)
+    return np.stack(
+        [_crossing(curves["volts"], curves["current"], curves["up"], voltage, rising=True) for voltage in voltages], axis=1
+    )
+
+
+def compute_figures(scans, parameters=None):
+    """
+    Computes the figures of merit of the unpacked scans in batch.
+
+    Returns:
+        one {figure: value or None} dict per scan, in order
+    """
+    parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+    if not scans:
+        return []
+    curves = prepare_curves(scans)
+    if curves is None:
+        return [dict.fromkeys(FIGURES) for _ in scans]
+    volts, current, up, down = curves["volts"], curves["current"], curves["up"], curves["down"]
+    vop = parameters["vop"]
+
+    i_vop = _crossing(volts, current, up, vop, rising=True)
+    i_vop_norm = scale_current(i_vop, scan_temperatures(scans), parameters["reference_temperature"])
+
+    # log-derivative between consecutive points of the ramp up
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_v, log_i = np.log(volts), np.log(current)
+        k = np.diff(log_i, axis=1) / np.diff(log_v, axis=1)
+    steps = up[:, 1:] & up[:, :-1] & (volts[:, 1:] > volts[:, :-1]) & (volts[:, 1:] >= parameters["breakdown_min_voltage"])
+    breakdown = steps & np.isfinite(k) & (k > parameters["breakdown_threshold"])
+    has_breakdown = breakdown.any(axis=1)
+    v_breakdown = np.where(
+        has_breakdown, np.take_along_axis(volts, np.argmax(breakdown, axis=1)[:, None], 1)[:, 0], np.nan
+    )
+
+    # the ramp down starts after the peak: a scan without it has only the peak in down
+    has_down = down.sum(axis=1) > 1
+    i_vop_down = _crossing(volts, current, down, vop, rising=False)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hysteresis = np.where(has_down, (i_vop_down - i_vop) / i_vop, np.nan)
+
+    figures = np.stack([i_vop, i_vop_norm, v_breakdown, hysteresis], axis=1)
+    return [
+        {name: (float(value) if np.isfinite(value) else None) for name, value in zip(FIGURES, row)}
+        for row in figures
+    ]
+
+
+def analyze_scans(collection, query, parameters=None, batch_size=ANALYSIS_BATCH_SIZE):
+    """
+    The figures of merit of the scans matching the query. The ones cached with the same
+    parameters are read without the curves, the others are computed and cached in batches of
+    batch_size scans, so that only the curves of one batch are in memory at a time.
+
+    Returns:
+        the scans (without data) with their ANALYSIS_FIELD
+    """
+    parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+    scans = list(collection.find(query, {"data": 0}))
+    stale = [scan["_id"] for scan in scans if (scan.get(ANALYSIS_FIELD) or {}).get("parameters") != parameters]
+    results = {}
+    for start in range(0, len(stale), batch_size):
+        to_compute = [unpack_scan(scan) for scan in collection.find({"_id": {"$in": stale[start:start + batch_size]}})]
+        updates = []
+        for scan, figures in zip(to_compute, compute_figures(to_compute, parameters)):
+            analysis = dict(figures, parameters=parameters)
+            results[scan["_id"]] = analysis
+            updates.append(UpdateOne({"_id": scan["_id"]}, {"$set": {ANALYSIS_FIELD: analysis}}))
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+    for scan in scans:
+        if scan["_id"] in results:
+            scan[ANALYSIS_FIELD] = results[scan["_id"]]
+    return scans
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_analytics_query(data):
+    """
+    Parses the body of an IV analytics query.
+
+    Body (all optional):
+    - modules: nameLabels of the modules, sessions: sessionNames, IVScanIds: scan ids
+    - parameters: overrides of DEFAULT_PARAMETERS
+    - latest: only the most recent scan of each module (default true)
+    - sort: figure to rank by (default I_vop_norm), order: asc (default) or desc
+    - ranges: {figure: {"min": x, "max": y}} to keep
+    - limit: maximum number of results
+
+    Returns:
+        dict with the "query", "parameters", "latest", "sort", "descending", "ranges" and "limit"
+    """
+    if not isinstance(data, dict):
+        raise AnalyticsQueryError("Invalid input, expected a JSON object")
+    query = {}
+    for key, field in (("modules", "nameLabel"), ("sessions", "sessionName"), ("IVScanIds", "IVScanId")):
+        if key in data:
+            if not isinstance(data[key], list):
+                raise AnalyticsQueryError(f"{key} should be a list")
+            query[field] = {"$in": data[key]}
+    parameters = data.get("parameters", {})
+    if not isinstance(parameters, dict) or any(key not in DEFAULT_PARAMETERS for key in parameters):
+        raise AnalyticsQueryError(f"parameters should be an object with keys among {', '.join(DEFAULT_PARAMETERS)}")
+    if not all(isinstance(value, (int, float)) for value in parameters.values()):
+        raise AnalyticsQueryError("parameters should be numbers")
+    sort = data.get("sort", "I_vop_norm")
+    if sort not in FIGURES:
+        raise AnalyticsQueryError(f"sort should be one of {', '.join(FIGURES)}")
+    order = data.get("order", "asc")
+    if order not in ("asc", "desc"):
+        raise AnalyticsQueryError("order should be asc or desc")
+    ranges = data.get("ranges", {})
+    if not isinstance(ranges, dict) or any(key not in FIGURES or not isinstance(value, dict) for key, value in ranges.items()):
+        raise AnalyticsQueryError(f"ranges should map figures among {', '.join(FIGURES)} to {{min, max}}")
+    for figure, bounds in ranges.items():
+        if any(key not in ("min", "max") or not _is_number(value) for key, value in bounds.items()):
+            raise AnalyticsQueryError(f"ranges.{figure} should have a numeric min and/or max")
+    latest = data.get("latest", True)
+    if not isinstance(latest, bool):
+        raise AnalyticsQueryError("latest should be true or false")
+    limit = data.get("limit")
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        raise AnalyticsQueryError("limit should be a positive integer")
+    return {
+        "query": query,
+        "parameters": {key: float(value) for key, value in parameters.items()},
+        "latest": latest,
+        "sort": sort,
+        "descending": order == "desc",
+        "ranges": ranges,
+        "limit": limit,
+    }
+
+
+def rank_scans(scans, sort, descending=False, ranges=None, latest=True, limit=None):
+    """
+    Flattens the analyzed scans into result rows, keeps the latest scan of each module (by date)
+    if latest, filters them by the ranges of the figures and sorts them, the missing values last.
+    """
+    if latest:
+        by_module = {}
+        for scan in scans:
+            current = by_module.get(scan.get("nameLabel"))
+            if current is None or str(scan.get("date", "")) > str(current.get("date", "")):
+                by_module[scan.get("nameLabel")] = scan
+        scans = list(by_module.values())
+    rows = []
+    for scan in scans:
+        analysis = scan.get(ANALYSIS_FIELD) or {}
+        row = {key: scan.get(key) for key in ("IVScanId", "nameLabel", "sessionName", "date", "averageTemperature")}
+        row.update({figure: analysis.get(figure) for figure in FIGURES})
+        keep = True
+        for figure, bounds in (ranges or {}).items():
+            value = row[figure]
+            if value is None or ("min" in bounds and value < bounds["min"]) or ("max" in bounds and value > bounds["max"]):
+                keep = False
+        if keep:
+            rows.append(row)
+    present = sorted((row for row in rows if row[sort] is not None), key=lambda row: row[sort], reverse=descending)
+    rows = present + [row for row in rows if row[sort] is None]
+    return rows[:limit] if limit else rows
@@ -0,0 +1,181 @@
+# compact storage of the IV scan curves, and their downsampling for the plots
+#
+# an IV scan keeps one array per quantity in data (VOLTS, CURRNT_NAMP, TEMP_DEGC, RH_PRCNT, and
+# the TIME strings). As BSON arrays every double costs 9 bytes plus its index as a key. With
+# IV_STORAGE=binary the numeric curves are stored as typed blobs instead,
+#   data.VOLTS = {"dtype": "<f8", "shape": [n], "values": BinData(...)}
+# (IV_BINARY_DTYPE=float32 halves them again), and decoded without a copy with numpy.frombuffer.
+# The responses always carry plain arrays: the packed and the array documents read the same.
+# The GETs take ?points=N to downsample the curves (LTTB by default, or min-max with
+# ?downsample=minmax), keeping the same points of every per-point array.
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import UpdateOne
+
+# the numeric per-point arrays of an IV scan, packed in binary mode
+CURVES = ("VOLTS", "CURRNT_NAMP", "TEMP_DEGC", "RH_PRCNT")
+# the curves used to pick the points kept by the downsampling
+X_CURVE = "VOLTS"
+Y_CURVE = "CURRNT_NAMP"
+DTYPES = {"float64": "<f8", "float32": "<f4"}
+DOWNSAMPLING = ("lttb", "minmax")
+
+
+class CurveQueryError(ValueError):
+    """Raised when the downsampling args of an IV scan GET are not valid."""
+
+
+def is_packed(value):
+    return isinstance(value, dict) and "dtype" in value and "values" in value
+
+
+def pack_curve(values, dtype="float64"):
+    """The typed blob of a numeric array, with its dtype and shape."""
+    array = np.asarray(values, dtype=DTYPES[dtype])
+    return {"dtype": array.dtype.str, "shape": list(array.shape), "values": Binary(array.tobytes())}
+
+
+def unpack_curve(value):
+    """The numpy array of a packed curve, a read-only view on the BSON bytes."""
+    return np.frombuffer(value["values"], dtype=np.dtype(value["dtype"])).reshape(value["shape"])
+
+
+def pack_scan(scan, dtype="float64"):
+    """Packs the numeric curves of the data of an IV scan in place, returns the scan."""
+    data = scan.get("data")
+    if isinstance(data, dict):
+        for name in CURVES:
+            if isinstance(data.get(name), list):
+                data[name] = pack_curve(data[name], dtype)
+    return scan
+
+
+def unpack_scan(scan):
+    """Replaces the packed curves of an IV scan (in place) with numpy arrays, returns the scan."""
+    data = scan.get("data")
+    if isinstance(data, dict):
+        for name, value in data.items():
+            if is_packed(value):
+                data[name] = unpack_curve(value)
+    return scan
+
+
+def lttb_indices(x, y, points):
+    """
+    The indices of the points kept by Largest-Triangle-Three-Buckets: the first and the last
+    points, and in each of the points - 2 buckets in between the one making the largest triangle
+    with the point kept in the previous bucket and the average of the next bucket.
+    """
+    size = len(y)
+    if points >= size:
+        return np.arange(size)
+    if points < 3:
+        return np.array([0, size - 1])[:points]
+    edges = np.linspace(1, size - 1, points - 1).astype(np.intp)
+    indices = np.empty(points, dtype=np.intp)
+    indices[0], indices[-1] = 0, size - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else size
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, points):
+    """The indices of the minimum and the maximum of each of points / 2 buckets, in order."""
+    size = len(y)
+    if points >= size:
+        return np.arange(size)
+    buckets = max(1, points // 2)
+    edges = np.linspace(0, size, buckets + 1).astype(np.intp)
+    kept = set()
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            kept.add(start + int(np.argmin(y[start:end])))
+            kept.add(start + int(np.argmax(y[start:end])))
+    return np.array(sorted(kept), dtype=np.intp)
+
+
+def downsample_scan(scan, points, method="lttb"):
+    """
+    Keeps about points points of the curves of an unpacked IV scan (in place), the same ones in
+    every per-point array of its data. Returns the scan.
+    """
+    data = scan.get("data")
+    if not isinstance(data, dict) or Y_CURVE not in data:
+        return scan
+    y = np.asarray(data[Y_CURVE], dtype=float)
+    size = len(y)
+    if points >= size:
+        return scan
+    if method == "minmax":
+        indices = minmax_indices(y, points)
+    else:
+        x = np.asarray(data[X_CURVE], dtype=float) if len(data.get(X_CURVE, ())) == size else np.arange(size, dtype=float)
+        indices = lttb_indices(x, y, points)
+    for name, value in data.items():
+        if isinstance(value, np.ndarray) and len(value) == size:
+            data[name] = value[indices]
+        elif isinstance(value, list) and len(value) == size:
+            data[name] = [value[i] for i in indices]
+    return scan
+
+
+def parse_curve_args(args):
+    """
+    Parses the downsampling query args of the IV scan GETs.
+
+    Query parameters:
+    - points: maximum number of points of each curve (optional, default: all of them)
+    - downsample: lttb (default) or minmax
+
+    Returns:
+        (points or None, method)
+    """
+    points = args.get("points")
+    if points is not None:
+        try:
+            points = int(points)
+        except ValueError:
+            raise CurveQueryError("points should be an integer")
+        if points < 2:
+            raise CurveQueryError("points should be at least 2")
+    method = args.get("downsample", "lttb").lower()
+    if method not in DOWNSAMPLING:
+        raise CurveQueryError(f"downsample should be one of {', '.join(DOWNSAMPLING)}")
+    return points, method
+
+
+def scan_reader(points=None, method="lttb"):
+    """The function turning an IV scan read from MongoDB into the one of the responses."""
+
+    def read(scan):
+        unpack_scan(scan)
+        if points is not None:
+            downsample_scan(scan, points, method)
+        return scan
+
+    return read
+
+
+def pack_collection(collection, dtype="float64", batch_size=500):
+    """Packs the curves of the IV scans still stored as arrays, returns the number of scans packed."""
+    query = {"$or": [{f"data.{name}": {"$type": "array"}} for name in CURVES]}
+    projection = {f"data.{name}": 1 for name in CURVES}
+    packed = 0
+    batch = []
+    for scan in collection.find(query, projection).batch_size(batch_size):
+        pack_scan(scan, dtype)
+        update = {f"data.{name}": value for name, value in scan["data"].items() if is_packed(value)}
+        batch.append(UpdateOne({"_id": scan["_id"]}, {"$set": update}))
+        if len(batch) == batch_size:
+            packed += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        packed += collection.bulk_write(batch, ordered=False).modified_count
+    return packed
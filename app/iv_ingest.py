@@ -0,0 +1,124 @@
+# bulk ingestion of IV scans: the sessions of the probe station and the backfills of past campaigns
+#
+# the scans are taken in batches of INGEST_BATCH_SIZE (from a JSON list, or streamed from an NDJSON
+# body one line at a time), and each batch costs two round trips: one find with $in on the
+# IVScanIds of the batch, and one insert_many(ordered=False) (or a bulk_write of upserts).
+# Every scan is validated with the compiled validator, and gets a status in the report:
+#   inserted, updated (upsert mode), exists (insert mode), duplicate (an IVScanId repeated in
+#   the request), invalid (JSON or schema) or error (rejected by MongoDB).
+
+import json
+import os
+import sys
+from itertools import islice
+
+from jsonschema import ValidationError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from validation import validate_entry
+from iv_curves import pack_scan
+
+INGEST_BATCH_SIZE = 500
+INGEST_MODES = ("insert", "upsert")
+
+
+def read_ndjson(lines):
+    """Yields the scans of NDJSON lines (bytes or str), or the ValueError of a line that is not JSON."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON: {e}")
+
+
+def _ingest_batch(collection, batch, start, seen, upsert, dtype, touched):
+    results = [None] * len(batch)
+    valid = {}
+    for offset, scan in enumerate(batch):
+        result = results[offset] = {"index": start + offset}
+        if isinstance(scan, Exception):
+            result.update(status="invalid", error=str(scan))
+            continue
+        if isinstance(scan, dict) and "IVScanId" in scan:
+            result["IVScanId"] = scan["IVScanId"]
+        try:
+            validate_entry(scan, "IVScans")
+        except ValidationError as e:
+            result.update(status="invalid", error=e.message)
+            continue
+        if scan["IVScanId"] in seen:
+            result.update(status="duplicate", error="IVScanId repeated in the request")
+            continue
+        seen.add(scan["IVScanId"])
+        valid[offset] = pack_scan(scan, dtype) if dtype else scan
+
+    if not valid:
+        return results
+    existing = set(collection.distinct("IVScanId", {"IVScanId": {"$in": [scan["IVScanId"] for scan in valid.values()]}}))
+    if upsert:
+        offsets = list(valid)
+        requests = [ReplaceOne({"IVScanId": valid[offset]["IVScanId"]}, valid[offset], upsert=True) for offset in offsets]
+    else:
+        for offset, scan in list(valid.items()):
+            if scan["IVScanId"] in existing:
+                results[offset]["status"] = "exists"
+                del valid[offset]
+        offsets = list(valid)
+        requests = [valid[offset] for offset in offsets]
+    if not requests:
+        return results
+
+    failed = {}
+    try:
+        if upsert:
+            collection.bulk_write(requests, ordered=False)
+        else:
+            collection.insert_many(requests, ordered=False)
+    except BulkWriteError as e:
+        failed = {error["index"]: error["errmsg"] for error in e.details.get("writeErrors", [])}
+    for position, offset in enumerate(offsets):
+        if position in failed:
+            results[offset].update(status="error", error=failed[position])
+        elif upsert and valid[offset]["IVScanId"] in existing:
+            results[offset]["status"] = "updated"
+        else:
+            results[offset]["status"] = "inserted"
+        if results[offset]["status"] != "error":
+            touched.add(valid[offset]["IVScanId"])
+    return results
+
+
+def ingest_scans(collection, scans, mode="insert", dtype=None, batch_size=INGEST_BATCH_SIZE, touched=None):
+    """
+    Validates and writes the scans (an iterable of documents, or exceptions for the ones that
+    could not be parsed) in batches. dtype packs the curves, as with IV_STORAGE=binary.
+    The IVScanId of the scans written are added to the touched set if given.
+
+    Returns:
+        the report: {"inserted", "updated", "failed", "results": [{"index", "IVScanId", "status", "error"}]}
+    """
+    upsert = mode == "upsert"
+    scans = iter(scans)
+    seen = set()
+    touched = set() if touched is None else touched
+    results = []
+    while True:
+        batch = list(islice(scans, batch_size))
+        if not batch:
+            break
+        results += _ingest_batch(collection, batch, len(results), seen, upsert, dtype, touched)
+    counts = {status: 0 for status in ("inserted", "updated")}
+    for result in results:
+        if result["status"] in counts:
+            counts[result["status"]] += 1
+    return {
+        "inserted": counts["inserted"],
+        "updated": counts["updated"],
+        "failed": len(results) - counts["inserted"] - counts["updated"],
+        "results": results,
+    }
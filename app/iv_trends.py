@@ -0,0 +1,243 @@
+# trends of the IV scans of the modules across their sessions, from a rollup collection
+#
+# following the leakage current of a module through its sessions and burn-in cycles used to mean
+# downloading all its iv_scans, curves included. The iv_trends collection keeps one summary point
+# per scan: its date, the module, the session and the scan (the metaField), the |I| at the
+# reference voltages IV_TREND_VOLTAGES, the temperature and the humidity. It is a time-series
+# collection (MongoDB >= 5.0, a regular collection otherwise, both created by apply-indexes), and
+# the point of a scan is rewritten whenever the scan is written, so that concurrent writes of
+# other scans never touch it. POST /iv_trends then returns the series of many modules in one
+# aggregation, per scan or averaged by session, day, week or month (the last three need 5.0).
+
+import datetime
+import math
+import os
+import sys
+
+from flask import current_app
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from iv_curves import unpack_scan
+from iv_analytics import currents_at, scan_humidities, scan_temperatures
+
+TRENDS_COLLECTION = "iv_trends"
+TREND_BUCKETS = ("scan", "session", "day", "week", "month")
+# the buckets grouped with $dateTrunc, which MongoDB has since 5.0
+DATE_BUCKETS = ("day", "week", "month")
+
+# the (major, minor) version of the server of each client, read once
+_server_versions = {}
+
+
+class TrendQueryError(ValueError):
+    """Raised when the body of a trend query is not valid."""
+
+
+def voltage_key(voltage):
+    """The key of the current at a reference voltage in the points, e.g. "300"."""
+    return f"{voltage:g}"
+
+
+def parse_scan_date(value):
+    """The datetime of the date of a scan ("2024-01-15T10:00:00" or "2024-01-15 10:00:00"), None if it has none."""
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def ensure_trends_collection(db):
+    """
+    Creates the iv_trends collection, as a time-series collection when the server supports it.
+    Run by apply-indexes: the scan writes do not check for it.
+    """
+    if TRENDS_COLLECTION in db.list_collection_names(filter={"name": TRENDS_COLLECTION}):
+        return
+    try:
+        db.create_collection(
+            TRENDS_COLLECTION, timeseries={"timeField": "date", "metaField": "meta", "granularity": "hours"}
+        )
+    except CollectionInvalid:
+        # created meanwhile by another worker
+        pass
+    except OperationFailure:
+        # no time-series collections before MongoDB 5.0 (the indexes are in the registry either way)
+        db.create_collection(TRENDS_COLLECTION)
+
+
+def trend_points(scans, voltages):
+    """The trend points of the unpacked scans, the ones without a date are left out."""
+    currents = currents_at(scans, voltages)
+    temperatures = scan_temperatures(scans)
+    humidities = scan_humidities(scans)
+    points = []
+    for row, scan in enumerate(scans):
+        date = parse_scan_date(scan.get("date"))
+        if date is None:
+            continue
+        points.append({
+            "date": date,
+            "meta": {"nameLabel": scan.get("nameLabel"), "sessionName": scan.get("sessionName"), "IVScanId": scan.get("IVScanId")},
+            "runType": scan.get("runType"),
+            "current": {
+                voltage_key(voltage): float(value) for voltage, value in zip(voltages, currents[row]) if math.isfinite(value)
+            },
+            "temperature": float(temperatures[row]) if math.isfinite(temperatures[row]) else None,
+            "humidity": float(humidities[row]) if math.isfinite(humidities[row]) else None,
+        })
+    return points
+
+
+def update_trends(db, scan_ids, voltages, batch_size=500):
+    """
+    Rewrites the trend points of the scans (by IVScanId) from the scans, e.g. after a write of
+    these scans: a deleted scan loses its point. Rewriting a scan twice leaves a single point.
+    The time-series collections delete by metaField since MongoDB 5.0.
+    """
+    scan_ids = sorted({scan_id for scan_id in scan_ids if scan_id is not None})
+    trends = db[TRENDS_COLLECTION]
+    count = 0
+    for start in range(0, len(scan_ids), batch_size):
+        batch = scan_ids[start:start + batch_size]
+        trends.delete_many({"meta.IVScanId": {"$in": batch}})
+        scans = [unpack_scan(scan) for scan in db["iv_scans"].find({"IVScanId": {"$in": batch}})]
+        count += _insert_points(db, trend_points(scans, voltages))
+    return count
+
+
+def refresh_trends(db, scan_ids):
+    """update_trends with the reference voltages of the app (IV_TREND_VOLTAGES)."""
+    return update_trends(db, scan_ids, current_app.config["IV_TREND_VOLTAGES"])
+
+
+def rebuild_trends(db, voltages, batch_size=500):
+    """Rebuilds the iv_trends collection from all the scans, returns the number of points."""
+    ensure_trends_collection(db)
+    db[TRENDS_COLLECTION].delete_many({})
+    count = 0
+    batch = []
+    for scan in db["iv_scans"].find().batch_size(batch_size):
+        batch.append(unpack_scan(scan))
+        if len(batch) == batch_size:
+            count += _insert_points(db, trend_points(batch, voltages))
+            batch = []
+    if batch:
+        count += _insert_points(db, trend_points(batch, voltages))
+    return count
+
+
+def _insert_points(db, points):
+    if points:
+        db[TRENDS_COLLECTION].insert_many(points, ordered=False)
+    return len(points)
+
+
+def parse_trend_query(data, voltages):
+    """
+    Parses the body of a trend query.
+
+    Body:
+    - modules: nameLabels of the modules (required)
+    - from, to: ISO 8601 dates (optional)
+    - bucket: scan (default), session, day, week or month
+    - voltages: subset of the reference voltages (optional)
+
+    Returns:
+        dict with the "modules", "from", "to", "bucket" and "voltages"
+    """
+    if not isinstance(data, dict):
+        raise TrendQueryError("Invalid input, expected a JSON object")
+    modules = data.get("modules")
+    if not isinstance(modules, list) or not modules:
+        raise TrendQueryError("modules should be a non-empty list")
+    parsed = {"modules": modules, "bucket": data.get("bucket", "scan")}
+    if parsed["bucket"] not in TREND_BUCKETS:
+        raise TrendQueryError(f"bucket should be one of {', '.join(TREND_BUCKETS)}")
+    for key in ("from", "to"):
+        parsed[key] = None
+        if data.get(key) is not None:
+            parsed[key] = parse_scan_date(data[key])
+            if parsed[key] is None:
+                raise TrendQueryError(f"{key} should be an ISO 8601 date")
+    parsed["voltages"] = data.get("voltages", voltages)
+    if not isinstance(parsed["voltages"], list) or any(v not in voltages for v in parsed["voltages"]):
+        raise TrendQueryError(f"voltages should be among the reference voltages {voltages}")
+    return parsed
+
+
+def trends_pipeline(modules, bucket="scan", start=None, end=None, voltages=()):
+    """
+    The aggregation of the trend points of the modules: one row per point (bucket "scan"), or the
+    averages of the points of each session or each day, week or month, sorted by module and date.
+    """
+    match = {"meta.nameLabel": {"$in": modules}}
+    if start is not None or end is not None:
+        match["date"] = {}
+        if start is not None:
+            match["date"]["$gte"] = start
+        if end is not None:
+            match["date"]["$lte"] = end
+    pipeline = [{"$match": match}]
+    if bucket == "scan":
+        pipeline.append({"$project": {
+            "_id": 0,
+            "nameLabel": "$meta.nameLabel",
+            "sessionName": "$meta.sessionName",
+            "date": 1,
+            "IVScanId": "$meta.IVScanId",
+            "runType": 1,
+            "temperature": 1,
+            "humidity": 1,
+            **{f"current.{voltage_key(v)}": 1 for v in voltages},
+        }})
+    else:
+        if bucket == "session":
+            group_id = {"nameLabel": "$meta.nameLabel", "sessionName": "$meta.sessionName"}
+        else:
+            group_id = {"nameLabel": "$meta.nameLabel", "bucket": {"$dateTrunc": {"date": "$date", "unit": bucket}}}
+        pipeline += [
+            {"$group": {
+                "_id": group_id,
+                "date": {"$min": "$date"},
+                "scans": {"$sum": 1},
+                "temperature": {"$avg": "$temperature"},
+                "humidity": {"$avg": "$humidity"},
+                **{f"current_{voltage_key(v)}": {"$avg": f"$current.{voltage_key(v)}"} for v in voltages},
+            }},
+            {"$project": {
+                "_id": 0,
+                "nameLabel": "$_id.nameLabel",
+                **({"sessionName": "$_id.sessionName"} if bucket == "session" else {}),
+                "date": 1,
+                "scans": 1,
+                "temperature": 1,
+                "humidity": 1,
+                "current": {voltage_key(v): f"$current_{voltage_key(v)}" for v in voltages},
+            }},
+        ]
+    pipeline.append({"$sort": {"nameLabel": 1, "date": 1}})
+    return pipeline
+
+
+def supports_date_buckets(db):
+    """Whether the server has $dateTrunc (MongoDB >= 5.0), for the day, week and month buckets."""
+    if db.client not in _server_versions:
+        _server_versions[db.client] = tuple(db.client.server_info()["versionArray"][:2])
+    return _server_versions[db.client] >= (5, 0)
+
+
+def trend_series(db, parsed):
+    """
+    The trend points of the parsed query, as {nameLabel: [points in date order]}.
+    Raises TrendQueryError for a day, week or month bucket on a server older than MongoDB 5.0.
+    """
+    if parsed["bucket"] in DATE_BUCKETS and not supports_date_buckets(db):
+        raise TrendQueryError(f"bucket {parsed['bucket']} needs MongoDB 5.0 or later")
+    series = {module: [] for module in parsed["modules"]}
+    pipeline = trends_pipeline(parsed["modules"], parsed["bucket"], parsed["from"], parsed["to"], parsed["voltages"])
+    for point in db[TRENDS_COLLECTION].aggregate(pipeline):
+        series.setdefault(point.pop("nameLabel"), []).append(point)
+    return series
@@ -0,0 +1,141 @@
+from flask import request, current_app, Response, stream_with_context
+from bson import ObjectId
+import bson
+import pymongo
+
+# number of documents fetched from MongoDB per round trip while streaming
+STREAM_BATCH_SIZE = 500
+
+
+class ListQueryError(ValueError):
+    """Raised when the query args of a collection GET are not valid."""
+
+
+def parse_fields(args):
+    """
+    The projection of the fields query arg, None without it: the fields to return, e.g.
+    fields=moduleName,status, or the fields to leave out prefixed by -, e.g. fields=-data.
+    """
+    fields = [f.strip() for f in args.get("fields", "").split(",") if f.strip()]
+    if not fields:
+        return None
+    excluded = [f for f in fields if f.startswith("-")]
+    if excluded and len(excluded) != len(fields):
+        raise ListQueryError("fields should be all included or all excluded (prefixed by -)")
+    return {f.lstrip("-"): 0 if excluded else 1 for f in fields}
+
+
+def parse_list_args(args):
+    """
+    Parses the query args shared by all the collection GETs.
+
+    Query parameters:
+    - limit: maximum number of documents to return (optional)
+    - after: _id of the last document of the previous page, for keyset pagination (optional)
+    - fields: comma-separated list of fields to return, e.g. fields=moduleName,status, or to leave
+      out, e.g. fields=-data (optional)
+    - sort: comma-separated list of fields to sort by, prefixed by - for descending order,
+      e.g. sort=-_id (optional, default: natural order, or _id when paginating with after)
+    - format: json (default, a JSON array) or ndjson (one document per line)
+
+    Returns:
+        dict with the parsed "limit", "after", "projection", "sort" and "ndjson" entries
+    """
+    parsed = {"limit": None, "after": None, "projection": None, "sort": None, "ndjson": False}
+
+    limit = args.get("limit")
+    if limit is not None:
+        try:
+            parsed["limit"] = int(limit)
+        except ValueError:
+            raise ListQueryError("limit should be an integer")
+        if parsed["limit"] < 0:
+            raise ListQueryError("limit should be positive")
+
+    parsed["projection"] = parse_fields(args)
+
+    sort = args.get("sort")
+    if sort:
+        parsed["sort"] = []
+        for key in sort.split(","):
+            key = key.strip()
+            if not key:
+                continue
+            if key.startswith("-"):
+                parsed["sort"].append((key[1:], pymongo.DESCENDING))
+            else:
+                parsed["sort"].append((key.lstrip("+"), pymongo.ASCENDING))
+
+    after = args.get("after")
+    if after:
+        try:
+            parsed["after"] = ObjectId(after)
+        except bson.errors.InvalidId:
+            raise ListQueryError("after should be the _id of a document")
+        # keyset pagination is only consistent when the documents are sorted by _id
+        if parsed["sort"] is None:
+            parsed["sort"] = [("_id", pymongo.ASCENDING)]
+        elif [key for key, _ in parsed["sort"]] != ["_id"]:
+            raise ListQueryError("after can only be used when sorting by _id")
+
+    output_format = args.get("format")
+    if output_format is None:
+        # no explicit format: honour the Accept header
+        output_format = "ndjson" if request.accept_mimetypes.best == "application/x-ndjson" else "json"
+    if output_format.lower() not in ["json", "ndjson"]:
+        raise ListQueryError("format should be json or ndjson")
+    parsed["ndjson"] = output_format.lower() == "ndjson"
+    return parsed
+
+
+def find_list(collection, parsed, query=None):
+    """Builds the pymongo cursor for the parsed collection GET args."""
+    query = dict(query or {})
+    if parsed["after"] is not None:
+        direction = parsed["sort"][0][1]
+        query["_id"] = {"$gt" if direction == pymongo.ASCENDING else "$lt": parsed["after"]}
+    cursor = collection.find(query, parsed["projection"]).batch_size(STREAM_BATCH_SIZE)
+    if parsed["sort"]:
+        cursor = cursor.sort(parsed["sort"])
+    if parsed["limit"]:
+        cursor = cursor.limit(parsed["limit"])
+    return cursor
+
+
+def stream_documents(cursor, ndjson=False, transform=None):
+    """
+    Streams the documents of a cursor as a chunked JSON array (or NDJSON), encoding
+    one document at a time, so the whole collection is never held in memory.
+    transform, if given, is applied to each document before it is encoded.
+    """
+    dumpb = current_app.json.dumpb
+    if transform is not None:
+        cursor = map(transform, cursor)
+    if ndjson:
+        for document in cursor:
+            yield dumpb(document) + b"\n"
+        return
+    yield b"["
+    first = True
+    for document in cursor:
+        if first:
+            first = False
+            yield dumpb(document)
+        else:
+            yield b"," + dumpb(document)
+    yield b"]"
+
+
+def list_collection(collection, query=None, transform=None):
+    """
+    Returns a streamed response with the documents of the collection matching the query,
+    paginated and projected according to the request args (see parse_list_args), and
+    passed through transform (e.g. to decode them) if given.
+    """
+    try:
+        parsed = parse_list_args(request.args)
+    except ListQueryError as e:
+        return {"message": str(e)}, 400
+    cursor = find_list(collection, parsed, query)
+    mimetype = "application/x-ndjson" if parsed["ndjson"] else "application/json"
+    return Response(stream_with_context(stream_documents(cursor, parsed["ndjson"], transform)), mimetype=mimetype)
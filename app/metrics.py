@@ -0,0 +1,258 @@
+# request latency and MongoDB command instrumentation, exposed in Prometheus text format at /metrics
+#
+# the before/after request hooks time every request by route (the url rule, not the url, to keep
+# the number of series bounded), and a pymongo CommandListener times every command by command
+# name and collection. pymongo runs the listener in the thread that issued the command, so the
+# commands are also attributed to the request being served by the thread: this gives the
+# database time spent by each route, and the pipelines that ran for the slow-request log.
+# The metrics are kept in memory and refer to the worker process that serves /metrics.
+
+from collections import defaultdict
+import logging
+import threading
+import time
+
+from bson import json_util
+from flask import current_app, request
+from pymongo import monitoring
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# the pipelines in the slow-request log are truncated to this many characters
+MAX_PIPELINE_CHARS = 2000
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Cumulative histogram with the BUCKETS upper bounds, as in Prometheus."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Records the duration of every MongoDB command, by command name and collection."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        # request_id -> (command name, collection, pipeline) of the commands in flight
+        self._in_flight = {}
+
+    def started(self, event):
+        command = event.command
+        name = event.command_name
+        # most commands have the collection as the value of the command name, getMore has it apart
+        collection = command.get("collection") if name == "getMore" else command.get(name)
+        if not isinstance(collection, str):
+            # db-level commands, e.g. aggregate: 1 or ping
+            collection = ""
+        pipeline = command.get("pipeline") if name == "aggregate" else None
+        with self._lock:
+            self._in_flight[(event.request_id, event.connection_id)] = (name, collection, pipeline)
+
+    def _finished(self, event, failed, documents=0):
+        with self._lock:
+            info = self._in_flight.pop((event.request_id, event.connection_id), None)
+        if info is None:
+            return
+        name, collection, pipeline = info
+        self.metrics.record_command(name, collection, event.duration_micros / 1e6, failed, documents, pipeline)
+
+    def succeeded(self, event):
+        reply = event.reply or {}
+        cursor = reply.get("cursor") or {}
+        documents = len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        self._finished(event, failed=False, documents=documents)
+
+    def failed(self, event):
+        self._finished(event, failed=True)
+
+
+class RequestMetrics:
+    """Per-route request latencies and per-collection command statistics of this worker process."""
+
+    def __init__(self, slow_request_ms=1000):
+        self.slow_request_ms = slow_request_ms
+        self.listener = CommandMetricsListener(self)
+        self._lock = threading.Lock()
+        # state of the request being served by each thread
+        self._local = threading.local()
+        # (method, route) -> Histogram
+        self.request_latency = defaultdict(Histogram)
+        # (method, route, status) -> count
+        self.requests = defaultdict(int)
+        # (method, route) -> [db seconds, db commands]
+        self.request_db = defaultdict(lambda: [0.0, 0])
+        # (command, collection) -> Histogram
+        self.command_latency = defaultdict(Histogram)
+        # (command, collection) -> count
+        self.command_failures = defaultdict(int)
+        # collection -> count
+        self.documents_returned = defaultdict(int)
+
+    # requests
+
+    def start_request(self):
+        self._local.started = time.perf_counter()
+        self._local.db_seconds = 0.0
+        self._local.commands = []
+
+    def finish_request(self, method, route, status):
+        started = getattr(self._local, "started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        db_seconds = self._local.db_seconds
+        commands = self._local.commands
+        self._local.started = None
+        self.record_request(method, route, status, elapsed, db_seconds, commands)
+
+    def record_request(self, method, route, status, elapsed, db_seconds=0.0, commands=()):
+        """
+        Records a request timed outside of the hooks, e.g. by the ASGI app for its async routes,
+        whose MongoDB commands run on the event loop and are not attributed to the request.
+        """
+        with self._lock:
+            self.request_latency[(method, route)].observe(elapsed)
+            self.requests[(method, route, status)] += 1
+            db = self.request_db[(method, route)]
+            db[0] += db_seconds
+            db[1] += len(commands)
+        if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+            self._log_slow_request(method, route, status, elapsed, db_seconds, commands)
+
+    def _log_slow_request(self, method, route, status, elapsed, db_seconds, commands):
+        lines = [
+            f"Slow request: {method} {route} ({status}) took {elapsed * 1000:.0f} ms, "
+            f"{db_seconds * 1000:.0f} ms in {len(commands)} MongoDB commands"
+        ]
+        for name, collection, seconds, pipeline in commands:
+            line = f"  {name} {collection}: {seconds * 1000:.1f} ms"
+            if pipeline is not None:
+                line += f" pipeline={json_util.dumps(pipeline)[:MAX_PIPELINE_CHARS]}"
+            lines.append(line)
+        logger.warning("\n".join(lines))
+
+    # commands
+
+    def record_command(self, name, collection, seconds, failed, documents, pipeline):
+        with self._lock:
+            self.command_latency[(name, collection)].observe(seconds)
+            if failed:
+                self.command_failures[(name, collection)] += 1
+            if documents:
+                self.documents_returned[collection] += documents
+        # attribute the command to the request served by this thread, if any
+        if getattr(self._local, "started", None) is not None:
+            self._local.db_seconds += seconds
+            self._local.commands.append((name, collection, seconds, pipeline))
+
+    # exposition
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            request_latency = {key: (list(h.counts), h.count, h.sum) for key, h in self.request_latency.items()}
+            requests = dict(self.requests)
+            request_db = {key: tuple(value) for key, value in self.request_db.items()}
+            command_latency = {key: (list(h.counts), h.count, h.sum) for key, h in self.command_latency.items()}
+            command_failures = dict(self.command_failures)
+            documents_returned = dict(self.documents_returned)
+
+        lines = []
+
+        def histogram(metric, help_text, values, label_names):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, (counts, count, total) in sorted(values.items()):
+                labels = dict(zip(label_names, key))
+                for bound, bucket_count in zip(BUCKETS, counts):
+                    lines.append(f"{metric}_bucket{_labels(**labels, le=bound)} {bucket_count}")
+                lines.append(f"{metric}_bucket{_labels(**labels, le='+Inf')} {count}")
+                lines.append(f"{metric}_sum{_labels(**labels)} {total}")
+                lines.append(f"{metric}_count{_labels(**labels)} {count}")
+
+        def counter(metric, help_text, values, label_names):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in sorted(values.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{metric}{_labels(**dict(zip(label_names, key)))} {value}")
+
+        histogram("localdb_request_duration_seconds", "Duration of the HTTP requests.",
+                  request_latency, ("method", "route"))
+        counter("localdb_requests_total", "HTTP requests by status code.",
+                requests, ("method", "route", "status"))
+        counter("localdb_request_db_seconds_total", "Time spent in MongoDB commands by the HTTP requests.",
+                {key: value[0] for key, value in request_db.items()}, ("method", "route"))
+        counter("localdb_request_db_commands_total", "MongoDB commands issued by the HTTP requests.",
+                {key: value[1] for key, value in request_db.items()}, ("method", "route"))
+        histogram("localdb_mongo_command_duration_seconds", "Duration of the MongoDB commands.",
+                  command_latency, ("command", "collection"))
+        counter("localdb_mongo_command_failures_total", "Failed MongoDB commands.",
+                command_failures, ("command", "collection"))
+        counter("localdb_mongo_documents_returned_total", "Documents returned by the MongoDB cursors.",
+                documents_returned, ("collection",))
+        return "\n".join(lines) + "\n"
+
+
+def _finish_after(body, finish):
+    """Wraps a streamed response body, calling finish once it was sent (or the client went away)."""
+    try:
+        yield from body
+    finally:
+        finish()
+
+
+def init_metrics(app):
+    """
+    Creates the RequestMetrics of the app, configured from app.config, and registers the
+    request hooks. Must be called before init_client_registry, which adds its listener to the clients.
+    """
+    metrics = RequestMetrics(slow_request_ms=app.config.get("SLOW_REQUEST_MS", 1000))
+    app.extensions["request_metrics"] = metrics
+
+    @app.before_request
+    def start_request_timer():
+        metrics.start_request()
+
+    @app.after_request
+    def finish_request_timer(response):
+        method = request.method
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        status = response.status_code
+        if response.is_streamed:
+            # streamed responses (e.g. the collection listings) run their queries while being sent
+            response.response = _finish_after(response.response, lambda: metrics.finish_request(method, route, status))
+        else:
+            metrics.finish_request(method, route, status)
+        return response
+
+    return metrics
+
+
+def get_metrics():
+    metrics = current_app.extensions.get("request_metrics")
+    if metrics is None:
+        # the hooks can only be registered in create_app: no request timing, only the commands
+        metrics = current_app.extensions["request_metrics"] = RequestMetrics()
+    return metrics
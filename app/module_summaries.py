@@ -0,0 +1,211 @@
+# materialized view of the modules with their tests, runs, sessions and latest analyses,
+# served by /fetch_module_results
+#
+# the module_summaries collection holds one document per module, in the same format returned
+# by the aggregation pipeline below. The summaries of the touched modules are recomputed by
+# /addRun, /addAnalysis and the module_test_analysis POST, while the generic CRUD resources
+# just drop the summaries they make stale, which are then rebuilt on the next read.
+
+import os
+import sys
+
+from pymongo import ReplaceOne, DeleteMany
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from references import in_reference_order
+
+SUMMARIES_COLLECTION = "module_summaries"
+
+# number of modules aggregated at once by rebuild_module_summaries
+REBUILD_BATCH_SIZE = 200
+
+
+def module_tests_lookup():
+    """
+    Stages looking up the module tests referenced by the _moduleTest_id array of the modules,
+    yielding one document per module test, with the test as testDetail and its id as testId.
+    The references are ObjectIds, so the array is matched directly on the _id index.
+    """
+    return [
+        {
+            "$lookup": {
+                "from": "module_tests",
+                "localField": "_moduleTest_id",
+                "foreignField": "_id",
+                "as": "testDetails"
+            }
+        },
+        # in the order of the _moduleTest_id array
+        {
+            "$addFields": {
+                "testDetails": in_reference_order("$testDetails", "$_moduleTest_id")
+            }
+        },
+        {
+            "$unwind": {
+                "path": "$testDetails",
+                "preserveNullAndEmptyArrays": True
+            }
+        },
+        {
+            "$addFields": {
+                "testDetail": "$testDetails",
+                "testId": "$testDetails._id"
+            }
+        },
+    ]
+
+
+def module_summary_pipeline(match):
+    """Aggregation pipeline on the modules collection building the summary of the modules matching match."""
+    return [
+        # Stage 1: Match the modules
+        {
+            "$match": match
+        },
+        # Stage 2-4: Lookup the moduleTests documents, one per document
+        *module_tests_lookup(),
+        # Stage 5: Lookup the test_run document
+        {
+            "$lookup": {
+                "from": "test_runs",
+                "localField": "testDetail.test_runName",
+                "foreignField": "test_runName",
+                "as": "testRun"
+            }
+        },
+        # Stage 6: Add test run to document
+        {
+            "$addFields": {
+                "run": { "$arrayElemAt": ["$testRun", 0] }
+            }
+        },
+        # Stage 7: Lookup the session
+        {
+            "$lookup": {
+                "from": "sessions",
+                "localField": "run.runSession",
+                "foreignField": "sessionName",
+                "as": "sessionData"
+            }
+        },
+        # Stage 8: Add session to document
+        {
+            "$addFields": {
+                "session": { "$arrayElemAt": ["$sessionData", 0] }
+            }
+        },
+        # Stage 9: Get the last analysis ID
+        {
+            "$addFields": {
+                "lastAnalysisId": { 
+                    "$arrayElemAt": ["$testDetail.analysesList", -1] 
+                }
+            }
+        },
+        # Stage 10: Lookup the analysis
+        {
+            "$lookup": {
+                "from": "module_test_analysis",
+                "localField": "lastAnalysisId",
+                "foreignField": "moduleTestAnalysisName",
+                "as": "analysisData"
+            }
+        },
+        # Stage 11: Add analysis to document
+        {
+            "$addFields": {
+                "analysis": { "$arrayElemAt": ["$analysisData", 0] }
+            }
+        },
+        # Stage 12: Create a combined test document
+        {
+            "$addFields": {
+                "combinedTest": {
+                    "name": "$testDetail.moduleTestName",
+                    "id": "$testId",
+                    "details": "$testDetail",
+                    "run": "$run",
+                    "session": "$session",
+                    "analysis": "$analysis"
+                }
+            }
+        },
+        # Stage 13: Group back to rebuild the module with all tests
+        {
+            "$group": {
+                "_id": "$_id",
+                "moduleName": { "$first": "$moduleName" },
+                "position": { "$first": "$position" },
+                "status": { "$first": "$status" },
+                "type": { "$first": "$type" },
+                "crateSide": { "$first": "$crateSide" },
+                "tests": { "$push": "$combinedTest" }
+            }
+        },
+        # Stage 14: Clean up by removing unnecessary fields
+        {
+            "$project": {
+                "moduleTests": 0
+            }
+        }
+    ]
+
+def refresh_module_summaries(db, module_names):
+    """
+    Recomputes and stores the summaries of the given modules.
+
+    Returns:
+        the list of the new summaries
+    """
+    module_names = list(set(module_names))
+    if not module_names:
+        return []
+    summaries = list(db["modules"].aggregate(module_summary_pipeline({"moduleName": {"$in": module_names}})))
+    operations = [ReplaceOne({"_id": summary["_id"]}, summary, upsert=True) for summary in summaries]
+    # drop the summaries of deleted (or deleted and recreated) modules
+    operations.append(
+        DeleteMany(
+            {
+                "moduleName": {"$in": module_names},
+                "_id": {"$nin": [summary["_id"] for summary in summaries]},
+            }
+        )
+    )
+    db[SUMMARIES_COLLECTION].bulk_write(operations, ordered=False)
+    return summaries
+
+
+def invalidate_module_summaries(db, query):
+    """Drops the summaries matching query, they are rebuilt on the next read."""
+    db[SUMMARIES_COLLECTION].delete_many(query)
+
+
+def get_module_summary(db, module_name):
+    """Returns the summary of the module, building it if it is missing, or None if the module does not exist."""
+    summary = db[SUMMARIES_COLLECTION].find_one({"moduleName": module_name})
+    if summary is None:
+        summaries = refresh_module_summaries(db, [module_name])
+        summary = summaries[0] if summaries else None
+    return summary
+
+
+def rebuild_module_summaries(db, batch_size=REBUILD_BATCH_SIZE):
+    """
+    Rebuilds the summaries of all the modules, e.g. to backfill the collection.
+
+    Returns:
+        the number of summaries written
+    """
+    count = 0
+    batch = []
+    for module in db["modules"].find({}, {"moduleName": 1}):
+        batch.append(module["moduleName"])
+        if len(batch) == batch_size:
+            count += len(refresh_module_summaries(db, batch))
+            batch = []
+    count += len(refresh_module_summaries(db, batch))
+    # drop the summaries of modules which do not exist anymore
+    module_ids = db["modules"].distinct("_id")
+    db[SUMMARIES_COLLECTION].delete_many({"_id": {"$nin": module_ids}})
+    return count
@@ -0,0 +1,96 @@
+# references between the collections, stored as native ObjectIds
+#
+# the _id references used to be stored as strings, so every pipeline had to $unwind the arrays
+# and $toObjectId each element before the $lookup. Stored as ObjectIds, the arrays are matched
+# directly by a $lookup with localField on the _id index of the other collection.
+# coerce_references converts the references received as strings through the API, and
+# migrate_references converts the documents written before. A $lookup on an array returns the
+# documents in the order of the other collection: in_reference_order restores the array order.
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+# collection -> fields holding ObjectId references (a single id or an array of ids)
+REFERENCE_FIELDS = {
+    "modules": ["_moduleTest_id"],
+    "sessions": ["_test_run_id"],
+    "test_runs": ["_moduleTest_id"],
+    "module_tests": ["_test_run_id", "_module_id"],
+}
+
+# number of documents updated at once by migrate_references
+MIGRATION_BATCH_SIZE = 500
+
+
+def as_object_id(value):
+    """Returns value as an ObjectId if it is the string of one, unchanged otherwise."""
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    return value
+
+
+def _coerce(value):
+    if isinstance(value, list):
+        return [as_object_id(item) for item in value]
+    return as_object_id(value)
+
+
+def coerce_references(collection, entry):
+    """Converts in place the references of an entry of the collection given as strings, returns the entry."""
+    for field in REFERENCE_FIELDS.get(collection, []):
+        if field in entry:
+            entry[field] = _coerce(entry[field])
+    return entry
+
+
+def in_reference_order(joined, references):
+    """
+    Expression putting the documents of a $lookup on an array of references (joined, e.g.
+    "$runDetails") back in the order of the array (references, e.g. "$_test_run_id"): the
+    $lookup returns them in the order of the other collection. A dangling reference is left out.
+    """
+    return {
+        "$filter": {
+            "input": {
+                "$map": {
+                    "input": {"$ifNull": [references, []]},
+                    "as": "reference",
+                    "in": {
+                        "$arrayElemAt": [
+                            {"$filter": {"input": joined, "cond": {"$eq": ["$$this._id", "$$reference"]}}},
+                            0,
+                        ]
+                    },
+                }
+            },
+            "cond": {"$ne": ["$$this", None]},
+        }
+    }
+
+
+def migrate_references(db, batch_size=MIGRATION_BATCH_SIZE, dry_run=False):
+    """
+    Converts the string references of all the collections to ObjectIds.
+
+    Returns:
+        {collection: number of documents converted}
+    """
+    converted = {}
+    for collection, fields in REFERENCE_FIELDS.items():
+        # $type matches the arrays with at least one string element as well
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        projection = {field: 1 for field in fields}
+        count = 0
+        operations = []
+        for doc in db[collection].find(query, projection):
+            update = {field: _coerce(doc[field]) for field in fields if field in doc}
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+            if len(operations) == batch_size:
+                if not dry_run:
+                    db[collection].bulk_write(operations, ordered=False)
+                count += len(operations)
+                operations = []
+        if operations and not dry_run:
+            db[collection].bulk_write(operations, ordered=False)
+        converted[collection] = count + len(operations)
+    return converted
@@ -1,12 +1,17 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, iv_scans_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection, parse_fields, ListQueryError
+from iv_curves import CurveQueryError, pack_scan, pack_curve, parse_curve_args, scan_reader, CURVES
+from iv_analytics import ANALYSIS_FIELD
+from iv_trends import refresh_trends
 # Flask resource for burnin cycles
 class IVScansResource(Resource):
     """
@@ -21,46 +26,49 @@ class IVScansResource(Resource):
 
     def get(self, IVScanId=None): # IVScanId here is the path parameter
         iv_scans_collection = get_db()["iv_scans"]
+        # ?points=N downsamples the curves, the packed curves are decoded (see iv_curves.py)
+        try:
+            read = scan_reader(*parse_curve_args(request.args))
+        except CurveQueryError as e:
+            return {"message": str(e)}, 400
         if IVScanId:
+            # ?fields= as in the listing, e.g. fields=-data to leave the curves out
+            try:
+                projection = parse_fields(request.args)
+            except ListQueryError as e:
+                return {"message": str(e)}, 400
             # 1. Try to find by IVScanId (specific scan ID)
-            entry_by_ivscanid = iv_scans_collection.find_one({"IVScanId": IVScanId})
+            entry_by_ivscanid = iv_scans_collection.find_one({"IVScanId": IVScanId}, projection)
             if entry_by_ivscanid:
-                entry_by_ivscanid["_id"] = str(entry_by_ivscanid["_id"])
-                return jsonify(entry_by_ivscanid) # Returns a single object
+                return jsonify(read(entry_by_ivscanid)) # Returns a single object
 
             # 2. Try to find by MongoDB _id
             try:
                 obj_id = ObjectId(IVScanId)
-                entry_by_oid = iv_scans_collection.find_one({"_id": obj_id})
+                entry_by_oid = iv_scans_collection.find_one({"_id": obj_id}, projection)
                 if entry_by_oid:
-                    entry_by_oid["_id"] = str(entry_by_oid["_id"])
-                    return jsonify(entry_by_oid) # Returns a single object
+                    return jsonify(read(entry_by_oid)) # Returns a single object
             except bson.errors.InvalidId:
                 # IVScanId is not a valid ObjectId string, will proceed to check as nameLabel
                 pass
             
             # 3. Try to find by nameLabel (module name)
             # This is reached if not found by IVScanId, and (IVScanId is not an ObjectId or not found by ObjectId)
-            entries_by_module = list(iv_scans_collection.find({"nameLabel": IVScanId}))
+            entries_by_module = [read(entry) for entry in iv_scans_collection.find({"nameLabel": IVScanId}, projection)]
             if entries_by_module:
-                for e_mod in entries_by_module:
-                    e_mod["_id"] = str(e_mod["_id"])
                 return jsonify(entries_by_module) # Returns a list of objects
 
             # 4. If not found by any criteria
             return {"message": "IV Scan(s) or Module not found"}, 404
         else:
             # Fetch all entries if no specific IVScanId/identifier is provided
-            all_entries = list(iv_scans_collection.find())
-            for entry in all_entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(all_entries)
+            return list_collection(iv_scans_collection, transform=read)
 
     def post(self):
         iv_scans_collection = get_db()["iv_scans"]
         try:
             new_entry = request.get_json()
-            validate(instance=new_entry, schema=iv_scans_schema)
+            validate_entry(new_entry, "IVScans")
             # if an entry with the same Name already exists, return an error
             if iv_scans_collection.count_documents({"IVScanId": new_entry["IVScanId"]}) != 0:
                 return (
@@ -70,7 +78,10 @@ class IVScansResource(Resource):
                     },
                     400,
                 )
+            if current_app.config.get("IV_STORAGE") == "binary":
+                pack_scan(new_entry, current_app.config["IV_BINARY_DTYPE"])
             iv_scans_collection.insert_one(new_entry)
+            refresh_trends(get_db(), [new_entry["IVScanId"]])
             return {"message": "IV Scan inserted"}, 201
         except ValidationError as e:
             return {"message": str(e)}, 400
@@ -79,7 +90,20 @@ class IVScansResource(Resource):
         iv_scans_collection = get_db()["iv_scans"]
         if IVScanId:
             updated_data = request.get_json()
-            iv_scans_collection.update_one({"IVScanId": IVScanId}, {"$set": updated_data})
+            if current_app.config.get("IV_STORAGE") == "binary":
+                dtype = current_app.config["IV_BINARY_DTYPE"]
+                pack_scan(updated_data, dtype)
+                for name in CURVES:
+                    if isinstance(updated_data.get(f"data.{name}"), list):
+                        updated_data[f"data.{name}"] = pack_curve(updated_data[f"data.{name}"], dtype)
+            update = {"$set": updated_data}
+            if any(key == "data" or key.startswith("data.") for key in updated_data):
+                # the cached figures of merit are computed from the curves
+                update["$unset"] = {ANALYSIS_FIELD: ""}
+            result = iv_scans_collection.update_one({"IVScanId": IVScanId}, update)
+            if result.matched_count:
+                # the trend point of the scan, under its new IVScanId if the update changed it
+                refresh_trends(get_db(), [IVScanId, updated_data.get("IVScanId", IVScanId)])
             return {"message": "IV Scan updated"}, 200
         else:
             return {"message": "IV Scan not found"}, 404
@@ -90,6 +114,7 @@ class IVScansResource(Resource):
             entry = iv_scans_collection.find_one({"IVScanId": IVScanId})
             if entry:
                 iv_scans_collection.delete_one({"IVScanId": IVScanId})
+                refresh_trends(get_db(), [IVScanId])
                 return {"message": "IV Scan deleted"}, 200
             else:
                 return {"message": "IV Scan not found"}, 404
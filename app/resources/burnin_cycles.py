@@ -1,12 +1,17 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, burnin_cycles_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
+from response_cache import bump_generations
+from counters import next_name, parse_name, advance_counter
+from burnin_timeline import refresh_timeline
 # Flask resource for burnin cycles
 class BurninCyclesResource(Resource):
     """
@@ -31,21 +36,22 @@ class BurninCyclesResource(Resource):
                 except bson.errors.InvalidId: 
                     entry = None
             if entry:
-                entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                 return jsonify(entry)
             else:
                 return {"message": "Burnin cycle not found"}, 404
         else:
-            entries = list(burnin_cycles_collection.find())
-            for entry in entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(entries)
+            return list_collection(burnin_cycles_collection)
 
     def post(self):
         burnin_cycles_collection = get_db()["burnin_cycles"]
         try:
-            new_entry = request.get_json()
-            validate(instance=new_entry, schema=burnin_cycles_schema)
+            new_entry = request.get_json(silent=True)
+            if not isinstance(new_entry, dict):
+                return {"message": "Invalid input, expected a JSON object"}, 400
+            # without a name, the cycle gets the next one of the burn-in cycles counter
+            if "BurninCycleName" not in new_entry:
+                new_entry["BurninCycleName"] = next_name(get_db(), "burnin_cycle")
+            validate_entry(new_entry, "BurninCycles")
             # if an entry with the same Name already exists, return an error
             if burnin_cycles_collection.count_documents({"BurninCycleName": new_entry["BurninCycleName"]}) != 0:
                 return (
@@ -55,8 +61,14 @@ class BurninCyclesResource(Resource):
                     },
                     400,
                 )
+            # a BC<n> chosen by the client is never handed out by the counter
+            number = parse_name("burnin_cycle", new_entry["BurninCycleName"])
+            if number is not None:
+                advance_counter(get_db(), "burnin_cycle", number)
             burnin_cycles_collection.insert_one(new_entry)
-            return {"message": "Burnin cycle inserted"}, 201
+            refresh_timeline(get_db(), [new_entry["_id"]])
+            bump_generations(get_db(), "burnin_cycles")
+            return {"message": "Burnin cycle inserted", "BurninCycleName": new_entry["BurninCycleName"]}, 201
         except ValidationError as e:
             return {"message": str(e)}, 400
 
@@ -64,7 +76,12 @@ class BurninCyclesResource(Resource):
         burnin_cycles_collection = get_db()["burnin_cycles"]
         if burninCycleName:
             updated_data = request.get_json()
+            # by _id: the update may rename the cycle
+            entry = burnin_cycles_collection.find_one({"BurninCycleName": burninCycleName}, {"_id": 1})
             burnin_cycles_collection.update_one({"BurninCycleName": burninCycleName}, {"$set": updated_data})
+            if entry:
+                refresh_timeline(get_db(), [entry["_id"]])
+            bump_generations(get_db(), "burnin_cycles")
             return {"message": "Burnin cycle updated"}, 200
         else:
             return {"message": "Burnin cycle not found"}, 404
@@ -75,6 +92,8 @@ class BurninCyclesResource(Resource):
             entry = burnin_cycles_collection.find_one({"BurninCycleName": burninCycleName})
             if entry:
                 burnin_cycles_collection.delete_one({"BurninCycleName": burninCycleName})
+                refresh_timeline(get_db(), [entry["_id"]])
+                bump_generations(get_db(), "burnin_cycles")
                 return {"message": "Burnin cycle deleted"}, 200
             else:
                 return {"message": "Burnin cycle not found"}, 404
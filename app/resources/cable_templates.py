@@ -2,10 +2,13 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
-from utils import get_db, cable_templates_schema
+from utils import get_db
+from validation import validate_entry
+from cabling_graph import invalidate_cabling_graph
+from listing import list_collection
 
 
 class CableTemplatesResource(Resource):
@@ -14,22 +17,19 @@ class CableTemplatesResource(Resource):
         if cable_type:
             entry = cable_templates_collection.find_one({"type": cable_type})
             if entry:
-                entry["_id"] = str(entry["_id"])
                 return jsonify(entry)
             else:
                 return {"message": "Template not found"}, 404
         else:
-            entries = list(cable_templates_collection.find())
-            for entry in entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(entries)
+            return list_collection(cable_templates_collection)
 
     def post(self):
         cable_templates_collection = get_db()["cable_templates"]
         try:
             new_entry = request.get_json()
-            validate(instance=new_entry, schema=cable_templates_schema)
+            validate_entry(new_entry, "cable_templates")
             cable_templates_collection.insert_one(new_entry)
+            invalidate_cabling_graph(get_db())
             return {"message": "Template inserted"}, 201
         except ValidationError as e:
             return {"message": str(e)}, 400
@@ -41,6 +41,7 @@ class CableTemplatesResource(Resource):
             cable_templates_collection.update_one(
                 {"type": cable_type}, {"$set": updated_data}
             )
+            invalidate_cabling_graph(get_db())
             return {"message": "Template updated"}, 200
         else:
             return {"message": "Template not found"}, 404
@@ -50,6 +51,7 @@ class CableTemplatesResource(Resource):
         if cable_type:
             result = cable_templates_collection.delete_one({"type": cable_type})
             if result.deleted_count > 0:
+                invalidate_cabling_graph(get_db())
                 return {"message": "Template deleted"}, 200
             else:
                 return {"message": "Template not found"}, 404
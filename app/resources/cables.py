@@ -2,10 +2,13 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
-from utils import get_db, cables_schema
+from utils import get_db
+from validation import validate_entry
+from cabling_graph import invalidate_cabling_graph
+from listing import list_collection
 
 
 class CablesResource(Resource):
@@ -24,15 +27,11 @@ class CablesResource(Resource):
         if name:
             entry = cables_collection.find_one({"name": name})
             if entry:
-                entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                 return jsonify(entry)
             else:
                 return {"message": "Entry not found"}, 404
         else:
-            entries = list(cables_collection.find())
-            for entry in entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(entries)
+            return list_collection(cables_collection)
 
     def post(self):
         cables_collection = get_db()["cables"]
@@ -40,7 +39,7 @@ class CablesResource(Resource):
 
         try:
             new_entry = request.get_json()
-            validate(instance=new_entry, schema=cables_schema)
+            validate_entry(new_entry, "cables")
             # if any cable with the same name already exists, return an error
             if cables_collection.find_one({"name": new_entry["name"]}):
                 return {"message": "Entry already exists"}, 400
@@ -72,6 +71,7 @@ class CablesResource(Resource):
                     return {"message": "side should be initialized as empty"}, 400
             
             cables_collection.insert_one(new_entry)
+            invalidate_cabling_graph(get_db())
             return {"message": "Entry inserted"}, 201
         except ValidationError as e:
             return {"message": str(e)}, 400
@@ -83,6 +83,7 @@ class CablesResource(Resource):
             # update the cable entry with the new data
             # but leave the 
             cables_collection.update_one({"name": name}, {"$set": updated_data})
+            invalidate_cabling_graph(get_db())
             return {"message": "Entry updated"}, 200
         else:
             return {"message": "Entry not found"}, 404
@@ -93,6 +94,7 @@ class CablesResource(Resource):
             entry = cables_collection.find_one({"name": name})
             if entry:
                 cables_collection.delete_one({"name": name})
+                invalidate_cabling_graph(get_db())
                 return {"message": "Entry deleted"}, 200
             else:
                 return {"message": "Entry not found"}, 404
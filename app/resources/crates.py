@@ -6,6 +6,7 @@ from jsonschema import validate, ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from utils import get_db
+from listing import list_collection
 
 # NOTE: add schema for crates
 
@@ -17,15 +18,11 @@ class CratesResource(Resource):
         if name:
             entry = crates_collection.find_one({"name": name})
             if entry:
-                entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                 return jsonify(entry)
             else:
                 return {"message": "Entry not found"}, 404
         else:
-            entries = list(crates_collection.find())
-            for entry in entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(entries)
+            return list_collection(crates_collection)
 
     def post(self):
         crates_collection = get_db()["crates"]
@@ -1,11 +1,14 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
-from utils import get_db, logbook_schema, findModuleIds
+from utils import get_db, findModuleIds
+from validation import validate_entry
+from listing import list_collection
+from attachments import store_uploads, parse_attachment_url, release_attachment
 import base64,json
 import time
 class LogbookResource(Resource):
@@ -48,19 +51,11 @@ class LogbookResource(Resource):
             if _id:
                 log = logbook_collection.find_one({"_id": ObjectId(_id)})
                 if log:
-                    log["_id"] = str(log["_id"])  # convert ObjectId to string
                     return jsonify(log)
                 else:
                     return {"message": "Log not found"}, 404
             else:
-                logs = list(logbook_collection.find())
-                for log in logs:
-                    ##convert bytes fields to base64
-                    #for key in log:
-                    #    if isinstance(log[key], bytes):
-                    #        log[key] = base64.b64encode(log[key]).decode('utf-8')
-                    log["_id"] = str(log["_id"])
-                return jsonify(logs)
+                return list_collection(logbook_collection)
 
         def post(self):
             """
@@ -83,18 +78,7 @@ class LogbookResource(Resource):
                 new_log = json.loads(all_data["jsonData"])
                 new_log["attachments"] = {}
                 #new_log["timestamp"] = ObjectId()
-                #attachments as blobs of data
-                if request.files:
-                    for file in request.files:
-                        #save in "/attachments" folder and add url in new_log
-                        file = request.files[file]
-                        #add current time timestamp to filename
-                        curr_timestamp= str(time.time()).replace(".","_")
-                        file.save(os.path.join("/attachments", curr_timestamp+"_"+file.filename))
-                        new_log["attachments"][file.filename] = os.path.join("/attachments", curr_timestamp+"_"+file.filename)
-
-                      
-                validate(instance=new_log, schema=logbook_schema)
+                validate_entry(new_log, "logbook")
                 # check involved modules
                 im = []
                 key = "involved_modules"
@@ -108,6 +92,9 @@ class LogbookResource(Resource):
                     d = new_log["details"]
                     modules_in_the_details = findModuleIds(d)
                 new_log[key] = list(set(modules_in_the_details+im))
+                #attachments are streamed to the content-addressed store, see attachments.py
+                if request.files:
+                    new_log["attachments"], new_log["attachment_digests"] = store_uploads(request.files)
                 logbook_collection.insert_one(new_log)
                 return {"_id": str(new_log["_id"])}, 201
             except ValidationError as e:
@@ -159,13 +146,18 @@ class LogbookResource(Resource):
             log = logbook_collection.find_one({"_id": ObjectId(_id)})
             
             # Handle attachment removal if requested
+            released_digests = []
             if "remove_attachment" in updated_data:
                 filename_to_remove = updated_data["remove_attachment"]
                 if "attachments" in log and filename_to_remove in log["attachments"]:
                     # Get the file path
                     file_path = log["attachments"][filename_to_remove]
-                    # Remove the file from filesystem if it exists
-                    if os.path.exists(file_path):
+                    digest, _ = parse_attachment_url(file_path)
+                    if digest is not None:
+                        # the content may be attached to other entries: deleted after the update if not
+                        released_digests.append(digest)
+                    # Remove the file from filesystem if it exists (attachments saved before the store)
+                    elif os.path.exists(file_path):
                         os.remove(file_path)
                     # Remove from attachments dictionary
                     del log["attachments"][filename_to_remove]
@@ -177,6 +169,10 @@ class LogbookResource(Resource):
                 updated_data["attachments"] = log["attachments"]
             else:
                 updated_data["attachments"] = {}
+            updated_data["attachment_digests"] = log.get("attachment_digests", [])
+            for digest in released_digests:
+                if digest in updated_data["attachment_digests"]:
+                    updated_data["attachment_digests"].remove(digest)
 
             # Handle involved modules
             if "involved_modules" in updated_data:
@@ -187,13 +183,15 @@ class LogbookResource(Resource):
 
             # Handle new file attachments
             if request.files:
-                for file in request.files:
-                    file = request.files[file]
-                    curr_timestamp = str(time.time()).replace(".", "_")
-                    filename = curr_timestamp + "_" + file.filename
-                    file_path = os.path.join("/attachments", filename)
-                    file.save(file_path)
-                    updated_data["attachments"][file.filename] = file_path
+                attachments, digests = store_uploads(request.files)
+                # a file uploaded again under the same name replaces the previous one
+                for filename in attachments:
+                    digest, _ = parse_attachment_url(updated_data["attachments"].get(filename, ""))
+                    if digest in updated_data["attachment_digests"]:
+                        updated_data["attachment_digests"].remove(digest)
+                        released_digests.append(digest)
+                updated_data["attachments"].update(attachments)
+                updated_data["attachment_digests"] += digests
 
             # Remove _id from updated data if present
             if "_id" in updated_data:
@@ -201,6 +199,8 @@ class LogbookResource(Resource):
 
             # Update entry in database
             logbook_collection.update_one({"_id": ObjectId(_id)}, {"$set": updated_data})
+            for digest in released_digests:
+                release_attachment(logbook_collection, digest)
             
             return {"message": "Log updated"}, 200
 
@@ -222,6 +222,8 @@ class LogbookResource(Resource):
             log = logbook_collection.find_one({"_id": ObjectId(_id)})
             if log:
                 logbook_collection.delete_one({"_id": ObjectId(_id)})
+                for digest in set(log.get("attachment_digests", [])):
+                    release_attachment(logbook_collection, digest)
                 return {"message": "Log deleted"}, 200
             else:
                 return {"message": "Log not found"}, 404
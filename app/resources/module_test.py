@@ -1,12 +1,17 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, module_test_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
+from module_summaries import invalidate_module_summaries
+from references import coerce_references
+from response_cache import bump_generations
 
 # a flask resource for module_tests
 class ModuleTestsResource(Resource):
@@ -33,21 +38,18 @@ class ModuleTestsResource(Resource):
                     except bson.errors.InvalidId: 
                         entry = None
                 if entry:
-                    entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                     return jsonify(entry)
                 else:
                     return {"message": "Entry not found"}, 404
             else:
-                entries = list(module_tests_collection.find())
-                for entry in entries:
-                    entry["_id"] = str(entry["_id"])
-                return jsonify(entries)
+                return list_collection(module_tests_collection)
 
         def post(self):
             module_tests_collection = get_db()["module_tests"]
             try:
                 new_entry = request.get_json()
-                validate(instance=new_entry, schema=module_test_schema)
+                validate_entry(new_entry, "moduleTest")
+                coerce_references("module_tests", new_entry)
                 # if an entry with the same Name already exists, return an error
                 if (module_tests_collection.count_documents({"moduleTestName": new_entry["moduleTestName"]}) != 0) & (not new_entry["moduleTestName"].endswith("run0")):
                     return (
@@ -64,9 +66,13 @@ class ModuleTestsResource(Resource):
                     module_tests_collection.update_one(
                         {"moduleTestName": new_entry["moduleTestName"]}, {"$set": new_entry}
                     )
+                    invalidate_module_summaries(get_db(), {"moduleName": new_entry["moduleName"]})
+                    bump_generations(get_db(), "module_tests")
                     return {"message": "Module test key already exists, but end with run0: Entry updated"}, 200
                 else:
                     module_tests_collection.insert_one(new_entry)
+                    invalidate_module_summaries(get_db(), {"moduleName": new_entry["moduleName"]})
+                    bump_generations(get_db(), "module_tests")
                     return {"message": "Entry inserted"}, 201
                 
             except ValidationError as e:
@@ -76,7 +82,9 @@ class ModuleTestsResource(Resource):
             module_tests_collection = get_db()["module_tests"]
             if moduleTestName:
                 updated_data = request.get_json()
-                module_tests_collection.update_one({"moduleTestName": moduleTestName}, {"$set": updated_data})
+                module_tests_collection.update_one({"moduleTestName": moduleTestName}, {"$set": coerce_references("module_tests", updated_data)})
+                invalidate_module_summaries(get_db(), {"tests.name": moduleTestName})
+                bump_generations(get_db(), "module_tests")
                 return {"message": "Entry updated"}, 200
             else:
                 return {"message": "Entry not found"}, 404
@@ -87,6 +95,8 @@ class ModuleTestsResource(Resource):
                 entry = module_tests_collection.find_one({"moduleTestName": moduleTestName})
                 if entry:
                     module_tests_collection.delete_one({"moduleTestName": moduleTestName})
+                    invalidate_module_summaries(get_db(), {"tests.name": moduleTestName})
+                    bump_generations(get_db(), "module_tests")
                     return {"message": "Entry deleted"}, 200
                 else:
                     return {"message": "Entry not found"}, 404
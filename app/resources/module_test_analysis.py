@@ -1,12 +1,16 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, module_test_analysis_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
+from module_summaries import refresh_module_summaries, invalidate_module_summaries
+from response_cache import bump_generations
 
 # a flask resource for module test analysis
 class ModuleTestAnalysisResource(Resource):
@@ -32,15 +36,11 @@ class ModuleTestAnalysisResource(Resource):
                     except bson.errors.InvalidId:
                         entry = None
                 if entry:
-                    entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                     return jsonify(entry)
                 else:
                     return {"message": "Entry not found"}, 404
             else:
-                entries = list(module_test_analysis_collection.find())
-                for entry in entries:
-                    entry["_id"] = str(entry["_id"])
-                return jsonify(entries)
+                return list_collection(module_test_analysis_collection)
 
         def post(self):
             module_test_analysis_collection = get_db()["module_test_analysis"]
@@ -48,7 +48,7 @@ class ModuleTestAnalysisResource(Resource):
                 new_entry = request.get_json()
                 # add to the new_entry the moduleTestAnalysisId defined 
                 # as the length of the collection + 1
-                validate(instance=new_entry, schema=module_test_analysis_schema)
+                validate_entry(new_entry, "moduleTestAnalysis")
                 # if an entry with the same Name already exists, return an error
                 if module_test_analysis_collection.count_documents({"moduleTestAnalysisName": new_entry["moduleTestAnalysisName"]}) != 0:
                     print("moduleTestAnalysisName already exists")
@@ -62,6 +62,11 @@ class ModuleTestAnalysisResource(Resource):
                     )
 
                 module_test_analysis_collection.insert_one(new_entry)
+                bump_generations(get_db(), "module_test_analysis")
+                # the module summary embeds the latest analysis of each test
+                module_test = get_db()["module_tests"].find_one({"moduleTestName": new_entry["moduleTestName"]}, {"moduleName": 1})
+                if module_test:
+                    refresh_module_summaries(get_db(), [module_test["moduleName"]])
                 # return the moduleTestAnalysisName as well
                 return {"message": "Entry created", "moduleTestAnalysisName": new_entry["moduleTestAnalysisName"]}, 201
             except ValidationError as e:
@@ -73,6 +78,8 @@ class ModuleTestAnalysisResource(Resource):
             if moduleTestAnalysisName:
                 updated_data = request.get_json()
                 module_test_analysis_collection.update_one({"moduleTestAnalysisName": moduleTestAnalysisName}, {"$set": updated_data})
+                invalidate_module_summaries(get_db(), {"tests.details.analysesList": moduleTestAnalysisName})
+                bump_generations(get_db(), "module_test_analysis")
                 return {"message": "Entry updated"}, 200
             
         def delete(self, moduleTestAnalysisName):
@@ -81,6 +88,8 @@ class ModuleTestAnalysisResource(Resource):
                 entry = module_test_analysis_collection.find_one({"moduleTestAnalysisName": moduleTestAnalysisName})
                 if entry:
                     module_test_analysis_collection.delete_one({"moduleTestAnalysisName": moduleTestAnalysisName})
+                    invalidate_module_summaries(get_db(), {"tests.details.analysesList": moduleTestAnalysisName})
+                    bump_generations(get_db(), "module_test_analysis")
                     return {"message": "Entry deleted"}, 200
                 else:
                     return {"message": "Entry not found"}, 404
\ No newline at end of file
@@ -2,12 +2,17 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, module_schema
+from utils import get_db
+from validation import validate_entry
+from cabling_graph import invalidate_cabling_graph
+from listing import list_collection
+from module_summaries import invalidate_module_summaries
+from references import coerce_references
 
 
 class ModulesResource(Resource):
@@ -46,10 +51,7 @@ class ModulesResource(Resource):
             else:
                 return {"message": "Module not found"}, 404
         else:
-            modules = list(modules_collection.find())
-            # for module in modules:
-            #     module["_id"] = str(module["_id"])
-            return jsonify(modules)
+            return list_collection(modules_collection)
 
     def post(self):
         """
@@ -75,7 +77,7 @@ class ModulesResource(Resource):
                     ,
                     400,
                 )
-            validate(instance=new_module, schema=module_schema)
+            validate_entry(new_module, "module")
             # if an module with the same Name already exists, return an error
             if modules_collection.count_documents({"moduleName": new_module["moduleName"]}) != 0:
                 return (
@@ -121,7 +123,10 @@ class ModulesResource(Resource):
                 new_module["crateSide"] = {
                     str(i): [] for i in range(1, template["lines"] + 1)
                 }
-            modules_collection.insert_one(new_module)
+            modules_collection.insert_one(coerce_references("modules", new_module))
+            # drop the summary of a previous module with the same name
+            invalidate_module_summaries(get_db(), {"moduleName": new_module["moduleName"]})
+            invalidate_cabling_graph(get_db())
             return {"message": "Module inserted"}, 201
         except ValidationError as e:
             return {"message": str(e)}, 400
@@ -145,7 +150,13 @@ class ModulesResource(Resource):
 #                 updated_data[key] = None  # Convert 'None' string back to None
 
 
-        modules_collection.update_one({"moduleName": moduleName}, {"$set": updated_data})
+        modules_collection.update_one({"moduleName": moduleName}, {"$set": coerce_references("modules", updated_data)})
+        invalidate_module_summaries(
+            get_db(), {"moduleName": {"$in": [moduleName, updated_data.get("moduleName", moduleName)]}}
+        )
+        # only the cabling fields are mirrored by the cabling graph
+        if any(key in updated_data for key in ["moduleName", "type", "crateSide", "detSide"]):
+            invalidate_cabling_graph(get_db())
         return {"message": "Module updated"}, 200
 
     def delete(self, moduleName):
@@ -160,4 +171,6 @@ class ModulesResource(Resource):
         """
         modules_collection = get_db()["modules"]
         modules_collection.delete_one({"moduleName": moduleName})
+        invalidate_module_summaries(get_db(), {"moduleName": moduleName})
+        invalidate_cabling_graph(get_db())
         return {"message": "Module deleted"}, 200
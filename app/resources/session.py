@@ -1,12 +1,19 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, session_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
+from module_summaries import invalidate_module_summaries
+from references import coerce_references
+from response_cache import bump_generations
+from counters import next_name, claim_reserved
+from pymongo.errors import DuplicateKeyError
 
 # a flask resource for sessions
 class SessionsResource(Resource):
@@ -33,44 +40,40 @@ class SessionsResource(Resource):
                         entry = None
 
                 if entry:
-                    entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                     return jsonify(entry)
                 else:
                     return {"message": "Entry not found"}, 404
             else:
-                entries = list(sessions_collection.find())
-                for entry in entries:
-                    entry["_id"] = str(entry["_id"])
-                return jsonify(entries)
+                return list_collection(sessions_collection)
 
         def post(self):
             sessions_collection = get_db()["sessions"]
-            metadata_collection = get_db()["metadata"]
-            # check for the metadata object in metadata collection, and create it if it does not exist
-            if metadata_collection.count_documents({"name": "metadata"}) == 0:
-                metadata_collection.insert_one({"name": "metadata", "lastSessionNumber": 0})
             try:
                 new_entry = request.get_json()
 
-                # check that session collection is not empty
-                # if it is, set the sessionName to session1
-                last_session = metadata_collection.find_one({"name": "metadata"})["lastSessionNumber"]
-                new_entry["sessionName"] = "session" + str(last_session + 1)
-                metadata_collection.update_one({"name": "metadata"}, {"$set": {"lastSessionNumber": last_session + 1}})
+                # validated before a reserved name is claimed, so that an invalid entry does not use it up
+                validate_entry(dict(new_entry, sessionName=str(new_entry.get("sessionName", ""))), "session")
+                # a sessionName reserved in advance (POST /counters/session/reserve) is kept the first
+                # time it is used, any other is replaced by the next session number of the counter
+                if not claim_reserved(get_db(), "session", new_entry.get("sessionName")):
+                    new_entry["sessionName"] = next_name(get_db(), "session")
 
-                validate(instance=new_entry, schema=session_schema)
-                # if an entry with the same Name already exists, return an error
-                if sessions_collection.count_documents({"sessionName": new_entry["sessionName"]}) != 0:
-                    return (
-                        
-                            {
-                                "message": "Session Name already exists. Please try again.",
-                                "sessionName": new_entry["sessionName"],
-                            }
-                        ,
-                        400,
-                    )
-                sessions_collection.insert_one(new_entry)
+                # if an entry with the same Name already exists, return an error; the unique index
+                # on sessionName, when it could be built, also rejects one inserted meanwhile
+                duplicate = (
+                    {
+                        "message": "Session Name already exists. Please try again.",
+                        "sessionName": new_entry["sessionName"],
+                    },
+                    400,
+                )
+                if sessions_collection.count_documents({"sessionName": new_entry["sessionName"]}, limit=1) != 0:
+                    return duplicate
+                try:
+                    sessions_collection.insert_one(coerce_references("sessions", new_entry))
+                except DuplicateKeyError:
+                    return duplicate
+                bump_generations(get_db(), "sessions")
                 # return the sessionName as well
                 return {"message": "Entry created", "sessionName": new_entry["sessionName"]}, 201
             except ValidationError as e:
@@ -81,7 +84,9 @@ class SessionsResource(Resource):
             sessions_collection = get_db()["sessions"]
             if sessionName:
                 updated_data = request.get_json()
-                sessions_collection.update_one({"sessionName": sessionName}, {"$set": updated_data})
+                sessions_collection.update_one({"sessionName": sessionName}, {"$set": coerce_references("sessions", updated_data)})
+                invalidate_module_summaries(get_db(), {"tests.run.runSession": sessionName})
+                bump_generations(get_db(), "sessions")
                 return {"message": "Entry updated"}, 200
             else:
                 return {"message": "Entry not found"}, 404
@@ -90,6 +95,8 @@ class SessionsResource(Resource):
             sessions_collection = get_db()["sessions"]
             if sessionName:
                 sessions_collection.delete_one({"sessionName": sessionName})
+                invalidate_module_summaries(get_db(), {"tests.run.runSession": sessionName})
+                bump_generations(get_db(), "sessions")
                 return {"message": "Entry deleted"}, 200
             else:
                 return {"message": "Entry not found"}, 404
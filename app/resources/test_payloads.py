@@ -2,11 +2,13 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
-from utils import get_db, testpayload_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
 
 
 class TestPayloadsResource(Resource):
@@ -25,21 +27,17 @@ class TestPayloadsResource(Resource):
         if testpName:
             entry = tests_collection.find_one({"_id": ObjectId(testpName)})
             if entry:
-                entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                 return jsonify(entry)
             else:
                 return {"message": "Entry not found"}, 404
         else:
-            entries = list(tests_collection.find())
-            for entry in entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(entries)
+            return list_collection(tests_collection)
 
     def post(self):
         tests_collection = get_db()["testpayloads"]
         try:
             new_entry = request.get_json()
-            validate(instance=new_entry, schema=testpayload_schema)
+            validate_entry(new_entry, "testpayload")
             result = tests_collection.insert_one(new_entry)
             _id = str(result.inserted_id)
             return {"_id": str(_id)}, 201
@@ -2,12 +2,17 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
 from bson import ObjectId
 import bson
-from utils import get_db, test_run_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
+from module_summaries import invalidate_module_summaries
+from references import coerce_references
+from response_cache import bump_generations
 
 
 # a flask resource for test_runs
@@ -37,16 +42,16 @@ class TestRunResource(Resource):
             else:
                 return {"message": "Entry not found"}, 404
         else:
-            entries = list(test_runs_collection.find())
-
-            return jsonify(entries)
+            return list_collection(test_runs_collection)
 
     def post(self):
         test_runs_collection = get_db()["test_runs"]
         try:
             new_entry = request.get_json()
-            validate(instance=new_entry, schema=test_run_schema)
-            test_runs_collection.insert_one(new_entry)
+            validate_entry(new_entry, "testRun")
+            test_runs_collection.insert_one(coerce_references("test_runs", new_entry))
+            invalidate_module_summaries(get_db(), {"tests.details.test_runName": new_entry["test_runName"]})
+            bump_generations(get_db(), "test_runs")
             return {"message": "Entry inserted"}, 201
         except ValidationError as e:
             return {"message": str(e)}, 400
@@ -56,8 +61,10 @@ class TestRunResource(Resource):
         if test_runName:
             updated_data = request.get_json()
             test_runs_collection.update_one(
-                {"test_runName": test_runName}, {"$set": updated_data}
+                {"test_runName": test_runName}, {"$set": coerce_references("test_runs", updated_data)}
             )
+            invalidate_module_summaries(get_db(), {"tests.details.test_runName": test_runName})
+            bump_generations(get_db(), "test_runs")
             return {"message": "Entry updated"}, 200
         else:
             return {"message": "Entry not found"}, 404
@@ -68,6 +75,8 @@ class TestRunResource(Resource):
             entry = test_runs_collection.find_one({"test_runName": test_runName})
             if entry:
                 test_runs_collection.delete_one({"test_runName": test_runName})
+                invalidate_module_summaries(get_db(), {"tests.details.test_runName": test_runName})
+                bump_generations(get_db(), "test_runs")
                 return {"message": "Entry deleted"}, 200
             else:
                 return {"message": "Entry not found"}, 404
@@ -2,10 +2,12 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import request, jsonify, current_app
 from flask_restful import Resource
-from utils import get_db, tests_schema
+from utils import get_db
+from validation import validate_entry
+from listing import list_collection
 
 
 class TestsResource(Resource):
@@ -25,21 +27,17 @@ class TestsResource(Resource):
         if testName:
             entry = tests_collection.find_one({"testName": testName})
             if entry:
-                entry["_id"] = str(entry["_id"])  # convert ObjectId to string
                 return jsonify(entry)
             else:
                 return {"message": "Entry not found"}, 404
         else:
-            entries = list(tests_collection.find())
-            for entry in entries:
-                entry["_id"] = str(entry["_id"])
-            return jsonify(entries)
+            return list_collection(tests_collection)
 
     def post(self):
         tests_collection = get_db()["tests"]
         try:
             new_entry = request.get_json()
-            validate(instance=new_entry, schema=tests_schema)
+            validate_entry(new_entry, "tests")
             tests_collection.insert_one(new_entry)
             return {"message": "Entry inserted"}, 201
         except ValidationError as e:
@@ -0,0 +1,138 @@
+# server-side cache of the responses of the heavy GET endpoints (the TBPS dashboards)
+#
+# the entries are keyed by endpoint and normalized query args, evicted LRU when the cache is
+# full and expired after a TTL. Every write route bumps a per-collection generation counter,
+# kept in the metadata collection so that it is shared by all the workers: an entry is only
+# served if the generations of the collections it was computed from did not change.
+
+from collections import OrderedDict
+from functools import wraps
+import threading
+import time
+
+from flask import current_app, request, make_response, Response
+from pymongo import ReturnDocument
+
+GENERATIONS_DOC = {"name": "collection_generations"}
+
+
+def get_generations(db, collections):
+    """Returns the current generation of each of the collections, as a tuple."""
+    doc = db["metadata"].find_one(GENERATIONS_DOC, {name: 1 for name in collections}) or {}
+    return tuple(doc.get(name, 0) for name in collections)
+
+
+def bump_generations(db, *collections):
+    """Marks the collections as changed, invalidating the cached responses computed from them."""
+    db["metadata"].find_one_and_update(
+        GENERATIONS_DOC,
+        {"$inc": {name: 1 for name in collections}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+class ResponseCache:
+    """Size-bounded LRU cache with TTL, holding the serialized responses."""
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generations):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generations, expires_at, value = entry
+                if entry_generations == generations and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                # stale or expired
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, generations, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (generations, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def init_response_cache(app):
+    """Creates the ResponseCache of the app, configured from app.config."""
+    app.extensions["response_cache"] = ResponseCache(
+        max_entries=app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 256),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 300),
+    )
+    return app.extensions["response_cache"]
+
+
+def get_response_cache():
+    cache = current_app.extensions.get("response_cache")
+    if cache is None:
+        cache = init_response_cache(current_app)
+    return cache
+
+
+def cached_response(get_db, collections):
+    """
+    Decorator caching the successful responses of a GET view.
+
+    Args:
+        get_db: function returning the database the view reads from
+        collections: names of the collections the response is computed from
+    """
+    collections = tuple(collections)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            db = get_db()
+            # the order of the query args does not matter
+            query_args = tuple(sorted((key, tuple(request.args.getlist(key))) for key in request.args))
+            key = (db.name, request.endpoint, tuple(sorted(kwargs.items())), query_args)
+            generations = get_generations(db, collections)
+
+            cache = get_response_cache()
+            cached = cache.get(key, generations)
+            if cached is not None:
+                body, status, mimetype = cached
+                response = Response(body, status=status, mimetype=mimetype)
+                response.headers["X-Cache"] = "HIT"
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                cache.set(key, generations, (response.get_data(), response.status_code, response.mimetype))
+            response.headers["X-Cache"] = "MISS"
+            return response
+
+        return wrapper
+
+    return decorator
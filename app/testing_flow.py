@@ -0,0 +1,195 @@
+# segmentation of the events of a session into the columns and rows of the testing flow page,
+# used by /fetch_session_testing_flow
+#
+# the timestamps are parsed once, the tests between two burn-in cycles are found with bisect
+# on the sorted test times, and each column indexes its events by module, so the cost is
+# linear in the number of events plus the size of the output matrix.
+
+from bisect import bisect_left, bisect_right
+import datetime
+
+
+def parse_timestamp(ts):
+    """Returns the timestamp of an event as a datetime (datetime.min if missing or invalid)."""
+    if ts is None:
+        return datetime.datetime.min
+    if isinstance(ts, str):
+        try:
+            return datetime.datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        except ValueError:
+            return datetime.datetime.min
+    return ts
+
+
+def build_segments(test_events, test_times, cycle_events):
+    """
+    Splits the tests (sorted by time) into groups delimited by the burn-in cycles (sorted by time).
+    A test taking place at the same time as a cycle does not belong to any group.
+
+    Returns:
+        list of "test_group" and "cycle" segments, in time order
+    """
+    segments = []
+
+    def add_test_group(lo, hi):
+        if lo < hi:
+            segments.append({
+                "type": "test_group",
+                "events": test_events[lo:hi],
+                "start_time": test_times[lo],
+                "end_time": test_times[hi - 1],
+            })
+
+    if not cycle_events:
+        # No cycles, all tests in one segment
+        add_test_group(0, len(test_events))
+        return segments
+
+    # Add test segment before first cycle
+    add_test_group(0, bisect_left(test_times, cycle_events[0]["time"]))
+
+    # Interleave cycles and test groups
+    for i, cycle in enumerate(cycle_events):
+        segments.append({
+            "type": "cycle",
+            "cycle_data": cycle["data"],
+            "timestamp": cycle["time"],
+        })
+        # Add tests between this cycle and the next (or end)
+        lo = bisect_right(test_times, cycle["time"])
+        if i < len(cycle_events) - 1:
+            hi = bisect_left(test_times, cycle_events[i + 1]["time"])
+        else:
+            hi = len(test_events)
+        add_test_group(lo, hi)
+    return segments
+
+
+def build_columns(segments):
+    """
+    Each segment becomes columns: one per test type for a test group, a single one for a cycle.
+    Each column also gets a "by_module" index of its events, which is not part of the response.
+    """
+    columns = []
+    for seg_idx, segment in enumerate(segments):
+        if segment["type"] == "cycle":
+            # Single column for the cycle (applies to all modules in the cycle)
+            cycle_data = segment["cycle_data"]
+            columns.append({
+                "type": "cycle",
+                "column_id": f"seg_{seg_idx}_cycle",
+                "event_name": cycle_data["event_name"],
+                "timestamp": segment["timestamp"],
+                "cycle_name": cycle_data["cycle_name"],
+                "temperatures": cycle_data["temperatures"],
+                "modules": cycle_data["modules"],  # List of modules in this cycle
+                "by_module": set(cycle_data["modules"]),
+            })
+        else:
+            # Group tests by test_type within this segment
+            test_types_in_segment = {}
+            for event in segment["events"]:
+                test_types_in_segment.setdefault(event.get("test_type", "Unknown"), []).append(event)
+
+            # Create a column for each test type in this segment
+            for test_type, type_events in sorted(test_types_in_segment.items(), key=lambda item: item[0]):
+                by_module = {}
+                for event in type_events:
+                    by_module.setdefault(event.get("module_name"), []).append(event)
+                columns.append({
+                    "type": "test_group",
+                    "column_id": f"seg_{seg_idx}_{test_type}",
+                    "test_type": test_type,
+                    "event_name": test_type,
+                    "start_time": segment["start_time"],
+                    "end_time": segment["end_time"],
+                    "test_events": type_events,  # All events of this type in this segment
+                    "by_module": by_module,
+                })
+    return columns
+
+
+def build_flow_matrix(modules_list, columns):
+    """Builds one row per module, with the module's cell for each column."""
+    flow_matrix = []
+    for module in modules_list:
+        row = {"module_name": module, "columns": {}}
+        for col_idx, column in enumerate(columns):
+            col_key = f"col_{col_idx}"
+            if column["type"] == "cycle":
+                # Check if this module participated in this cycle
+                if module in column["by_module"]:
+                    row["columns"][col_key] = {
+                        "present": True,
+                        "type": "cycle",
+                        "event_name": column["event_name"],
+                        "cycle_name": column["cycle_name"],
+                        "temperatures": column["temperatures"],
+                    }
+                else:
+                    row["columns"][col_key] = {"present": False}
+            else:
+                # All tests of this type for this module in this segment
+                module_tests_in_column = column["by_module"].get(module)
+                if module_tests_in_column:
+                    # Count tests by status
+                    passed = sum(1 for t in module_tests_in_column if t.get("run_status") == "done")
+                    row["columns"][col_key] = {
+                        "present": True,
+                        "type": "test_group",
+                        "test_type": column["test_type"],
+                        "count": len(module_tests_in_column),
+                        "passed": passed,
+                        "failed": len(module_tests_in_column) - passed,
+                        "tests": module_tests_in_column,  # List of all tests
+                    }
+                else:
+                    row["columns"][col_key] = {"present": False}
+        flow_matrix.append(row)
+    return flow_matrix
+
+
+def build_testing_flow(modules_list, module_test_events, burnin_events):
+    """
+    Builds the columns and the flow matrix of a session from its test events (one per module test)
+    and burn-in events (one per module in each cycle).
+
+    Returns:
+        (columns, flow_matrix)
+    """
+    # parse every timestamp once, and sort the events by it (stable, tests before cycles on ties)
+    all_events = [(parse_timestamp(event.get("timestamp")), event) for event in module_test_events + burnin_events]
+    all_events.sort(key=lambda item: item[0])
+
+    # Group cycle events by their cycle name (since same cycle applies to all modules)
+    cycle_groups = {}
+    test_events = []
+    test_times = []
+    for time, event in all_events:
+        if event.get("type") == "cycle":
+            cycle_name = event.get("cycle_name")
+            if cycle_name not in cycle_groups:
+                cycle_groups[cycle_name] = {
+                    "time": time,
+                    "data": {
+                        "cycle_name": cycle_name,
+                        "event_name": event.get("event_name"),
+                        "timestamp": event.get("timestamp"),
+                        "temperatures": event.get("temperatures"),
+                        "modules": [],
+                    },
+                }
+            cycle_groups[cycle_name]["data"]["modules"].append(event.get("module_name"))
+        elif event.get("type") == "test":
+            test_events.append(event)
+            test_times.append(time)
+
+    # the cycles are already in time order, as they were created following the sorted events
+    cycle_events = list(cycle_groups.values())
+
+    segments = build_segments(test_events, test_times, cycle_events)
+    columns = build_columns(segments)
+    flow_matrix = build_flow_matrix(modules_list, columns)
+    for column in columns:
+        del column["by_module"]
+    return columns, flow_matrix
@@ -1,16 +1,219 @@
 from flask import current_app, g
 from json import JSONEncoder
-from pymongo import MongoClient
-from bson import ObjectId
+from pymongo import MongoClient, monitoring
+from pymongo.errors import OperationFailure
+from bson import ObjectId, Decimal128
 import json
 import os
 from flask.json.provider import JSONProvider
 import re
 from bson import json_util
 import datetime
+import threading
+import time
 
+try:
+    import orjson
+except ImportError:
+    # optional: the stdlib json is used without it
+    orjson = None
 
-def get_db():
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    A pymongo connection pool listener that keeps running counters of pool checkouts.
+
+    The time spent waiting for a connection is measured between the check out
+    started and the checked out (or check out failed) events, which pymongo
+    publishes from the same thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {
+                "pools_created": 0,
+                "pools_cleared": 0,
+                "connections_created": 0,
+                "connections_closed": 0,
+                "checkouts_started": 0,
+                "checkouts": 0,
+                "checkouts_failed": 0,
+                "checkins": 0,
+                "wait_time_total_ms": 0.0,
+                "wait_time_max_ms": 0.0,
+                "checkout_failure_reasons": {},
+            }
+
+    def _wait_time_ms(self):
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        if started is None:
+            return 0.0
+        return (time.perf_counter() - started) * 1000.0
+
+    def _add_wait(self, wait_ms):
+        self.counters["wait_time_total_ms"] += wait_ms
+        if wait_ms > self.counters["wait_time_max_ms"]:
+            self.counters["wait_time_max_ms"] = wait_ms
+
+    def pool_created(self, event):
+        with self._lock:
+            self.counters["pools_created"] += 1
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.counters["pools_cleared"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.counters["connections_created"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.counters["connections_closed"] += 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self.counters["checkouts_started"] += 1
+
+    def connection_check_out_failed(self, event):
+        wait_ms = self._wait_time_ms()
+        with self._lock:
+            self.counters["checkouts_failed"] += 1
+            reasons = self.counters["checkout_failure_reasons"]
+            reasons[str(event.reason)] = reasons.get(str(event.reason), 0) + 1
+            self._add_wait(wait_ms)
+
+    def connection_checked_out(self, event):
+        wait_ms = self._wait_time_ms()
+        with self._lock:
+            self.counters["checkouts"] += 1
+            self._add_wait(wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.counters["checkins"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["checkout_failure_reasons"] = dict(self.counters["checkout_failure_reasons"])
+        stats["open_connections"] = stats["connections_created"] - stats["connections_closed"]
+        stats["in_use_connections"] = stats["checkouts"] - stats["checkins"]
+        finished = stats["checkouts"] + stats["checkouts_failed"]
+        stats["wait_time_avg_ms"] = stats["wait_time_total_ms"] / finished if finished else 0.0
+        return stats
+
+
+class MongoClientRegistry:
+    """
+    A process-wide registry of pooled MongoClients, one per mongo uri.
+
+    A MongoClient is thread-safe and keeps its own connection pool, so it has to be
+    created once per process and reused by all the requests. MongoClients are not
+    fork-safe though: when a gunicorn worker is forked from a master that already
+    opened a client (e.g. while creating the indexes in create_app), the child
+    must open its own. The registry is therefore keyed by pid as well.
+    """
+
+    def __init__(self, max_pool_size=50, min_pool_size=0, wait_queue_timeout_ms=5000, max_idle_time_ms=60000, event_listeners=()):
+        # other listeners added to every client, e.g. the command listener of the request metrics
+        self.event_listeners = list(event_listeners)
+        self.options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "waitQueueTimeoutMS": wait_queue_timeout_ms,
+            "maxIdleTimeMS": max_idle_time_ms,
+        }
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients = {}
+        self._listeners = {}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # the clients (and the lock) were inherited from the parent process:
+            # drop them without closing, the parent is still using their sockets
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            self._clients = {}
+            self._listeners = {}
+
+    def get_client(self, mongo_uri):
+        self._check_fork()
+        client = self._clients.get(mongo_uri)
+        if client is not None:
+            return client
+        with self._lock:
+            if mongo_uri not in self._clients:
+                listener = PoolStatsListener()
+                self._clients[mongo_uri] = MongoClient(mongo_uri, event_listeners=[listener] + self.event_listeners, **self.options)
+                self._listeners[mongo_uri] = listener
+            return self._clients[mongo_uri]
+
+    def stats(self):
+        self._check_fork()
+        return {
+            "pid": self._pid,
+            "options": self.options,
+            "clients": [
+                {
+                    # never expose the credentials
+                    "host": mongo_uri.split("@")[-1],
+                    "pool": listener.snapshot(),
+                }
+                for mongo_uri, listener in list(self._listeners.items())
+            ],
+        }
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+            self._listeners = {}
+
+
+def init_client_registry(app):
+    """Creates the MongoClientRegistry of the app, configured from app.config."""
+    app.extensions["mongo_client_registry"] = MongoClientRegistry(
+        max_pool_size=app.config.get("MONGO_MAX_POOL_SIZE", 50),
+        min_pool_size=app.config.get("MONGO_MIN_POOL_SIZE", 0),
+        wait_queue_timeout_ms=app.config.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+        max_idle_time_ms=app.config.get("MONGO_MAX_IDLE_TIME_MS", 60000),
+        event_listeners=[app.extensions["request_metrics"].listener] if "request_metrics" in app.extensions else [],
+    )
+    return app.extensions["mongo_client_registry"]
+
+
+def get_client_registry():
+    registry = current_app.extensions.get("mongo_client_registry")
+    if registry is None:
+        registry = init_client_registry(current_app)
+    return registry
+
+
+def get_server_uri():
     # the current app mongo uri contains the database name after the /, we need to drop it
     mongo_uri = current_app.config["MONGO_URI"] # something like mongodb://localhost:27017/mydatabase
     # want to drop /mydatabase
@@ -19,22 +222,37 @@ def get_db():
         mongo_uri = mongo_uri[:-1]
     if 'MONGO_DB_NAME' in current_app.config:
         mongo_uri = mongo_uri.rsplit('/', 1)[0]
+    return mongo_uri
+
+
+def get_db():
     if 'db' not in g:
-        g.db = MongoClient(mongo_uri)[current_app.config["MONGO_DB_NAME"]]
+        client = get_client_registry().get_client(get_server_uri())
+        g.db = client[current_app.config["MONGO_DB_NAME"]]
     return g.db
 
 def get_unittest_db():
-        # the current app mongo uri contains the database name after the /, we need to drop it
-    if 'MONGO_DB_NAME' in current_app.config:
-        mongo_uri = current_app.config["MONGO_URI"]
-    if mongo_uri.endswith('/'):
-        mongo_uri = mongo_uri[:-1]
-    if 'MONGO_DB_NAME' in current_app.config:
-        mongo_uri = mongo_uri.rsplit('/', 1)[0]
     if 'unittest_db' not in g:
-        g.unittest_db = MongoClient(mongo_uri)["unittest_db"]
+        client = get_client_registry().get_client(get_server_uri())
+        g.unittest_db = client["unittest_db"]
     return g.unittest_db
 
+
+def run_in_transaction(db, callback):
+    """
+    Runs callback(session) inside a multi-document transaction, retried by the driver
+    on transient errors. Standalone servers do not support transactions: in that case
+    callback(None) is run without one, and it is up to the caller to clean up on failure.
+    """
+    with db.client.start_session() as session:
+        try:
+            return session.with_transaction(callback)
+        except OperationFailure as e:
+            # IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+            if e.code != 20:
+                raise
+    return callback(None)
+
 # define regexps to select module ids, crateid, etc
 def regExpPatterns(s):
     mapRE = {"ModuleID": "PS_[0-9A-Z_\\-]+"}
@@ -46,6 +264,35 @@ def regExpPatterns(s):
 def findModuleIds(istring):
     return re.findall(regExpPatterns("ModuleID"),istring)
 
+def bson_default(obj):
+    """
+    The JSON form of the BSON types that JSON does not have, shared by all the responses:
+    ObjectIds as their hex string, dates and datetimes in ISO 8601, Decimal128 as a string,
+    numpy arrays (e.g. the decoded IV curves) as lists.
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    elif isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    elif isinstance(obj, Decimal128):
+        return str(obj)
+    elif numpy is not None and isinstance(obj, (numpy.ndarray, numpy.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# int keys as in the stdlib json, numpy arrays as lists
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) if orjson is not None else 0
+
+
+def dumpb(obj):
+    """Encodes obj (e.g. documents as returned by pymongo) to JSON bytes."""
+    if orjson is not None:
+        # orjson encodes the datetimes itself, in the same ISO 8601 form as bson_default
+        return orjson.dumps(obj, default=bson_default, option=ORJSON_OPTIONS)
+    return json.dumps(obj, default=bson_default).encode()
+
+
 class CustomJSONEncoder(JSONEncoder):
     """
     A custom JSON encoder that converts MongoDB ObjectIds to strings.
@@ -56,24 +303,36 @@ class CustomJSONEncoder(JSONEncoder):
     """
 
     def default(self, obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        elif isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        return super().default(obj)
+        try:
+            return bson_default(obj)
+        except TypeError:
+            return super().default(obj)
 
 
 class CustomJSONProvider(JSONProvider):
     """
-    A custom JSON provider that uses a custom JSON encoder to serialize objects.
+    A custom JSON provider that encodes the documents straight to bytes with orjson when it is
+    installed, with the stdlib json and CustomJSONEncoder otherwise (or when stdlib options are given).
     """
 
     def dumps(self, obj, **kwargs):
-        return json.dumps(obj, **kwargs, cls=CustomJSONEncoder)
+        if kwargs or orjson is None:
+            return json.dumps(obj, **kwargs, cls=CustomJSONEncoder)
+        return dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        return dumpb(obj)
 
     def loads(self, s, **kwargs):
-        return json.loads(s, **kwargs)
-    
+        if kwargs or orjson is None:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # the body is kept as bytes, without a round trip through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return current_app.response_class(self.dumpb(obj), mimetype="application/json")
+
 
 # load schemas
 base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
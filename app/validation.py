@@ -0,0 +1,102 @@
+# JSON-schema validators of all_schemas.json, compiled once per process
+#
+# jsonschema.validate(instance, schema) checks the schema and builds a new validator on every
+# call. The registry checks each schema once, keeps its Draft7Validator, and raises the same
+# ValidationError (the best match) as jsonschema.validate.
+# When fastjsonschema is installed, the hot schemas (FAST_SCHEMAS) are also compiled to
+# specialized Python code, used to accept the valid documents. A document it rejects is checked
+# again by the Draft7Validator, which decides (and builds the error): fastjsonschema enforces
+# the formats, e.g. a date-time without a timezone, that the app has always accepted.
+
+import os
+import sys
+import threading
+
+from jsonschema import Draft7Validator, FormatChecker, ValidationError
+from jsonschema.exceptions import best_match
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import all_schemas
+
+# schemas validated on every write of the testing flow, or thousands of times by the imports
+FAST_SCHEMAS = ("moduleTest", "testRun", "IVScans", "logbook", "module")
+
+
+class ValidatorRegistry:
+    """Compiles the validators of a set of named schemas on first use and keeps them."""
+
+    def __init__(self, schemas, fast_schemas=FAST_SCHEMAS, check_formats=False):
+        self.schemas = schemas
+        self.fast_schemas = set(fast_schemas) if fastjsonschema is not None else set()
+        # the formats are not checked by jsonschema.validate, which the resources used
+        self.format_checker = FormatChecker() if check_formats else None
+        self._lock = threading.Lock()
+        self._validators = {}
+        self._fast = {}
+
+    def get(self, name):
+        """Returns the Draft7Validator of the schema, compiled on the first call."""
+        validator = self._validators.get(name)
+        if validator is None:
+            with self._lock:
+                validator = self._validators.get(name)
+                if validator is None:
+                    schema = self.schemas[name]
+                    Draft7Validator.check_schema(schema)
+                    validator = Draft7Validator(schema, format_checker=self.format_checker)
+                    self._validators[name] = validator
+        return validator
+
+    def _get_fast(self, name):
+        if name not in self.fast_schemas:
+            return None
+        if name not in self._fast:
+            with self._lock:
+                if name not in self._fast:
+                    try:
+                        self._fast[name] = fastjsonschema.compile(self.schemas[name])
+                    except fastjsonschema.JsonSchemaDefinitionException:
+                        # a construct the code generator does not support: the Draft7Validator only
+                        self._fast[name] = None
+        return self._fast[name]
+
+    def validate(self, instance, name):
+        """Raises a jsonschema ValidationError if instance is not valid against the schema."""
+        fast = self._get_fast(name)
+        if fast is not None:
+            try:
+                fast(instance)
+                return
+            except fastjsonschema.JsonSchemaException:
+                pass
+        error = best_match(self.get(name).iter_errors(instance))
+        if error is not None:
+            raise error
+
+    def is_valid(self, instance, name):
+        try:
+            self.validate(instance, name)
+        except ValidationError:
+            return False
+        return True
+
+
+registry = ValidatorRegistry(all_schemas)
+
+
+def get_validator(name):
+    """Returns the cached Draft7Validator of a schema of all_schemas.json."""
+    return registry.get(name)
+
+
+def validate_entry(instance, name):
+    """
+    Validates instance against the schema of all_schemas.json with the given name
+    (e.g. "moduleTest"), raising a jsonschema ValidationError as jsonschema.validate does.
+    """
+    registry.validate(instance, name)
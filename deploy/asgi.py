@@ -0,0 +1,7 @@
+import sys
+
+sys.path.append("..")
+from app.asgi import create_asgi_app
+
+# ASGI mode (see app/asgi.py): uvicorn asgi:app
+app = create_asgi_app('prod')
@@ -1,6 +1,6 @@
 from pymongo import MongoClient
 import json
-from jsonschema import validate, ValidationError
+from jsonschema import Draft7Validator, ValidationError
 from dotenv import load_dotenv
 import os
 
@@ -10,9 +10,10 @@ password = os.environ.get('MONGO_PASSWORD')
 db_name = os.environ.get('MONGO_DB_NAME')
 
 
-def insert_module(data, schema=None):
+def insert_module(data, validator):
+    # the validator is compiled once and reused for every module
     try:
-        validate(instance=data, schema=schema)
+        validator.validate(data)
         modules_collection.insert_one(data)
         print("Insert successful")
     except ValidationError as e:
@@ -27,6 +28,8 @@ if __name__ == '__main__':
     modules_collection = db['modules']
     with open('module_schema.json', 'r') as f:
         module_schema = json.load(f)
+    Draft7Validator.check_schema(module_schema)
+    module_validator = Draft7Validator(module_schema)
 
     # Sample data
     sample_module_data = {
@@ -39,7 +42,7 @@ if __name__ == '__main__':
         "overall_grade": "A"
     }
 
-    insert_module(sample_module_data, module_schema)
+    insert_module(sample_module_data, module_validator)
 
     # print all documents in the collection
     for doc in modules_collection.find():
@@ -0,0 +1,146 @@
+"""
+Benchmark of the module summary and session pipelines with the _id references stored as strings
+(unwind + $toObjectId before each $lookup, as before the migration) and as native ObjectIds
+(direct $lookup on the arrays).
+
+Two scratch databases are populated with the same synthetic sessions, runs, module tests and
+modules, one per storage format, and dropped at the end.
+
+usage: MONGO_URI=mongodb://... python3 benchmark_references.py [--sessions 20] [--runs 10] [--modules 50] [--repeat 3]
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app")))
+from module_summaries import module_summary_pipeline, module_tests_lookup
+from blueprints.TBPS_blueprints import session_with_related_data_pipeline
+
+# stages of the pipelines before the migration, replacing the direct lookups
+LEGACY_MODULE_TESTS_LOOKUP = [
+    {"$unwind": {"path": "$_moduleTest_id", "preserveNullAndEmptyArrays": True}},
+    {"$addFields": {"testId": "$_moduleTest_id"}},
+    {"$addFields": {"testId": {"$toObjectId": "$testId"}}},
+    {"$lookup": {"from": "module_tests", "localField": "testId", "foreignField": "_id", "as": "testDetails"}},
+    {"$addFields": {"testDetail": {"$arrayElemAt": ["$testDetails", 0]}}},
+]
+LEGACY_SESSION_LOOKUPS = [
+    {"$unwind": {"path": "$_test_run_id", "preserveNullAndEmptyArrays": True}},
+    {"$addFields": {"runId": "$_test_run_id"}},
+    {"$addFields": {"runId": {"$toObjectId": "$runId"}}},
+    {"$lookup": {"from": "test_runs", "localField": "runId", "foreignField": "_id", "as": "runDetails"}},
+    {"$addFields": {"runDetail": {"$arrayElemAt": ["$runDetails", 0]}}},
+    {"$unwind": {"path": "$runDetail._moduleTest_id", "preserveNullAndEmptyArrays": True}},
+    {"$addFields": {"moduleTestId": "$runDetail._moduleTest_id"}},
+    {"$addFields": {"moduleTestId": {"$toObjectId": "$moduleTestId"}}},
+    {"$lookup": {"from": "module_tests", "localField": "moduleTestId", "foreignField": "_id", "as": "moduleTestDetails"}},
+    {"$addFields": {"moduleTest": {"$arrayElemAt": ["$moduleTestDetails", 0]}}},
+]
+# number of stages of the current pipelines replaced by the legacy ones (after the $match)
+SESSION_LOOKUP_STAGES = 6
+
+
+def legacy_module_summary_pipeline(match):
+    pipeline = module_summary_pipeline(match)
+    return pipeline[:1] + LEGACY_MODULE_TESTS_LOOKUP + pipeline[1 + len(module_tests_lookup()):]
+
+
+def legacy_session_pipeline(session_name):
+    pipeline = session_with_related_data_pipeline(session_name)
+    return pipeline[:1] + LEGACY_SESSION_LOOKUPS + pipeline[1 + SESSION_LOOKUP_STAGES:]
+
+
+def populate(db, n_sessions, n_runs, n_modules, as_strings):
+    """Fills db with n_sessions sessions of n_runs runs, each testing the same n_modules modules."""
+    ref = str if as_strings else (lambda value: value)
+    start = datetime.datetime(2024, 1, 1)
+    modules, sessions, runs, module_tests = [], [], [], []
+    for s in range(n_sessions):
+        module_docs = [
+            {"_id": ObjectId(), "moduleName": f"PS_{s:03d}_{m:04d}", "type": "module", "position": "cleanroom",
+             "status": "tested", "_moduleTest_id": [], "moduleTestName": []}
+            for m in range(n_modules)
+        ]
+        session = {"_id": ObjectId(), "sessionName": f"session{s + 1}", "operator": "benchmark",
+                   "timestamp": start, "description": "", "modulesList": [m["moduleName"] for m in module_docs],
+                   "_test_run_id": [], "test_runName": []}
+        for r in range(n_runs):
+            run_name = f"run{s * n_runs + r + 1}"
+            run = {"_id": ObjectId(), "test_runName": run_name, "runSession": session["sessionName"],
+                   "runDate": start + datetime.timedelta(hours=s * n_runs + r), "runStatus": "done",
+                   "runType": "IV", "_moduleTest_id": [], "moduleTestName": []}
+            for module in module_docs:
+                test = {"_id": ObjectId(), "moduleTestName": f"{module['moduleName']}__{run_name}",
+                        "test_runName": run_name, "moduleName": module["moduleName"],
+                        "_test_run_id": run["_id"], "_module_id": module["_id"], "noise": {}}
+                module_tests.append(test)
+                run["_moduleTest_id"].append(ref(test["_id"]))
+                run["moduleTestName"].append(test["moduleTestName"])
+                module["_moduleTest_id"].append(ref(test["_id"]))
+                module["moduleTestName"].append(test["moduleTestName"])
+            runs.append(run)
+            session["_test_run_id"].append(ref(run["_id"]))
+            session["test_runName"].append(run_name)
+        modules.extend(module_docs)
+        sessions.append(session)
+    db["modules"].insert_many(modules)
+    db["sessions"].insert_many(sessions)
+    db["test_runs"].insert_many(runs)
+    db["module_tests"].insert_many(module_tests)
+    # the indexes created by create_app
+    db["modules"].create_index("moduleName")
+    db["sessions"].create_index("sessionName")
+    db["test_runs"].create_index("test_runName")
+    db["module_tests"].create_index("moduleTestName")
+    db["module_test_analysis"].create_index("moduleTestAnalysisName")
+    return [session["sessionName"] for session in sessions]
+
+
+def best_of(repeat, run):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - t0)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--modules", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--db-prefix", default="benchmark_references")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+    variants = [
+        ("strings + $toObjectId", True, legacy_module_summary_pipeline, legacy_session_pipeline),
+        ("ObjectIds, direct lookup", False, module_summary_pipeline, session_with_related_data_pipeline),
+    ]
+    try:
+        for label, as_strings, summary_pipeline, session_pipeline in variants:
+            db = client[f"{args.db_prefix}_{'strings' if as_strings else 'objectids'}"]
+            client.drop_database(db.name)
+            session_names = populate(db, args.sessions, args.runs, args.modules, as_strings)
+            summaries = best_of(args.repeat, lambda: list(db["modules"].aggregate(summary_pipeline({}))))
+            sessions = best_of(args.repeat, lambda: [
+                list(db["sessions"].aggregate(session_pipeline(name))) for name in session_names
+            ])
+            print(
+                f"{label:26s} module tests={db['module_tests'].estimated_document_count():7d}  "
+                f"all module summaries={summaries * 1000:8.1f} ms  all sessions={sessions * 1000:8.1f} ms"
+            )
+    finally:
+        for suffix in ["strings", "objectids"]:
+            client.drop_database(f"{args.db_prefix}_{suffix}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark of the testing flow segmentation (app/testing_flow.py) on synthetic sessions.
+
+Generates sessions with many modules, burn-in cycles and test runs, shaped like the output of
+the two aggregations of /fetch_session_testing_flow, and times build_testing_flow.
+
+usage: python3 benchmark_testing_flow.py [--modules 300] [--cycles 40] [--runs-per-step 2] [--repeat 5]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app")))
+from testing_flow import build_testing_flow
+
+TEST_TYPES = ["PS_Module_settings", "IV", "full", "noise"]
+
+
+def synthetic_session(n_modules, n_cycles, runs_per_step, seed=0):
+    """
+    Returns (modules_list, module_test_events, burnin_events) of a session where all the modules
+    are tested runs_per_step times before the first cycle and after each cycle.
+    """
+    rng = random.Random(seed)
+    modules_list = [f"PS_26_05-IBA_{i:05d}" for i in range(n_modules)]
+    start = datetime.datetime(2024, 1, 1)
+    test_events = []
+    burnin_events = []
+    t = start
+    for step in range(n_cycles + 1):
+        if step > 0:
+            t += datetime.timedelta(hours=1)
+            cycle_name = f"cycle{step}_session1"
+            # half of the cycle timestamps come as strings, as in the burnin_cycles collection
+            timestamp = t.isoformat() if step % 2 else t
+            for module in modules_list:
+                burnin_events.append({
+                    "type": "cycle",
+                    "timestamp": timestamp,
+                    "module_name": module,
+                    "cycle_name": cycle_name,
+                    "temperatures": {"low": -35, "high": 20},
+                    "event_name": "Cycle -35°C/20°C",
+                })
+        for run in range(runs_per_step):
+            t += datetime.timedelta(minutes=10)
+            test_type = rng.choice(TEST_TYPES)
+            for module in modules_list:
+                test_events.append({
+                    "type": "test",
+                    "timestamp": t,
+                    "module_name": module,
+                    "test_type": test_type,
+                    "test_name": f"{module}__run{step}_{run}",
+                    "run_name": f"run{step}_{run}",
+                    "run_status": rng.choice(["done", "failed"]),
+                    "event_name": test_type,
+                })
+    return modules_list, test_events, burnin_events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", type=int, default=300)
+    parser.add_argument("--cycles", type=int, default=40)
+    parser.add_argument("--runs-per-step", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # also time smaller sessions, to show how the cost scales
+    for scale in [0.25, 0.5, 1]:
+        n_modules = max(1, int(args.modules * scale))
+        n_cycles = max(1, int(args.cycles * scale))
+        modules_list, test_events, burnin_events = synthetic_session(n_modules, n_cycles, args.runs_per_step)
+        timings = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            columns, flow_matrix = build_testing_flow(modules_list, test_events, burnin_events)
+            timings.append(time.perf_counter() - t0)
+        print(
+            f"modules={n_modules:5d} cycles={n_cycles:3d} events={len(test_events) + len(burnin_events):7d} "
+            f"columns={len(columns):4d}  best={min(timings) * 1000:8.1f} ms  "
+            f"mean={sum(timings) / len(timings) * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
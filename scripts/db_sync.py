@@ -1,15 +1,18 @@
-import subprocess
 import csv
+import datetime
+import hashlib
 import io
+import json
 import sys
 import requests
 from pymongo import MongoClient
 import os
 import logging
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 import argparse
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from app.utils import module_schema
+from app.validation import validate_entry
+from rhapi import RhApi
 
 # Constants
 API_URL = os.environ["API_URL"]
@@ -18,6 +21,7 @@ DB_NAME = os.environ["MONGO_DB_NAME"]
 
 # Directory where rhapi.py is located (same as this script)
 RHAPI_DIR = os.path.dirname(os.path.abspath(__file__))
+RHAPI_URL = "https://cmsdca.cern.ch/trk_rhapi"
 
 PARTS_TABLES = {
     "PS Module": "p9020",
@@ -34,29 +38,73 @@ PARTS_TABLES = {
     "MPA Chip": "p11420"
 }
 
+# the delta sync only queries the rows of these tables changed since the last successful sync
+RELATIONSHIPS_TABLE = "trkr_relationships_v"
+CHANGE_COLUMN = "RECORD_LASTUPDATE_TIME"
+# per-table watermarks, in the metadata collection
+WATERMARKS_DOC = {"name": "db_sync_watermarks"}
+# the watermark is set this long before the start of the sync, to cover the clock/timezone
+# difference with the central DB (the rows seen twice are skipped by the content hash)
+WATERMARK_OVERLAP = datetime.timedelta(hours=6)
+WATERMARK_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def run_rhapi_command(command):
-    # Change to the directory where rhapi.py is located
-    result = subprocess.run(command, capture_output=True, text=True, shell=True, cwd=RHAPI_DIR)
-    if result.returncode != 0:
-        logging.error(f"Command failed: {command}\n{result.stderr}")
-    return result.stdout
+# a single client for the whole sync, so that the HTTP connections and the SSO cookies
+# are reused by all the queries
+_rhapi = None
+
+def get_rhapi():
+    global _rhapi
+    if _rhapi is None:
+        # the login cache is next to rhapi.py, as when it was run from this directory
+        _rhapi = RhApi(RHAPI_URL, sso="login", sso_cache_file=os.path.join(RHAPI_DIR, ".session.cache"))
+    return _rhapi
+
+# a sync moving the watermarks must not take a failed query for an empty result: main() sets this,
+# so that the queries raise instead (the other scripts keep getting "" on failure)
+_strict_queries = False
+
+class CentralQueryError(Exception):
+    """Raised when a query on the central DB fails during a sync that moves the watermarks"""
+
+def run_rhapi_query(query):
+    """
+    Runs a query on the central DB, returning all the rows as CSV (empty string on failure,
+    CentralQueryError in a sync moving the watermarks)
+    """
+    try:
+        # clean=True drops the cached result, so that the query is run again on fresh data
+        return get_rhapi().csv_all(query, clean=True)
+    except Exception as e:
+        logging.error(f"Query failed: {query}\n{e}")
+        if _strict_queries:
+            raise CentralQueryError(f"Query failed: {query}") from e
+        return ""
 
 def parse_csv_output(output):
     csv_reader = csv.DictReader(io.StringIO(output))
     return list(csv_reader)
 
-def get_central_modules(by_name=False, location="Pisa"):
+def changed_since_clause(since, alias="p", change_column=CHANGE_COLUMN):
+    """SQL condition selecting the rows changed since the watermark (a WATERMARK_FORMAT string)"""
+    return f"{alias}.{change_column} >= TO_DATE('{since}', 'YYYY-MM-DD HH24:MI:SS')"
+
+def get_central_modules(by_name=False, location="Pisa", since=None, change_column=CHANGE_COLUMN):
     if by_name:
-        command = """python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.p9020 p where p.name_label LIKE '%IBA%' OR p.name_label LIKE '%IPG%'" --all --login -n"""
+        query = "select * from trker_cmsr.p9020 p where (p.name_label LIKE '%IBA%' OR p.name_label LIKE '%IPG%')"
     else:
-        command = f"""python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.p9020 p where p.location LIKE 'IT-{location}[INFN {location}]'" --all --login -n"""
-    output = run_rhapi_command(command)
+        query = f"select * from trker_cmsr.p9020 p where p.location LIKE 'IT-{location}[INFN {location}]'"
+    if since:
+        query += f" and {changed_since_clause(since, change_column=change_column)}"
+        # an empty result is expected when nothing changed, and a failure must not look like one
+        output = get_rhapi().csv_all(query, clean=True)
+        return parse_csv_output(output) if output.strip() else []
+    output = run_rhapi_query(query)
     
     if not output or not output.strip():
-        logging.error(f"No output received from central DB query. Command: {command}")
+        logging.error(f"No output received from central DB query. Query: {query}")
         return []
     
     try:
@@ -67,11 +115,17 @@ def get_central_modules(by_name=False, location="Pisa"):
             first_module = modules[0]
             if 'SERIAL_NUMBER' not in first_module or not first_module.get('SERIAL_NUMBER'):
                 logging.error(f"Invalid module data received. First row: {first_module}")
+                if _strict_queries:
+                    raise CentralQueryError(f"Invalid module data received for query: {query}")
                 return []
         return modules
+    except CentralQueryError:
+        raise
     except Exception as e:
         logging.error(f"Failed to parse central DB output: {e}")
         logging.error(f"Output was: {output[:500]}")  # Log first 500 chars
+        if _strict_queries:
+            raise CentralQueryError(f"Failed to parse the output of query: {query}") from e
         return []
 
 def get_local_modules(db_name):
@@ -88,10 +142,10 @@ def get_local_modules(db_name):
 def get_children_of_modules(parent_labels, PSROH=False):
     labels = "', '".join(parent_labels)
     if PSROH:
-        command = f"""python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.trkr_relationships_v r where r.parent_serial_number in ('{labels}')" --all --login -n"""
+        query = f"select * from trker_cmsr.trkr_relationships_v r where r.parent_serial_number in ('{labels}')"
     else:
-        command = f"""python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.trkr_relationships_v r where r.parent_name_label in ('{labels}')" --all --login -n"""
-    output = run_rhapi_command(command)
+        query = f"select * from trker_cmsr.trkr_relationships_v r where r.parent_name_label in ('{labels}')"
+    output = run_rhapi_query(query)
     return parse_csv_output(output)
 
 def get_component_details_in_bulk(component_type, identifiers):
@@ -104,8 +158,8 @@ def get_component_details_in_bulk(component_type, identifiers):
     ids = "', '".join(identifiers)
     # if component_type == "PS Read-out Hybrid":
     #     print(ids)
-    command = f"""python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.{table} p where p.{id_field} in ('{ids}')" --all --login -n"""
-    output = run_rhapi_command(command)
+    query = f"select * from trker_cmsr.{table} p where p.{id_field} in ('{ids}')"
+    output = run_rhapi_query(query)
     details = parse_csv_output(output)
     if component_type == "MaPSA":
         # MaPSA has two children: PS-p Sensor and MPA Chip
@@ -199,6 +253,11 @@ def process_children(children, all_component_details):
 
     return processed
 
+def content_hash(details, children):
+    """Hash of the central DB content of a module, stored as syncHash to skip unchanged updates"""
+    payload = json.dumps({"details": details, "children": children}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
 def process_module(module, children_map, all_component_details, mongo_collection):
     """Process a NEW module - creates full document with all fields"""
     module_id = module.get("SERIAL_NUMBER")
@@ -213,9 +272,10 @@ def process_module(module, children_map, all_component_details, mongo_collection
         "type": "module",
         "position": "cleanroom"
     }
+    module_doc["syncHash"] = content_hash(module_doc["details"], module_doc["children"])
 
     try:
-        validate(instance=module_doc, schema=module_schema)
+        validate_entry(module_doc, "module")
         mongo_collection.update_one(
             {"moduleName": module_id},
             {"$set": module_doc},
@@ -225,12 +285,15 @@ def process_module(module, children_map, all_component_details, mongo_collection
         logging.error(f"Validation error for module {module_id}: {e}")
         raise
 
-def update_existing_module(module, children_map, all_component_details, mongo_collection):
-    """Update an EXISTING module - only updates details and children fields"""
+def update_existing_module(module, children_map, all_component_details, mongo_collection, stored_hash=None):
+    """
+    Update an EXISTING module - only updates details and children fields.
+    Returns False if the module was skipped because its content did not change since the last sync.
+    """
     module_id = module.get("SERIAL_NUMBER")
     if not module_id:
         logging.error(f"No SERIAL_NUMBER for module: {module}")
-        return
+        return False
     
     children = children_map.get(module["NAME_LABEL"], [])
     
@@ -239,29 +302,37 @@ def update_existing_module(module, children_map, all_component_details, mongo_co
         "details": module,
         "children": process_children(children, all_component_details)
     }
+    sync_hash = content_hash(update_doc["details"], update_doc["children"])
+    if sync_hash == stored_hash:
+        return False
+    update_doc["syncHash"] = sync_hash
     
     try:
         # Validate the fields we're updating (create a minimal doc for validation)
         validation_doc = {
             "moduleName": module_id,
-            "details": module,
-            "children": process_children(children, all_component_details),
+            "details": update_doc["details"],
+            "children": update_doc["children"],
             "type": "module",
             "position": "cleanroom"
         }
-        validate(instance=validation_doc, schema=module_schema)
+        validate_entry(validation_doc, "module")
         
         # Only update the specified fields, preserve everything else
         mongo_collection.update_one(
             {"moduleName": module_id},
             {"$set": update_doc}
         )
+        return True
     except ValidationError as e:
         logging.error(f"Validation error for module {module_id}: {e}")
         raise
 
-def get_modules_by_serial_numbers(serial_numbers):
-    """Get module details from central DB by serial numbers (for modules that may have moved)"""
+def get_modules_by_serial_numbers(serial_numbers, since=None, change_column=CHANGE_COLUMN):
+    """
+    Get module details from central DB by serial numbers (for modules that may have moved).
+    With since, only the modules changed since then are returned, and a failed query raises.
+    """
     if not serial_numbers:
         return []
     
@@ -272,8 +343,12 @@ def get_modules_by_serial_numbers(serial_numbers):
     for i in range(0, len(serial_numbers), batch_size):
         batch = serial_numbers[i:i+batch_size]
         serials = "', '".join(batch)
-        command = f"""python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.p9020 p where p.serial_number in ('{serials}')" --all --login -n"""
-        output = run_rhapi_command(command)
+        query = f"select * from trker_cmsr.p9020 p where p.serial_number in ('{serials}')"
+        if since:
+            query += f" and {changed_since_clause(since, change_column=change_column)}"
+            output = get_rhapi().csv_all(query, clean=True)
+        else:
+            output = run_rhapi_query(query)
         
         if output and output.strip():
             try:
@@ -281,15 +356,101 @@ def get_modules_by_serial_numbers(serial_numbers):
                 all_modules.extend(modules)
             except Exception as e:
                 logging.error(f"Failed to parse modules by serial numbers: {e}")
+                if _strict_queries:
+                    raise CentralQueryError(f"Failed to parse the output of query: {query}") from e
     
     return all_modules
 
+def load_watermarks(db):
+    """Returns the per-table watermarks of the last successful sync ({} if there was none)"""
+    doc = db["metadata"].find_one(WATERMARKS_DOC) or {}
+    return doc.get("watermarks", {})
+
+def save_watermarks(db, tables, started_at):
+    """Moves the watermark of the tables to the start of this sync (minus the overlap)"""
+    watermark = (started_at - WATERMARK_OVERLAP).strftime(WATERMARK_FORMAT)
+    db["metadata"].update_one(
+        WATERMARKS_DOC,
+        {"$set": {f"watermarks.{table}": watermark for table in tables}},
+        upsert=True
+    )
+    logging.info(f"Watermark of {len(tables)} tables set to {watermark}.")
+
+def build_children_index(local_modules):
+    """Maps the name of every component (and subcomponent) stored in a local module to the module names"""
+    index = {}
+    for module in local_modules:
+        for child in (module.get("children") or {}).values():
+            for child_doc in (child if isinstance(child, list) else [child]):
+                if isinstance(child_doc, dict) and child_doc.get("childName"):
+                    index.setdefault(child_doc["childName"], set()).add(module["moduleName"])
+    return index
+
+def get_changed_component_ids(watermarks, change_column=CHANGE_COLUMN):
+    """
+    Returns the identifiers of the components (of all the PARTS_TABLES but the modules one) and of the
+    parents in the relationships changed since their table's watermark. Raises if a query fails.
+    """
+    changed = set()
+    for ctype, table in PARTS_TABLES.items():
+        if ctype == "PS Module":
+            continue
+        id_field = "NAME_LABEL" if ctype in ("MaPSA", "PS-s Sensor", "PS-p Sensor", "MPA Chip") else "SERIAL_NUMBER"
+        query = f"select p.{id_field} from trker_cmsr.{table} p where {changed_since_clause(watermarks[table], change_column=change_column)}"
+        output = get_rhapi().csv_all(query, clean=True)
+        rows = parse_csv_output(output) if output.strip() else []
+        changed.update(row[id_field] for row in rows if row.get(id_field))
+    # mounted/unmounted children: the parent is a module, a MaPSA or a read-out hybrid
+    query = (f"select r.parent_name_label, r.parent_serial_number from trker_cmsr.{RELATIONSHIPS_TABLE} r "
+             f"where {changed_since_clause(watermarks[RELATIONSHIPS_TABLE], alias='r', change_column=change_column)}")
+    output = get_rhapi().csv_all(query, clean=True)
+    for row in (parse_csv_output(output) if output.strip() else []):
+        changed.update(value for value in (row.get("PARENT_NAME_LABEL"), row.get("PARENT_SERIAL_NUMBER")) if value)
+    return changed
+
+def get_delta_modules(args, watermarks, local_modules):
+    """
+    Returns the central rows of the modules to sync in delta mode: the modules at the location (or
+    matching the name pattern) and the local modules changed since the watermark, plus the local
+    modules having a component or a relationship changed since then.
+    """
+    since = watermarks[PARTS_TABLES["PS Module"]]
+    local_names = set(m["moduleName"] for m in local_modules)
+    modules = {m["SERIAL_NUMBER"]: m for m in get_central_modules(args.by_name, args.location, since, args.change_column)}
+    missing_locals = [name for name in local_names if name not in modules]
+    for module in get_modules_by_serial_numbers(missing_locals, since, args.change_column):
+        modules[module["SERIAL_NUMBER"]] = module
+    logging.info(f"{len(modules)} module(s) changed since {since}.")
+
+    children_index = build_children_index(local_modules)
+    # the NAME_LABEL of the local modules, as the relationships refer to the parents by label
+    labels = {(m.get("details") or {}).get("NAME_LABEL"): m["moduleName"] for m in local_modules}
+    affected = set()
+    for cid in get_changed_component_ids(watermarks, args.change_column):
+        affected.update(children_index.get(cid, ()))
+        if cid in labels:
+            affected.add(labels[cid])
+        elif cid in local_names:
+            affected.add(cid)
+    affected -= set(modules)
+    logging.info(f"{len(affected)} other local module(s) have changed components or relationships.")
+    for module in get_modules_by_serial_numbers(sorted(affected)):
+        modules[module["SERIAL_NUMBER"]] = module
+    return list(modules.values())
+
 def main():
+    global _strict_queries
     # Add argument parsing
     parser = argparse.ArgumentParser(description='Sync module data from central to local DB')
     parser.add_argument('--by-name', action='store_true', help='Query modules by name pattern (IBA/IPG) instead of location')
     parser.add_argument('--location', default='Pisa', help='Location to filter modules (default: Pisa)')
+    parser.add_argument('--delta', action='store_true', help='Only sync the modules changed since the last successful sync (falls back to a full sync if there was none)')
+    parser.add_argument('--change-column', default=CHANGE_COLUMN, help=f'Last-change column of the central DB tables used by --delta (default: {CHANGE_COLUMN})')
     args = parser.parse_args()
+    started_at = datetime.datetime.now()
+    # every run moves the watermarks, which is only right if all its queries succeeded: a failed
+    # query aborts the sync before anything is written (no syncHash from missing children/details)
+    _strict_queries = True
 
     # Log all environment variables and configuration
     logging.info("="*80)
@@ -298,7 +459,7 @@ def main():
     logging.info(f"API_URL: {API_URL}")
     logging.info(f"MONGO_URI: {MONGO_URI}")
     logging.info(f"DB_NAME: {DB_NAME}")
-    logging.info(f"Arguments: by_name={args.by_name}, location={args.location}")
+    logging.info(f"Arguments: by_name={args.by_name}, location={args.location}, delta={args.delta}")
     logging.info(f"Python executable: {sys.executable}")
     logging.info(f"Working directory: {os.getcwd()}")
     logging.info("="*80)
@@ -307,34 +468,55 @@ def main():
     db = client[DB_NAME]
     modules_collection = db["modules"]
     logging.info(f"Connected to MongoDB at {MONGO_URI} on database {DB_NAME}.")
-    
-    # Step 1: Get modules from central DB by location/name
-    logging.info(f"STEP 1/5: Querying central DB for modules in location/pattern...")
-    central_modules_by_location = get_central_modules(by_name=args.by_name, location=args.location)
-    
-    # Step 2: Get all local modules
-    logging.info(f"STEP 2/5: Fetching all modules from local DB...")
-    local_modules = get_local_modules(DB_NAME)
-    logging.info(f"Local DB has {len(local_modules)} modules.")
-    
-    # Step 3: Determine which modules to sync
-    local_names = set(m["moduleName"] for m in local_modules)
-    central_names_by_location = set(m["SERIAL_NUMBER"] for m in central_modules_by_location)
-    
-    # Modules to import (new ones from location query)
-    missing = [m for m in central_modules_by_location if m["SERIAL_NUMBER"] not in local_names]
-    # now the not missing ones are the ones to update
-    existing = [m for m in central_modules_by_location if m["SERIAL_NUMBER"] in local_names]
-
-    # Modules to update (existing in local, need fresh data from central)
-    # Query central DB for ALL local modules (even if moved elsewhere)
-    logging.info(f"STEP 3/5: Querying central DB for existing local modules (including moved ones)...")
-    # will be local_names minus those already in central_names_by_location
-    local_serials_not_in_Pisa = list(local_names - central_names_by_location)
-    print(f"Local serials not in Pisa: {len(local_serials_not_in_Pisa), local_serials_not_in_Pisa}")
-    modules_not_in_Pisa_from_central = get_modules_by_serial_numbers(local_serials_not_in_Pisa)
-    
-    logging.info(f"Central DB (by location) has {len(central_modules_by_location)} modules.")
+
+    watermark_tables = list(PARTS_TABLES.values()) + [RELATIONSHIPS_TABLE]
+    delta_modules = None
+    if args.delta:
+        watermarks = load_watermarks(db)
+        if all(table in watermarks for table in watermark_tables):
+            logging.info(f"STEP 1-3/5: Fetching all modules from local DB and querying central DB for the changes since the last sync...")
+            local_modules = get_local_modules(DB_NAME)
+            logging.info(f"Local DB has {len(local_modules)} modules.")
+            try:
+                delta_modules = get_delta_modules(args, watermarks, local_modules)
+            except Exception as e:
+                logging.error(f"Delta query failed, running a full sync instead: {e}")
+        else:
+            logging.info("No watermark from a previous sync, running a full sync.")
+
+    if delta_modules is not None:
+        local_names = set(m["moduleName"] for m in local_modules)
+        missing = [m for m in delta_modules if m["SERIAL_NUMBER"] not in local_names]
+        existing = [m for m in delta_modules if m["SERIAL_NUMBER"] in local_names]
+        modules_not_in_Pisa_from_central = []
+    else:
+        # Step 1: Get modules from central DB by location/name
+        logging.info(f"STEP 1/5: Querying central DB for modules in location/pattern...")
+        central_modules_by_location = get_central_modules(by_name=args.by_name, location=args.location)
+
+        # Step 2: Get all local modules
+        logging.info(f"STEP 2/5: Fetching all modules from local DB...")
+        local_modules = get_local_modules(DB_NAME)
+        logging.info(f"Local DB has {len(local_modules)} modules.")
+
+        # Step 3: Determine which modules to sync
+        local_names = set(m["moduleName"] for m in local_modules)
+        central_names_by_location = set(m["SERIAL_NUMBER"] for m in central_modules_by_location)
+
+        # Modules to import (new ones from location query)
+        missing = [m for m in central_modules_by_location if m["SERIAL_NUMBER"] not in local_names]
+        # now the not missing ones are the ones to update
+        existing = [m for m in central_modules_by_location if m["SERIAL_NUMBER"] in local_names]
+
+        # Modules to update (existing in local, need fresh data from central)
+        # Query central DB for ALL local modules (even if moved elsewhere)
+        logging.info(f"STEP 3/5: Querying central DB for existing local modules (including moved ones)...")
+        # will be local_names minus those already in central_names_by_location
+        local_serials_not_in_Pisa = list(local_names - central_names_by_location)
+        print(f"Local serials not in Pisa: {len(local_serials_not_in_Pisa), local_serials_not_in_Pisa}")
+        modules_not_in_Pisa_from_central = get_modules_by_serial_numbers(local_serials_not_in_Pisa)
+
+        logging.info(f"Central DB (by location) has {len(central_modules_by_location)} modules.")
     logging.info(f"New modules to import: {len(missing)}")
     logging.info(f"Existing modules to update: {len(modules_not_in_Pisa_from_central)+len(existing)}")\
     # print all lenghts for debugging
@@ -344,6 +526,7 @@ def main():
         logging.info(f"New modules: {[m['SERIAL_NUMBER'] for m in missing]}")
     
     if not missing and not modules_not_in_Pisa_from_central and not existing:
+        save_watermarks(db, watermark_tables, started_at)
         logging.info("No modules to process. Sync completed.")
         return
     
@@ -366,6 +549,8 @@ def main():
     logging.info(f"STEP 5/5: Processing {total_to_process} modules ({len(missing)} new, {len(modules_not_in_Pisa_from_central)+len(existing)} updates)...")
 
     processed_count = 0
+    updated_count = 0
+    stored_hashes = {m["moduleName"]: m.get("syncHash") for m in local_modules}
     
     # First, process NEW modules (full insert with all fields)
     for i, module in enumerate(missing, 1):
@@ -374,14 +559,21 @@ def main():
         process_module(module, children_map, all_details, modules_collection)
         processed_count += 1
     
-    # Second, update EXISTING modules (only details and children fields)
+    # Second, update EXISTING modules (only details and children fields, if they changed)
     for i, module in enumerate(modules_not_in_Pisa_from_central + existing, len(missing) + 1):
         module_id = module.get("SERIAL_NUMBER", "unknown")
-        logging.info(f"Progress: {i}/{total_to_process} - Updating EXISTING module {module_id}")
-        update_existing_module(module, children_map, all_details, modules_collection)
+        if update_existing_module(module, children_map, all_details, modules_collection, stored_hashes.get(module_id)):
+            logging.info(f"Progress: {i}/{total_to_process} - Updated EXISTING module {module_id}")
+            updated_count += 1
         processed_count += 1
-    
-    logging.info(f"Sync completed successfully. Imported {len(missing)} new module(s), updated {len(modules_not_in_Pisa_from_central)+len(existing)} existing module(s).")
+
+    save_watermarks(db, watermark_tables, started_at)
+    logging.info(f"Sync completed successfully. Imported {len(missing)} new module(s), updated {updated_count} existing module(s), "
+                 f"{len(modules_not_in_Pisa_from_central)+len(existing)-updated_count} unchanged.")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except CentralQueryError as e:
+        logging.error(f"Sync aborted, the watermarks were not moved: {e}")
+        sys.exit(1)
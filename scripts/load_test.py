@@ -0,0 +1,123 @@
+"""
+Load test of the GUI read traffic against one or more deployments, e.g. the sync (gunicorn) and
+the ASGI (uvicorn, see app/asgi.py) modes of the same database.
+
+Each of the --clients concurrent clients loops for --duration seconds over the requests of a GUI
+page: the module test list (the slow aggregation), a session, a module and its results. A probe
+client meanwhile sends a cheap GET every --probe-interval seconds, standing for the test stations:
+its latency shows how long a request waits behind the slow ones.
+
+usage: python3 load_test.py --target sync=http://localhost:5000 --target asgi=http://localhost:5001
+                            [--clients 50] [--duration 30] [--module PS_1] [--session session1]
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def gui_requests(args):
+    """The GET paths of a GUI page, requested in turn by every client."""
+    return [
+        "/fetch_all_module_test_results?page=1&per_page=100",
+        f"/fetch_session_results/{args.session}",
+        f"/modules/{args.module}",
+        f"/fetch_module_results/{args.module}",
+        "/fetch_all_module_test_results?page=2&per_page=100",
+    ]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def client_loop(base_url, paths, deadline, results, lock):
+    session = requests.Session()
+    i = 0
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        t0 = time.perf_counter()
+        try:
+            ok = session.get(base_url + path, timeout=120).status_code < 500
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - t0
+        with lock:
+            results.append((path.split("?")[0], elapsed, ok))
+
+
+def probe_loop(base_url, path, interval, deadline, latencies):
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        t0 = time.perf_counter()
+        try:
+            session.get(base_url + path, timeout=120)
+            latencies.append(time.perf_counter() - t0)
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+
+
+def run_target(base_url, args):
+    paths = gui_requests(args)
+    results = []
+    probe_latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    probe = threading.Thread(
+        target=probe_loop, args=(base_url, f"/modules/{args.module}", args.probe_interval, deadline, probe_latencies)
+    )
+    probe.start()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        for _ in range(args.clients):
+            pool.submit(client_loop, base_url, paths, deadline, results, lock)
+    probe.join()
+    return results, probe_latencies
+
+
+def report(name, results, probe_latencies, duration):
+    latencies = [elapsed for _, elapsed, _ in results]
+    errors = sum(1 for _, _, ok in results if not ok)
+    print(
+        f"{name}: {len(results)} requests, {len(results) / duration:.1f} req/s, {errors} errors, "
+        f"p50={percentile(latencies, 50) * 1000:.0f} ms p95={percentile(latencies, 95) * 1000:.0f} ms "
+        f"p99={percentile(latencies, 99) * 1000:.0f} ms"
+    )
+    for path in sorted({path for path, _, _ in results}):
+        path_latencies = [elapsed for p, elapsed, _ in results if p == path]
+        print(
+            f"  {path:45s} n={len(path_latencies):6d}  mean={statistics.mean(path_latencies) * 1000:8.0f} ms  "
+            f"p95={percentile(path_latencies, 95) * 1000:8.0f} ms"
+        )
+    print(
+        f"  probe (test station)                          n={len(probe_latencies):6d}  "
+        f"p50={percentile(probe_latencies, 50) * 1000:8.0f} ms  p99={percentile(probe_latencies, 99) * 1000:8.0f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", required=True, help="name=base url, can be repeated")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--probe-interval", type=float, default=0.5)
+    parser.add_argument("--module", default="PS_1")
+    parser.add_argument("--session", default="session1")
+    args = parser.parse_args()
+
+    # one target at a time, so that they do not compete for the database
+    for target in args.target:
+        name, _, base_url = target.partition("=")
+        results, probe_latencies = run_target(base_url.rstrip("/"), args)
+        report(name, results, probe_latencies, args.duration)
+
+
+if __name__ == "__main__":
+    main()
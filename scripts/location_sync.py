@@ -1,14 +1,13 @@
 import sys
 import os
 import io
-import subprocess
 import csv
 import logging
 import requests
 from pymongo import MongoClient
 from jsonschema import validate, ValidationError
 
-from db_sync import run_rhapi_command, parse_csv_output, get_local_modules
+from db_sync import run_rhapi_query, parse_csv_output, get_local_modules
 
 # Constants
 API_URL = "http://192.168.0.45:5000"
@@ -17,8 +16,8 @@ MONGO_URI = os.environ["MONGO_URI"]
 DB_NAME = os.environ["MONGO_DB_NAME"]
 
 def get_all_central_modules(names):
-    command =  f"""python3 rhapi.py --url=https://cmsdca.cern.ch/trk_rhapi "select * from trker_cmsr.p9020 p where p.name_label IN ('{names}')" --all --login -n"""
-    out = run_rhapi_command(command)
+    query = f"select * from trker_cmsr.p9020 p where p.name_label IN ('{names}')"
+    out = run_rhapi_query(query)
     return parse_csv_output(out)
     
 def process_module(module_name, location, modules_collection):
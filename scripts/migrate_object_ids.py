@@ -0,0 +1,40 @@
+"""
+Converts the _id references stored as strings (modules._moduleTest_id, sessions._test_run_id,
+test_runs._moduleTest_id, module_tests._test_run_id/_module_id) to native ObjectIds, so that
+the pipelines can $lookup them directly. It can be run more than once, and while the API is up.
+
+usage: MONGO_URI=mongodb://... MONGO_DB_NAME=prod_db python3 migrate_object_ids.py [--dry-run]
+"""
+import argparse
+import logging
+import os
+import sys
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app")))
+from references import migrate_references, MIGRATION_BATCH_SIZE
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents to convert")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ["MONGO_URI"])
+    db = client[os.environ["MONGO_DB_NAME"]]
+    converted = migrate_references(db, batch_size=args.batch_size, dry_run=args.dry_run)
+    for collection, count in converted.items():
+        logging.info(f"{collection}: {count} document(s) {'to convert' if args.dry_run else 'converted'}")
+
+    if not args.dry_run and any(converted.values()):
+        # the summaries embed the converted documents: they are rebuilt on the next read
+        db["module_summaries"].delete_many({})
+        logging.info("Dropped the module summaries, run `flask --app deploy rebuild-module-summaries` to rebuild them now.")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,16 @@ from bs4 import BeautifulSoup
 import urllib3
 from urllib.parse import urlparse
 from requests.utils import requote_uri
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 requests.packages.urllib3.disable_warnings()
+
+# number of pages fetched in parallel by RhApi.fetch_pages
+DEFAULT_MAX_WORKERS = 4
 # warnings.filterwarnings("error")
 
 if sys.version_info < (3,):
@@ -250,12 +256,14 @@ class RhApi:
     RestHub API object
     """
 
-    def __init__(self, url, debug=False, sso=None):
+    def __init__(self, url, debug=False, sso=None, sso_cache_file=".session.cache", max_workers=DEFAULT_MAX_WORKERS):
         """
         Construct API object.
         url: URL to RestHub endpoint, i.e. http://localhost:8080/api
         debug: should debug messages be printed out? Verbose!
         sso: use cookie provider from SSO_COOKIE_PROVIDER string
+        sso_cache_file: file where the login provider caches the credentials and cookies
+        max_workers: number of pages fetched in parallel by the *_all methods
         """
         if re.match("/$", url) is None:
             url = url + "/"
@@ -263,24 +271,46 @@ class RhApi:
         self.debug = debug
         self.dprint("url = ", self.url)
 
+        # all the calls share one session, so the connections are kept alive and reused
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # the SSO cookies are fetched once and reused until the server asks to log in again
+        self._cookies = None
+        self._cookies_lock = threading.Lock()
+
         self.cprov = None
         if sso is not None and re.search("^https", url):
             if sso == 'login':
                 self.cprov = lambda url, force_level: (
-                CernSSO().login_sign_on(url, force_level=force_level,login_type='simple'), force_level)
+                CernSSO().login_sign_on(url, force_level=force_level,login_type='simple', cache_file=sso_cache_file), force_level)
             if sso == 'login2':
                 self.cprov = lambda url, force_level: (
-                CernSSO().login_sign_on(url, force_level=force_level,login_type='2fa'), force_level)
+                CernSSO().login_sign_on(url, force_level=force_level,login_type='2fa', cache_file=sso_cache_file), force_level)
             if sso == 'krb':
                 self.cprov = lambda url, force_level: (CernSSO().krb_sign_on(url), 2)
 
+    def _sso_cookies(self, force_level, stale=None):
+        """
+        Return the cached SSO cookies, or get new ones from the cookie provider if there are none
+        or if the stale ones were rejected (and no other thread has renewed them meanwhile).
+        """
+        with self._cookies_lock:
+            if self._cookies is not None and (force_level == 0 or self._cookies is not stale):
+                return self._cookies, force_level
+            self._cookies, force_level = self.cprov(self.url, force_level)
+            return self._cookies, force_level
+
     def _action(self, action, url, headers, data):
         force_level = 0
+        cookies = None
         while True:
 
-            cookies = None
             if self.cprov is not None:
-                cookies, force_level = self.cprov(self.url, force_level)
+                cookies, force_level = self._sso_cookies(force_level, stale=cookies)
 
             with warnings.catch_warnings():
                 r = action(url=url, headers=headers, data=data, cookies=cookies, verify=False)
@@ -350,7 +380,7 @@ class RhApi:
         else:
             method = method.lower()
 
-        action = getattr(requests, method, None)
+        action = getattr(self.session, method, None)
         if action:
             resp = self._action(action, headers=headers, url=callurl, data=data)
         else:
@@ -384,7 +414,7 @@ class RhApi:
             - None: if no content found
         Exception: if anything nasty happens
         """
-        action = getattr(requests, "get", None)
+        action = getattr(self.session, "get", None)
         resp = self._action(action, url=url, headers=None, data=None)
 
         self.dprint("Response", resp.status_code, " ".join(str(resp.headers.get('content-type')).split("\r\n")))
@@ -531,21 +561,48 @@ class RhApi:
         return self.data1(query, params, 'application/json', pagesize, page, verbose=verbose, cols=cols,
                          inline_clobs=inline_clobs)
 
+    def fetch_pages(self, query, form, params=None, clean=False, verbose=False, cols=False, inline_clobs=False):
+        """
+        Get all the pages of a query result: the query metadata is read once,
+        then the pages are fetched in parallel on the shared session.
+        returns: (total rows count, list of the pages in order)
+        """
+
+        for attempt in range(5):
+            try:
+                qid = self.qid(query)
+                if clean:
+                    self.clean(qid, verbose=verbose)
+                rowsLimit = self.query(qid, verbose=True)["rowsLimit"]
+                count = int(self.count(qid, params))
+                pages = max(1, -(-count // rowsLimit))
+
+                def fetch(page):
+                    return self.get(["query", qid, "page", rowsLimit, page, "data"], None, {"Accept": form}, params,
+                                    verbose=verbose, cols=cols, inline_clobs=inline_clobs)
+
+                if pages == 1:
+                    return count, [fetch(1)]
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, pages)) as executor:
+                    return count, list(executor.map(fetch, range(1, pages + 1)))
+            except Exception as e:
+                err_msg = str(e)
+                if (attempt < 4) and ("Query ID" in err_msg):
+                    print("failing to fetch query id attemp num:",attempt)
+                    time.sleep(20)
+                else:
+                    print("Inform the developer of this condition with error logs")
+                    raise e
+
     def json_all(self, query, params=None, verbose=False, cols=False, inline_clobs=False):
         """
         Get all rows in JSON format (array of arrays)
         """
 
+        count, pages = self.fetch_pages(query, "application/json", params, verbose=verbose, cols=cols,
+                                        inline_clobs=inline_clobs)
         rows = []
-
-        qid = self.qid(query)
-        rowsLimit = self.query(qid, verbose=True)["rowsLimit"]
-        count = int(self.count(qid, params))
-        pages = int(count / rowsLimit) + 1
-
-        for page in range(1, (pages + 1)):
-            data = self.data(qid, params, form="application/json", page=page, pagesize=rowsLimit, verbose=verbose,
-                             cols=cols, inline_clobs=inline_clobs)
+        for data in pages:
             rows.extend(data["data"])
 
         if count != len(rows):
@@ -553,6 +610,22 @@ class RhApi:
 
         return rows
 
+    def csv_all(self, query, params=None, clean=False, verbose=False, inline_clobs=False):
+        """
+        Get all rows in CSV format, as a single text with one header line
+        """
+
+        count, pages = self.fetch_pages(query, "text/csv", params, clean=clean, verbose=verbose,
+                                        inline_clobs=inline_clobs)
+        # every page starts with the header line, which is kept from the first page only
+        text = pages[0]
+        for page in pages[1:]:
+            rows = page.split("\n", 1)[1] if "\n" in page else ""
+            if rows and text and not text.endswith("\n"):
+                text += "\n"
+            text += rows
+        return text
+
     def json2(self, query, params=None, pagesize=None, page=None, verbose=False, cols=False, inline_clobs=False):
         """
         Get rows in JSON2 format (array or objects)
@@ -562,7 +635,7 @@ class RhApi:
                          inline_clobs=inline_clobs)
     
     def condlobapi(self, cond_id,koc_id, db_name="trk_cmsr"):
-        action = getattr(requests, "get", None)
+        action = getattr(self.session, "get", None)
         url1 = "https://cmsdca.cern.ch/servelets/" + db_name + "/construct/lobextapi?cond_id="+str(cond_id)+"&koc_id="+str(koc_id)
         resp = self._action(action, url=url1, headers=None, data=None)
         if resp.status_code == requests.codes.ok:
@@ -5,6 +5,11 @@ import sys
 import os
 from dotenv import load_dotenv
 import json
+import datetime
+import hashlib
+import io
+import shutil
+import tempfile
 
 sys.path.append("..")
 from app.app import (
@@ -12,6 +17,11 @@ from app.app import (
     get_unittest_db,
 )
 from examples.cables_templates import cables_templates
+from app.references import migrate_references
+from app.indexes import apply_indexes, index_status, advise
+from app.validation import get_validator, validate_entry
+from app.attachments import init_attachment_store, get_attachment_store, sweep_attachments
+from jsonschema import ValidationError
 from bson import ObjectId
 from pymongo import MongoClient
 import os
@@ -38,6 +48,8 @@ class TestAPI(TestCase):
             db.module_tests.drop()
             db.sessions.drop()
             db.module_test_analysis.drop()
+            db.module_summaries.drop()
+            db.counter_reservations.drop()
 
     def tearDown(self):
         with self.app.app_context():
@@ -54,6 +66,8 @@ class TestAPI(TestCase):
             db.module_tests.drop()
             db.sessions.drop()
             db.module_test_analysis.drop()
+            db.module_summaries.drop()
+            db.counter_reservations.drop()
 
     def test_fetch_all_modules_empty(self):
         response = self.client.get("/modules")
@@ -467,6 +481,15 @@ class TestAPI(TestCase):
         response = self.client.post("/connect", json=connect_data)
         self.assertEqual(response.status_code, 400)
 
+        # the cables collection dropped behind the API: the graph only notices it when its write misses
+        with self.app.app_context():
+            get_unittest_db().cables.drop()
+        response = self.client.post("/disconnect", json=connect_data)
+        self.assertEqual(response.status_code, 409)
+        # then it is reloaded
+        response = self.client.post("/disconnect", json=connect_data)
+        self.assertEqual(response.status_code, 404)
+
     def test_disconnect_failures(self):
 
         self.test_insert_cable_templates()
@@ -515,6 +538,57 @@ class TestAPI(TestCase):
         response = self.client.post("/disconnect", json=disconnect_data)
         self.assertEqual(response.status_code, 400)
 
+    def test_connect_bulk(self):
+
+        self.test_insert_cable_templates()
+        for cable in [
+            {"name": "E40", "type": "exapus", "detSide": {}, "crateSide": {}},
+            {"name": "E41", "type": "exapus", "detSide": {}, "crateSide": {}},
+            {"name": "D40", "type": "dodecapus", "detSide": {}, "crateSide": {}},
+        ]:
+            response = self.client.post("/cables", json=cable)
+            self.assertEqual(response.status_code, 201)
+
+        # the second operation takes the lines of D40 taken by the first one
+        operations = [
+            {"cable1": "E40", "port1": "1", "cable2": "D40", "port2": "A"},
+            ["E41", "1", "D40", "A"],
+            {"cable1": "E42", "port1": "1", "cable2": "D40", "port2": "A"},
+        ]
+        response = self.client.post("/connect_bulk", json={"operations": operations})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json["written"])
+        self.assertEqual([result["status"] for result in response.json["results"]], [200, 400, 404])
+        self.assertIn("already connected", response.json["results"][1]["error"])
+        # all or nothing: nothing was written, the lines of the template are all still empty
+        crate_side = self.client.get("/cables/E40").json["crateSide"]
+        self.assertTrue(crate_side)
+        self.assertTrue(all(line == [] for line in crate_side.values()))
+
+        # the failed operations are skipped
+        response = self.client.post("/connect_bulk", json={"operations": operations, "atomic": False})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json["written"])
+        self.assertEqual([result["status"] for result in response.json["results"]], [200, 400, 404])
+        self.assertEqual(self.client.get("/cables/E40").json["crateSide"]["1"], ["D40", 1])
+        self.assertEqual(self.client.get("/cables/D40").json["detSide"]["12"], ["E40", 12])
+        crate_side = self.client.get("/cables/E41").json["crateSide"]
+        self.assertTrue(crate_side)
+        self.assertTrue(all(line == [] for line in crate_side.values()))
+
+        response = self.client.post("/disconnect_bulk", json={"operations": [{"cable1": "E40", "cable2": "D40"}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get("/cables/E40").json["crateSide"]["1"], [])
+        self.assertEqual(self.client.get("/cables/D40").json["detSide"]["12"], [])
+
+        response = self.client.post("/connect_bulk", json={"operations": []})
+        self.assertEqual(response.status_code, 400)
+        # atomic has to be a boolean, "false" or 0.0 would silently pick a mode
+        for atomic in ("false", 0.0, None):
+            response = self.client.post("/connect_bulk", json={"operations": operations, "atomic": atomic})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("atomic", response.json["error"])
+
     def test_cabling_snapshot(self):
 
         self.test_insert_cable_templates()
@@ -817,6 +891,58 @@ class TestAPI(TestCase):
         # print(formatted)
 
     # Snapshot from Cable (crateSide)
+    def test_cabling_paths(self):
+        # the cabling of test_cabling_snapshot: the module fiber lines end on FC7OT2 OG0
+        self.test_cabling_snapshot()
+        module = "PS_26_05-IPG_00102"
+
+        response = self.client.get(f"/cabling_paths/module/{module}?end_type=FC7")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(len(response.json) > 0)
+        for path in response.json:
+            self.assertEqual(path["end"]["cable"], "FC7OT2")
+            self.assertEqual(path["end"]["port"], "OG0")
+            self.assertIn("D31", [hop["cable"] for hop in path["chain"]])
+        fc7_lines = sorted(path["line"] for path in response.json)
+
+        # back from the FC7 port, and from an intermediate cable
+        response = self.client.get("/cabling_paths/cable/FC7OT2?port=OG0&side=detSide")
+        self.assertEqual(sorted(path["line"] for path in response.json if path["module"] == module), fc7_lines)
+        response = self.client.get("/cabling_paths/cable/E51")
+        self.assertEqual(sorted(path["line"] for path in response.json), fc7_lines)
+        response = self.client.post("/cabling_paths/modules", json={"modules": [module, "unknown"], "end_type": "FC7"})
+        self.assertEqual(list(response.json), [module])
+
+        # the index follows the disconnections and connections
+        disconnect_data = {"cable1": "D31", "cable2": "FC7OT2", "port1": "P12", "port2": "OG0"}
+        response = self.client.post("/disconnect", json=disconnect_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f"/cabling_paths/module/{module}?end_type=FC7").json, [])
+        self.assertEqual(self.client.get("/cabling_paths/cable/FC7OT2").json, [])
+        response = self.client.post("/connect", json=dict(disconnect_data, port2="OG1"))
+        self.assertEqual(response.status_code, 200)
+        paths = self.client.get(f"/cabling_paths/module/{module}?end_type=FC7").json
+        self.assertEqual([path["end"]["port"] for path in paths], ["OG1"] * len(fc7_lines))
+
+        # the materialized paths follow the disconnections and connections too
+        result = self.app.test_cli_runner().invoke(args=["materialize-cabling-paths"])
+        self.assertEqual(result.exit_code, 0)
+        with self.app.app_context():
+            snapshot = get_unittest_db()["connection_snapshot"]
+            self.assertEqual(snapshot.count_documents({"First": module, "Last": "FC7OT2"}), len(fc7_lines))
+            response = self.client.post("/disconnect", json=dict(disconnect_data, port2="OG1"))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(snapshot.count_documents({"First": module, "Last": "FC7OT2"}), 0)
+            response = self.client.post("/connect_bulk", json={"operations": [disconnect_data]})
+            self.assertEqual(response.status_code, 200)
+            docs = list(snapshot.find({"First": module, "Last": "FC7OT2"}))
+            self.assertEqual(sorted(doc["line"] for doc in docs), fc7_lines)
+            self.assertEqual({doc["end"]["port"] for doc in docs}, {"OG0"})
+            snapshot.drop()
+
+        response = self.client.get("/cabling_paths/module/unknown")
+        self.assertEqual(response.status_code, 404)
+
     # def test_LogBookSearchByText(self):
     #     new_log = {
     #         "timestamp": "2023-11-03T14:21:29Z",
@@ -1078,6 +1204,10 @@ class TestAPI(TestCase):
         test_run_data["runNumber"] = "another_run1"
         response = self.client.post("/addRun", json=test_run_data)
         self.assertEqual(response.status_code, 400)
+        for run_number in ("run12b", "Run5", 5):
+            test_run_data["runNumber"] = run_number
+            response = self.client.post("/addRun", json=test_run_data)
+            self.assertEqual(response.status_code, 400)
         
         # now add run0, our test run
         test_run_data = {
@@ -1168,7 +1298,68 @@ class TestAPI(TestCase):
         self.assertEqual(response.status_code, 200)
         #print(response.json)
         
-        
+
+    def test_add_run_is_all_or_nothing(self):
+        # the modules are created with the connections of their template
+        self.test_insert_cable_templates()
+
+        response = self.client.post(
+            "/sessions",
+            json={
+                "timestamp": "2023-11-03T14:21:29",
+                "operator": "John Doe",
+                "description": "all or nothing",
+                "modulesList": ["M123"],
+                "configuration": {},
+                "log": [],
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        sessionName = response.json["sessionName"]
+        response = self.client.post("/modules", json={"moduleName": "M123", "position": "cleanroom", "status": "readyformount"})
+        self.assertEqual(response.status_code, 201)
+
+        test_run_data = {
+            "runNumber": "run7",
+            "runDate": "1996-11-21T10:00:56",
+            "runStatus": "failed",
+            "runType": "Type1",
+            "runSession": sessionName,
+            "runBoards": {3: "fc7ot2"},
+            # M999 does not exist, so nothing should be written
+            "runModules": {
+                "fc7ot2_optical0": ("M123", 67),
+                "fc7ot2_optical1": ("M999", 68),
+            },
+            "runResults": {67: "pass", 68: "failed"},
+            "runNoise": {67: {"SSA0": 4.348}, 68: {"SSA0": 3.348}},
+            "runConfiguration": {"a": "b"},
+            "runFile": "link",
+        }
+        response = self.client.post("/addRun", json=test_run_data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["moduleName"], "M999")
+        self.assertEqual(self.client.get("/module_test/M123__run7").status_code, 404)
+        self.assertEqual(self.client.get("/test_run/run7").status_code, 404)
+        self.assertNotIn("M123__run7", self.client.get("/modules/M123").json.get("moduleTestName", []))
+
+        # the same module twice in the run is rejected as well
+        test_run_data["runModules"]["fc7ot2_optical1"] = ("M123", 68)
+        response = self.client.post("/addRun", json=test_run_data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["moduleTestName"], "M123__run7")
+        self.assertEqual(self.client.get("/module_test/M123__run7").status_code, 404)
+        self.assertEqual(self.client.get("/test_run/run7").status_code, 404)
+
+        # with only existing modules the whole run goes in
+        del test_run_data["runModules"]["fc7ot2_optical1"]
+        response = self.client.post("/addRun", json=test_run_data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get("/module_test/M123__run7").status_code, 200)
+        run = self.client.get("/test_run/run7").json
+        self.assertEqual(run["moduleTestName"], ["M123__run7"])
+        self.assertIn(run["_moduleTest_id"][0], self.client.get("/modules/M123").json["_moduleTest_id"])
+
     def test_run_get(self):
         session_entry = {
             "timestamp": "2023-11-03T14:21:29",
@@ -1254,6 +1445,54 @@ class TestAPI(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("message", response.json)
 
+    def test_reserve_session_names(self):
+        # the unique index on sessionName is ensured by create_app, but dropped with the collection by setUp
+        with self.app.app_context():
+            apply_indexes(get_unittest_db(), ["sessions"])
+        session_entry = {
+            "timestamp": "2023-11-03T14:21:29",
+            "operator": "John Doe",
+            "description": "bulk session creation",
+            "modulesList": ["PS_1", "PS_2"],
+        }
+        # reserve 3 names in one request
+        response = self.client.post("/counters/session/reserve", json={"count": 3})
+        self.assertEqual(response.status_code, 200)
+        names = response.json["names"]
+        self.assertEqual(len(names), 3)
+        self.assertEqual(len(set(names)), 3)
+        # the reserved names are kept
+        for name in names:
+            response = self.client.post("/sessions", json=dict(session_entry, sessionName=name))
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json["sessionName"], name)
+        # a reserved name is kept only once, then it is replaced like any other name
+        response = self.client.post("/sessions", json=dict(session_entry, sessionName=names[0]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["sessionName"], "session" + str(int(names[-1][len("session"):]) + 1))
+        # as is a name handed out by the counter without a reservation
+        response = self.client.post("/sessions", json=dict(session_entry, sessionName=response.json["sessionName"]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["sessionName"], "session" + str(int(names[-1][len("session"):]) + 2))
+        # a new session gets the next number
+        response = self.client.post("/sessions", json=session_entry)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["sessionName"], "session" + str(int(names[-1][len("session"):]) + 3))
+        # without the unique index (e.g. a deployment that did not run apply-indexes), an existing
+        # name is still rejected
+        with self.app.app_context():
+            get_unittest_db().sessions.drop_indexes()
+        name = self.client.post("/counters/session/reserve", json={"count": 1}).json["names"][0]
+        with self.app.app_context():
+            get_unittest_db().sessions.insert_one(dict(session_entry, sessionName=name))
+        response = self.client.post("/sessions", json=dict(session_entry, sessionName=name))
+        self.assertEqual(response.status_code, 400)
+        # unknown counter or invalid count
+        response = self.client.post("/counters/foo/reserve", json={"count": 3})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/counters/session/reserve", json={"count": 0})
+        self.assertEqual(response.status_code, 400)
+
     def test_module_test_analysis_resource(self):
         mta_entry = {
             "moduleTestAnalysisName": "MTA22",
@@ -1569,6 +1808,18 @@ class TestAPI(TestCase):
         self.assertEqual(test2["analysis"]["analysisSummary"]["status"], "PASS")
         self.assertIn("thermal_stability", test2["analysis"]["analysisResults"])
 
+        # the results are served from the materialized summary, which follows the writes
+        with self.app.app_context():
+            self.assertEqual(get_unittest_db().module_summaries.count_documents({"moduleName": "TestModule001"}), 1)
+        response = self.client.put("/sessions/" + session_name, json={"operator": "New Operator"})
+        self.assertEqual(response.status_code, 200)
+        result = self.client.get("/fetch_module_results/TestModule001").json
+        tests = sorted(result["tests"], key=lambda x: x["name"])
+        self.assertEqual(tests[0]["session"]["operator"], "New Operator")
+
+        response = self.client.get("/fetch_module_results/NotAModule")
+        self.assertEqual(response.status_code, 404)
+
     def test_fetch_session_results(self):
         self.test_insert_cable_templates()
 
@@ -1772,5 +2023,340 @@ class TestAPI(TestCase):
         self.assertEqual(module_test2["run"]["name"], "TestRunSession2") 
         self.assertEqual(module_test2["run"]["data"]["runType"], "thermal_cycle")
 
+        # the module tests follow the order of the _test_run_id array, not the order of test_runs
+        update_session = {
+            "_test_run_id": [str(ObjectId(run_objectid2)), str(ObjectId(run_objectid1))],
+            "test_runName": ["TestRunSession2", "TestRunSession1"]
+        }
+        self.client.put(f"/sessions/{session_name}", json=update_session)
+        result = self.client.get(f"/fetch_session_results/{session_name}").json
+        self.assertEqual(
+            [mt["module_test_name"] for mt in result["module_tests"]],
+            ["ModuleTestSession2", "ModuleTestSession1"]
+        )
+
+    def test_db_pool_reused_across_requests(self):
+        # the MongoClient is shared by all the requests of the worker
+        with self.app.app_context():
+            first_client = get_unittest_db().client
+        with self.app.app_context():
+            self.assertIs(get_unittest_db().client, first_client)
+
+        for _ in range(5):
+            self.client.get("/modules")
+        response = self.client.get("/db_pool/stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["pid"], os.getpid())
+        self.assertEqual(len(response.json["clients"]), 1)
+        pool = response.json["clients"][0]["pool"]
+        self.assertGreaterEqual(pool["checkouts"], 5)
+        # far fewer connections than requests
+        self.assertLess(pool["connections_created"], pool["checkouts"])
+        self.assertNotIn("@", response.json["clients"][0]["host"])
+
+    def test_migrate_references(self):
+        with self.app.app_context():
+            db = get_unittest_db()
+            test_id, run_id, module_id = ObjectId(), ObjectId(), ObjectId()
+            db.modules.insert_one({"_id": module_id, "moduleName": "M1", "_moduleTest_id": [str(test_id)]})
+            db.test_runs.insert_one({"_id": run_id, "test_runName": "run1", "_moduleTest_id": [str(test_id)]})
+            db.sessions.insert_one({"sessionName": "session1", "_test_run_id": [str(run_id)]})
+            db.module_tests.insert_one(
+                {"_id": test_id, "moduleTestName": "M1__run1", "_test_run_id": str(run_id), "_module_id": module_id}
+            )
+            self.assertEqual(
+                migrate_references(db), {"modules": 1, "sessions": 1, "test_runs": 1, "module_tests": 1}
+            )
+            self.assertEqual(db.modules.find_one({"moduleName": "M1"})["_moduleTest_id"], [test_id])
+            self.assertEqual(db.sessions.find_one({"sessionName": "session1"})["_test_run_id"], [run_id])
+            self.assertEqual(db.test_runs.find_one({"test_runName": "run1"})["_moduleTest_id"], [test_id])
+            self.assertEqual(db.module_tests.find_one({"_id": test_id})["_test_run_id"], run_id)
+            # nothing left to convert
+            self.assertEqual(sum(migrate_references(db).values()), 0)
+        # the string references sent through the API are stored as ObjectIds
+        other_test_id = ObjectId()
+        self.client.put("/modules/M1", json={"_moduleTest_id": [str(test_id), str(other_test_id)]})
+        with self.app.app_context():
+            module = get_unittest_db().modules.find_one({"moduleName": "M1"})
+            self.assertEqual(module["_moduleTest_id"], [test_id, other_test_id])
+        # the migrate-references command run on every container start
+        with self.app.app_context():
+            get_unittest_db().sessions.insert_one({"sessionName": "session2", "_test_run_id": [str(run_id)]})
+        result = self.app.test_cli_runner().invoke(args=["migrate-references"])
+        self.assertIn("sessions: 1 documents converted", result.output)
+        with self.app.app_context():
+            self.assertEqual(get_unittest_db().sessions.find_one({"sessionName": "session2"})["_test_run_id"], [run_id])
+        result = self.app.test_cli_runner().invoke(args=["migrate-references"])
+        self.assertIn("No string references left", result.output)
+
+    def test_index_registry(self):
+        with self.app.app_context():
+            db = get_unittest_db()
+            # a non-unique index from an older deployment is replaced
+            db.sessions.create_index("sessionName")
+            applied, failed = apply_indexes(db, ["modules", "sessions", "test_runs"])
+            self.assertEqual(failed, {})
+            self.assertIn("sessionName_1", applied["sessions"])
+            self.assertTrue(next(i for i in db.sessions.list_indexes() if i["name"] == "sessionName_1").get("unique"))
+            status = index_status(db)
+            for collection in ["modules", "sessions", "test_runs"]:
+                self.assertEqual(status.get(collection, {}).get("missing", []), [])
+            # applying again is a no-op
+            self.assertEqual(apply_indexes(db, ["modules", "sessions", "test_runs"]), ({}, {}))
+            # the shapes on indexed fields do not scan the collection
+            shapes = [
+                ("modules", "by hwId", {"hwId": "1"}, None),
+                ("test_runs", "by type", {"runType": "IV"}, None),
+                ("cables", "by a field without an index", {"notIndexed": 1}, None),
+            ]
+            db.cables.insert_one({"name": "C1"})
+            report = advise(db, shapes)
+            self.assertEqual([entry["query"] for entry in report], ["by a field without an index"])
+            self.assertEqual(report[0]["collection_scans"], ["cables"])
+
+    def test_index_replacement_failure(self):
+        with self.app.app_context():
+            db = get_unittest_db()
+            # duplicated session names from an older deployment: the unique index cannot be built
+            db.sessions.create_index("sessionName")
+            db.sessions.insert_many([{"sessionName": "session1"}, {"sessionName": "session1"}])
+            applied, failed = apply_indexes(db, ["sessions"])
+            self.assertIn("sessionName_1", failed["sessions"])
+            self.assertNotIn("sessions", applied)
+            # the existing index is kept
+            index = next(i for i in db.sessions.list_indexes() if i["name"] == "sessionName_1")
+            self.assertFalse(index.get("unique"))
+
+    def test_validator_registry(self):
+        # compiled once, then reused
+        self.assertIs(get_validator("logbook"), get_validator("logbook"))
+        log = {"timestamp": "2023-11-03T14:21:29", "operator": "John Doe", "event": "mounted"}
+        # a date-time without timezone is accepted, as with jsonschema.validate
+        validate_entry(log, "logbook")
+        with self.assertRaises(ValidationError) as context:
+            validate_entry(dict(log, operator=1), "logbook")
+        self.assertEqual(list(context.exception.path), ["operator"])
+        with self.assertRaises(ValidationError):
+            validate_entry({"operator": "John Doe"}, "logbook")
+        # the resources answer 400 on an invalid entry
+        response = self.client.post("/logbook", data={"jsonData": json.dumps({"operator": "John Doe"})})
+        self.assertEqual(response.status_code, 400)
+
+    def test_json_provider(self):
+        _id = ObjectId()
+        document = {"_id": _id, "date": datetime.datetime(2023, 11, 3, 14, 21, 29), "refs": [_id], 1: "int key"}
+        with self.app.test_request_context():
+            response = self.app.json.response(document)
+        self.assertEqual(
+            json.loads(response.get_data()),
+            {"_id": str(_id), "date": "2023-11-03T14:21:29", "refs": [str(_id)], "1": "int key"},
+        )
+        # the documents are returned with their _id as a string
+        self.client.post("/crates", json={"name": "crate_json"})
+        response = self.client.get("/crates/crate_json")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(ObjectId.is_valid(response.json["_id"]))
+
+    def test_asgi_reads(self):
+        # the ASGI mode is optional: asgiref and an async MongoDB driver are only needed there
+        import asyncio
+        from app.asgi import create_asgi_app
+
+        with self.app.app_context():
+            db = get_unittest_db()
+            db.test_runs.insert_one({"test_runName": "run1", "runType": "IV", "runSession": "session1"})
+            db.module_tests.insert_one({"moduleTestName": "PS_1__run1", "moduleName": "PS_1", "test_runName": "run1"})
+            db.crates.insert_one({"name": "crate1"})
+        asgi_app = create_asgi_app("unittest")
+
+        async def get(path, query_string=b""):
+            messages = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {
+                "type": "http", "method": "GET", "path": path, "root_path": "", "query_string": query_string,
+                "headers": [], "http_version": "1.1", "scheme": "http", "server": ("localhost", 80),
+            }
+            await asgi_app(scope, receive, send)
+            return messages[0]["status"], json.loads(b"".join(m.get("body", b"") for m in messages[1:]))
+
+        async def requests():
+            responses = [
+                await get("/fetch_all_module_test_results", b"page=1&per_page=10"),
+                await get("/module_test/PS_1__run1"),
+                await get("/module_test/unknown"),
+                # not an async route: served by the Flask app
+                await get("/crates/crate1"),
+            ]
+            await asgi_app.close()
+            return responses
+
+        results, entry, missing, crate = asyncio.run(requests())
+        # same response as the Flask route
+        self.assertEqual(results, (200, self.client.get("/fetch_all_module_test_results?page=1&per_page=10").json))
+        self.assertEqual(results[1]["module_tests"]["all_names"], ["PS_1__run1"])
+        self.assertEqual(entry[0], 200)
+        self.assertEqual(entry[1]["moduleName"], "PS_1")
+        self.assertEqual(missing[0], 404)
+        self.assertEqual(crate, (200, self.client.get("/crates/crate1").json))
+        # the async routes are in the request series of /metrics, with the label of the Flask route
+        rendered = asgi_app.metrics.render()
+        self.assertIn('localdb_requests_total{method="GET",route="/module_test/<string:moduleTestName>",status="200"} 1', rendered)
+        self.assertIn('localdb_requests_total{method="GET",route="/module_test/<string:moduleTestName>",status="404"} 1', rendered)
+        self.assertIn('localdb_request_duration_seconds_count{method="GET",route="/fetch_all_module_test_results"} 1', rendered)
+
+    def test_search_logbook(self):
+        with self.app.app_context():
+            db = get_unittest_db()
+            apply_indexes(db, ["logbook"])
+            # the text index is recognized as the one of the registry
+            self.assertEqual(index_status(db).get("logbook", {}).get("missing", []), [])
+            db.logbook.insert_many([
+                {"timestamp": "2024-01-10T10:00:00", "operator": "A", "event": "cooling failure",
+                 "details": "chiller stopped", "involved_modules": ["PS_1"]},
+                {"timestamp": "2024-02-10T10:00:00", "operator": "B", "event": "module mounted",
+                 "details": "checked the cooling contact", "involved_modules": ["PS_2"]},
+                {"timestamp": "2024-03-10T10:00:00", "operator": "C", "event": "cooling restored",
+                 "details": "", "involved_modules": ["PS_1", "PS_3"]},
+                {"timestamp": "2024-03-11T10:00:00", "operator": "D", "event": "IV scan", "details": "",
+                 "involved_modules": ["PS_3"]},
+            ])
+
+        response = self.client.post("/searchLogBook", json={"text": "cooling"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["total"], 3)
+        # the matches in the event rank before the one in the details
+        self.assertEqual(response.json["results"][-1]["operator"], "B")
+        self.assertIn("score", response.json["results"][0])
+        self.assertIn("event", response.json["results"][0])
+
+        # text, module and date range in the same query
+        response = self.client.post("/searchLogBook", json={
+            "text": "cooling", "modules": ["PS_1"], "from": "2024-02-01T00:00:00", "to": "2024-12-31T00:00:00",
+        })
+        self.assertEqual([entry["operator"] for entry in response.json["results"]], ["C"])
+
+        # no text: most recent first, paginated
+        response = self.client.post("/searchLogBook", json={"modules": ["PS_3"], "page": 2, "per_page": 1})
+        self.assertEqual(response.json["total"], 2)
+        self.assertEqual([entry["operator"] for entry in response.json["results"]], ["C"])
+
+        response = self.client.post("/searchLogBook", json={"per_page": 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_attachment_store(self):
+        attachment_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, attachment_dir)
+        self.app.config["ATTACHMENT_DIR"] = attachment_dir
+        # no grace period: the contents are deleted as soon as they are released
+        self.app.config["ATTACHMENT_GRACE_SECONDS"] = 0
+        init_attachment_store(self.app)
+        with self.app.app_context():
+            apply_indexes(get_unittest_db(), ["logbook"])
+        plot = b"\x89PNG" + bytes(range(256)) * 8000
+        log = {"timestamp": "2024-01-10T10:00:00", "operator": "A", "event": "calibration"}
+
+        ids = []
+        for _ in range(2):
+            response = self.client.post("/logbook", data={
+                "jsonData": json.dumps(log), "attachments": (io.BytesIO(plot), "calibration.png"),
+            }, content_type="multipart/form-data")
+            self.assertEqual(response.status_code, 201)
+            ids.append(response.json["_id"])
+        first, second = [self.client.get(f"/logbook/{_id}").json for _id in ids]
+        # the same content is stored once, under its digest
+        url = first["attachments"]["calibration.png"]
+        self.assertEqual(url, second["attachments"]["calibration.png"])
+        digest = hashlib.sha256(plot).hexdigest()
+        self.assertEqual(url, f"/attachments/{digest}/calibration.png")
+        stored = [name for _, _, names in os.walk(attachment_dir) for name in names]
+        self.assertEqual(stored, [digest])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, plot)
+        self.assertEqual(response.content_type, "image/png")
+        self.assertEqual(response.headers["ETag"], f'"{digest}"')
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        response.close()
+        response = self.client.get(url, headers={"If-None-Match": f'"{digest}"'})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers={"Range": "bytes=0-3"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"\x89PNG")
+        response.close()
+        self.assertEqual(self.client.get(f"/attachments/{'0' * 64}/missing.png").status_code, 404)
+
+        # the content is deleted with the last entry referencing it
+        response = self.client.put(f"/logbook/{ids[0]}", data={
+            "jsonData": json.dumps({"remove_attachment": "calibration.png"}),
+        }, content_type="multipart/form-data")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f"/logbook/{ids[0]}").json["attachments"], {})
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.delete(f"/logbook/{ids[1]}")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        # a content used within the grace period is kept when released, and swept afterwards
+        self.app.config["ATTACHMENT_GRACE_SECONDS"] = 3600
+        response = self.client.post("/logbook", data={
+            "jsonData": json.dumps(log), "attachments": (io.BytesIO(plot), "calibration.png"),
+        }, content_type="multipart/form-data")
+        self.client.delete(f"/logbook/{response.json['_id']}")
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.app.app_context():
+            logbook = get_unittest_db()["logbook"]
+            self.assertEqual(sweep_attachments(logbook, get_attachment_store(), 3600), 0)
+            self.assertEqual(sweep_attachments(logbook, get_attachment_store(), 0), 1)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_metrics(self):
+        for _ in range(3):
+            self.client.get("/modules")
+        self.client.get("/modules/unknown_module")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        body = response.get_data(as_text=True)
+        # requests by route template, not by url
+        self.assertIn('localdb_request_duration_seconds_count{method="GET",route="/modules"} 3', body)
+        self.assertIn('route="/modules/<string:moduleName>",status="404"', body)
+        self.assertNotIn("unknown_module", body)
+        # commands by collection, attributed to the routes
+        self.assertIn('localdb_mongo_command_duration_seconds_count{command="find",collection="modules"}', body)
+        self.assertIn('localdb_request_db_commands_total{method="GET",route="/modules"}', body)
+
+    def test_response_cache_invalidated_by_writes(self):
+        session_entry = {
+            "timestamp": "2023-11-03T14:21:29",
+            "operator": "John Doe",
+            "description": "cached",
+            "modulesList": [],
+            "configuration": {},
+            "log": [],
+        }
+        self.assertEqual(self.client.post("/sessions", json=session_entry).status_code, 201)
+
+        first = self.client.get("/fetch_sessions_for_testing_flow")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers["X-Cache"], "MISS")
+        second = self.client.get("/fetch_sessions_for_testing_flow")
+        self.assertEqual(second.headers["X-Cache"], "HIT")
+        self.assertEqual(second.json, first.json)
+
+        # a write on sessions invalidates the entry
+        self.assertEqual(self.client.post("/sessions", json=session_entry).status_code, 201)
+        third = self.client.get("/fetch_sessions_for_testing_flow")
+        self.assertEqual(third.headers["X-Cache"], "MISS")
+        self.assertEqual(len(third.json), len(first.json) + 1)
+
+        stats = self.client.get("/response_cache/stats").json
+        self.assertGreaterEqual(stats["hits"], 1)
+
 if __name__ == "__main__":
     unittest.main()
@@ -19,11 +19,13 @@ class TestBurninCyclesAPI(TestCase):
         with self.app.app_context():
             db = get_unittest_db()
             db.burnin_cycles.drop()
+            db.burnin_timeline.drop()
 
     def tearDown(self):
         with self.app.app_context():
             db = get_unittest_db()
             db.burnin_cycles.drop()
+            db.burnin_timeline.drop()
 
     def test_fetch_all_burnin_cycles_empty(self):
         """Test that an empty list is returned when no burnin cycles exist"""
@@ -48,7 +50,7 @@ class TestBurninCyclesAPI(TestCase):
         
         response = self.client.post("/burnin_cycles", json=new_cycle)
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(response.json, {"message": "Burnin cycle inserted"})
+        self.assertEqual(response.json, {"message": "Burnin cycle inserted", "BurninCycleName": "BC001"})
 
         # Verify the cycle was inserted
         response = self.client.get("/burnin_cycles/BC001")
@@ -166,5 +168,91 @@ class TestBurninCyclesAPI(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json["BurninCycleName"], "BC006")
 
+    def test_burnin_cycle_names(self):
+        """Test the names given by the burn-in cycles counter"""
+        response = self.client.post("/burnin_cycles", json={"BurninCycleName": "BC900", "BurninCycleDate": "2024-01-01", "BurninCycleModules": ["M150"]})
+        self.assertEqual(response.status_code, 201)
+        # without a name, the next number after the ones chosen by the clients
+        response = self.client.post("/burnin_cycles", json={"BurninCycleDate": "2024-01-02", "BurninCycleModules": ["M150"]})
+        self.assertEqual(response.status_code, 201)
+        self.assertGreater(int(response.json["BurninCycleName"][len("BC"):]), 900)
+        # not a JSON object
+        response = self.client.post("/burnin_cycles", json=["BC901"])
+        self.assertEqual(response.status_code, 400)
+
+    def test_session_testing_flow_cycles(self):
+        """Test that the testing flow of a session shows all the modules of its cycles"""
+        response = self.client.post("/sessions", json={
+            "timestamp": "2024-02-01T08:00:00", "operator": "John Doe",
+            "description": "testing flow cycles", "modulesList": ["M160"],
+        })
+        self.assertEqual(response.status_code, 201)
+        session_name = response.json["sessionName"]
+        self.addCleanup(self.client.delete, f"/sessions/{session_name}")
+        cycles = [
+            {"BurninCycleName": f"{session_name}_BC1", "BurninCycleDate": "2024-02-01T10:00:00", "BurninCycleModules": ["M160", "M161"]},
+            # none of the modules of the session
+            {"BurninCycleName": f"{session_name}_BC2", "BurninCycleDate": "2024-02-02T10:00:00", "BurninCycleModules": ["M162"]},
+        ]
+        for cycle in cycles:
+            response = self.client.post("/burnin_cycles", json=cycle)
+            self.assertEqual(response.status_code, 201)
+
+        response = self.client.get(f"/fetch_session_testing_flow/{session_name}")
+        self.assertEqual(response.status_code, 200)
+        columns = [column for column in response.json["columns"] if column["type"] == "cycle"]
+        self.assertEqual([column["cycle_name"] for column in columns], [cycle["BurninCycleName"] for cycle in cycles])
+        self.assertEqual(sorted(columns[0]["modules"]), ["M160", "M161"])
+        self.assertEqual(columns[1]["modules"], ["M162"])
+
+    def test_burnin_timeline(self):
+        """Test the timeline lookups of the cycles of a module and of the modules in the chamber"""
+        cycles = [
+            {"BurninCycleName": "BC010", "BurninCycleDate": "2024-01-10T08:00:00",
+             "BurninCycleEndDate": "2024-01-10T20:00:00", "BurninCycleModules": ["M140", "M141"]},
+            # no end date: ends at the start of the next cycle of M140, or 24 hours later
+            {"BurninCycleName": "BC011", "BurninCycleDate": "2024-01-12T08:00:00", "BurninCycleModules": ["M140"]},
+            {"BurninCycleName": "BC012", "BurninCycleDate": "2024-01-12T20:00:00", "BurninCycleModules": ["M140", "M142"]},
+        ]
+        for cycle in cycles:
+            response = self.client.post("/burnin_cycles", json=cycle)
+            self.assertEqual(response.status_code, 201)
+
+        response = self.client.get("/burnin_timeline/modules/M140")
+        self.assertEqual(response.status_code, 200)
+        entries = response.json["cycles"]
+        self.assertEqual([entry["BurninCycleName"] for entry in entries], ["BC010", "BC011", "BC012"])
+        self.assertEqual(entries[0]["end"], "2024-01-10T20:00:00")
+        self.assertFalse(entries[0]["endEstimated"])
+        self.assertEqual(entries[1]["end"], "2024-01-12T20:00:00")
+        self.assertEqual(entries[2]["end"], "2024-01-13T20:00:00")
+        self.assertTrue(entries[2]["endEstimated"])
+
+        response = self.client.get("/burnin_timeline/modules/M140?from=2024-01-11T00:00:00&to=2024-01-12T12:00:00")
+        self.assertEqual([entry["BurninCycleName"] for entry in response.json["cycles"]], ["BC011"])
+
+        response = self.client.get("/burnin_timeline/chamber?at=2024-01-10T12:00:00")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry["moduleName"] for entry in response.json["modules"]], ["M140", "M141"])
+        response = self.client.get("/burnin_timeline/chamber?at=2024-01-11T12:00:00")
+        self.assertEqual(response.json["modules"], [])
+
+        # the entries follow the updates and the deletions of the cycles
+        response = self.client.put("/burnin_cycles/BC012", json={"BurninCycleModules": ["M142"]})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/burnin_timeline/modules/M140")
+        entries = response.json["cycles"]
+        self.assertEqual([entry["BurninCycleName"] for entry in entries], ["BC010", "BC011"])
+        self.assertEqual(entries[1]["end"], "2024-01-13T08:00:00")
+        response = self.client.delete("/burnin_cycles/BC010")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/burnin_timeline/chamber?at=2024-01-10T12:00:00")
+        self.assertEqual(response.json["modules"], [])
+
+        response = self.client.get("/burnin_timeline/chamber")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/burnin_timeline/modules/M140?from=yesterday")
+        self.assertEqual(response.status_code, 400)
+
 if __name__ == "__main__":
     unittest.main()
@@ -116,7 +116,43 @@ class TestGenericQueryAPI(TestCase):
         for module in response.json:
             self.assertTrue(module["moduleName"].startswith("MODULE_GENERIC_"))
         
-        
+
+
+    def test_list_modules_paginated(self):
+        """Test the keyset pagination of the modules collection GET."""
+        response = self.client.get("/modules?limit=3")
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json
+        self.assertEqual(len(first_page), 3)
+
+        response = self.client.get(f"/modules?limit=3&after={first_page[-1]['_id']}")
+        self.assertEqual(response.status_code, 200)
+        second_page = response.json
+        self.assertEqual(len(second_page), 1)
+        all_names = [m["moduleName"] for m in first_page + second_page]
+        self.assertEqual(len(set(all_names)), 4)
+
+        # the cursor must be an _id and the sort must be on _id
+        response = self.client.get("/modules?after=not_an_id")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f"/modules?after={first_page[-1]['_id']}&sort=moduleName")
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_modules_projection_sort_and_ndjson(self):
+        """Test the fields, sort and format args of the modules collection GET."""
+        response = self.client.get("/modules?fields=moduleName&sort=-moduleName")
+        self.assertEqual(response.status_code, 200)
+        names = [m["moduleName"] for m in response.json]
+        self.assertEqual(names, sorted(names, reverse=True))
+        for module in response.json:
+            self.assertEqual(set(module.keys()), {"_id", "moduleName"})
+
+        response = self.client.get("/modules?format=ndjson&fields=status")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertIn("status", lines[0])
 
 
 if __name__ == "__main__":
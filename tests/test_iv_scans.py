@@ -3,10 +3,12 @@ from flask_testing import TestCase
 import sys
 import os
 import json
+import math
 from datetime import datetime
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app.app import create_app, get_unittest_db
+from app.iv_analytics import analyze_scans
 from bson import ObjectId
 
 class TestIVScansAPI(TestCase):
@@ -19,6 +21,7 @@ class TestIVScansAPI(TestCase):
         with self.app.app_context():
             db = get_unittest_db()
             db.iv_scans.drop()
+            db.iv_trends.drop()
 
         self.sample_scan_1 = {
             "nameLabel": "PS_MODULE_01", # Module identifier
@@ -63,6 +66,7 @@ class TestIVScansAPI(TestCase):
         with self.app.app_context():
             db = get_unittest_db()
             db.iv_scans.drop()
+            db.iv_trends.drop()
 
     def test_fetch_all_iv_scans_empty(self):
         """Test fetching all IV scans when the collection is empty."""
@@ -267,6 +271,186 @@ class TestIVScansAPI(TestCase):
         self.assertEqual(response.json["_id"], mongo_id_scan1)
         self.assertEqual(response.json["IVScanId"], self.sample_scan_1["IVScanId"])
 
+    def test_binary_storage_and_downsampling(self):
+        """Test the curves stored as typed blobs read back as arrays, downsampled and projected."""
+        self.app.config["IV_STORAGE"] = "binary"
+        scan = dict(self.sample_scan_1, IVScanId="IVS_BIN")
+        volts = [-float(v) for v in range(1000)]
+        scan["data"] = {
+            "VOLTS": volts,
+            "CURRNT_NAMP": [v * 0.5 for v in volts],
+            "TEMP_DEGC": [22.5] * 1000,
+            "RH_PRCNT": [45.0] * 1000,
+            "TIME": [f"2024-01-15T09:{i // 60 % 60:02d}:{i % 60:02d}" for i in range(1000)],
+        }
+        response = self.client.post("/iv_scans", json=scan)
+        self.assertEqual(response.status_code, 201)
+        with self.app.app_context():
+            stored = get_unittest_db().iv_scans.find_one({"IVScanId": "IVS_BIN"})
+        self.assertEqual(stored["data"]["VOLTS"]["dtype"], "<f8")
+        self.assertEqual(stored["data"]["VOLTS"]["shape"], [1000])
+        self.assertEqual(len(stored["data"]["VOLTS"]["values"]), 8000)
+        # the TIME strings are kept as an array
+        self.assertEqual(stored["data"]["TIME"], scan["data"]["TIME"])
+
+        response = self.client.get("/iv_scans/IVS_BIN")
+        self.assertEqual(response.json["data"]["VOLTS"], volts)
+        self.assertEqual(response.json["data"]["CURRNT_NAMP"], scan["data"]["CURRNT_NAMP"])
+
+        # the same points are kept in every per-point array, the first and the last among them
+        for method in ("lttb", "minmax"):
+            response = self.client.get(f"/iv_scans/IVS_BIN?points=100&downsample={method}")
+            self.assertEqual(response.status_code, 200)
+            data = response.json["data"]
+            self.assertLessEqual(len(data["VOLTS"]), 100)
+            self.assertEqual(len(data["TIME"]), len(data["VOLTS"]))
+            self.assertEqual(data["VOLTS"][0], 0.0)
+            self.assertEqual(data["VOLTS"][-1], -999.0)
+            self.assertEqual(data["TIME"][-1], scan["data"]["TIME"][-1])
+        response = self.client.get("/iv_scans?points=10")
+        self.assertEqual(len(response.json[0]["data"]["CURRNT_NAMP"]), 10)
+
+        response = self.client.get("/iv_scans/IVS_BIN?fields=-data")
+        self.assertNotIn("data", response.json)
+        self.assertEqual(response.json["nameLabel"], scan["nameLabel"])
+        self.assertEqual(self.client.get("/iv_scans/IVS_BIN?points=1").status_code, 400)
+        self.assertEqual(self.client.get("/iv_scans/IVS_BIN?downsample=mean").status_code, 400)
+
+    def test_iv_analytics(self):
+        """Test the figures of merit computed in batch, cached on the scans and ranked."""
+        volts = [-10.0 * i for i in range(61)]
+        scans = []
+        for i, (module, scale, temperature) in enumerate([("M1", 1.0, 20.0), ("M2", 2.0, 20.0), ("M3", 1.0, -20.0)]):
+            current = [-(100 + 0.1 * abs(v)) * scale for v in volts]
+            scans.append(dict(
+                self.sample_scan_1, nameLabel=module, IVScanId=f"IVS_A{i}", averageTemperature=temperature,
+                data={"VOLTS": volts, "CURRNT_NAMP": current},
+            ))
+        # M2 breaks down above 450 V, with a ramp down 10% higher
+        scans[1]["data"]["CURRNT_NAMP"] = [
+            c * (math.exp((abs(v) - 450) / 5) if abs(v) > 450 else 1) for v, c in zip(volts, scans[1]["data"]["CURRNT_NAMP"])
+        ]
+        scans[1]["data"]["VOLTS"] = volts + volts[::-1][1:]
+        scans[1]["data"]["CURRNT_NAMP"] = scans[1]["data"]["CURRNT_NAMP"] + [c * 1.1 for c in scans[1]["data"]["CURRNT_NAMP"][::-1][1:]]
+        for scan in scans:
+            self.assertEqual(self.client.post("/iv_scans", json=scan).status_code, 201)
+
+        response = self.client.post("/iv_analytics", json={"modules": ["M1", "M2", "M3"], "sort": "I_vop_norm"})
+        self.assertEqual(response.status_code, 200)
+        results = response.json["results"]
+        self.assertEqual([row["nameLabel"] for row in results], ["M1", "M2", "M3"])
+        self.assertAlmostEqual(results[0]["I_vop"], 130.0)
+        self.assertAlmostEqual(results[0]["I_vop_norm"], 130.0)
+        # measured cold: larger at the reference temperature
+        self.assertGreater(results[2]["I_vop_norm"], results[2]["I_vop"])
+        self.assertEqual(results[1]["V_breakdown"], 450.0)
+        self.assertIsNone(results[0]["V_breakdown"])
+        self.assertAlmostEqual(results[1]["hysteresis"], 0.1)
+
+        # cached on the scans, and dropped when the curves change
+        with self.app.app_context():
+            cached = get_unittest_db().iv_scans.find_one({"IVScanId": "IVS_A0"})
+        self.assertEqual(cached["ivAnalysis"]["parameters"]["vop"], 300.0)
+        self.client.put("/iv_scans/IVS_A0", json={"data": {"VOLTS": volts, "CURRNT_NAMP": [-1000.0] * 61}})
+        with self.app.app_context():
+            self.assertNotIn("ivAnalysis", get_unittest_db().iv_scans.find_one({"IVScanId": "IVS_A0"}))
+
+        response = self.client.post("/iv_analytics", json={
+            "sort": "I_vop", "order": "desc", "ranges": {"I_vop": {"max": 500}}, "parameters": {"vop": 200},
+        })
+        self.assertEqual([row["nameLabel"] for row in response.json["results"]], ["M2", "M3"])
+        self.assertAlmostEqual(response.json["results"][0]["I_vop"], 240.0)
+        self.assertEqual(self.client.post("/iv_analytics", json={"sort": "unknown"}).status_code, 400)
+        for body in ({"ranges": {"I_vop": {"min": "a"}}}, {"ranges": {"I_vop": {"max": True}}}, {"latest": "no"}):
+            self.assertEqual(self.client.post("/iv_analytics", json=body).status_code, 400)
+
+        # the stale scans are computed in batches
+        with self.app.app_context():
+            analyzed = analyze_scans(get_unittest_db().iv_scans, {}, {"vop": 100}, batch_size=2)
+        self.assertEqual(len(analyzed), 3)
+        self.assertTrue(all(scan["ivAnalysis"]["parameters"]["vop"] == 100.0 for scan in analyzed))
+        self.assertTrue(all("data" not in scan for scan in analyzed))
+
+    def test_bulk_ingestion(self):
+        """Test the bulk endpoint with a JSON list and an NDJSON stream, in insert and upsert modes."""
+        self.client.post("/iv_scans", json=self.sample_scan_1)
+        invalid = dict(self.sample_scan_2, IVScanId="IVS_BAD")
+        del invalid["nameLabel"]
+        scans = [self.sample_scan_1, self.sample_scan_2, self.sample_scan_2, invalid, self.sample_scan_3_module_1]
+        response = self.client.post("/iv_scans/bulk", json=scans)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["inserted"], 2)
+        self.assertEqual(response.json["failed"], 3)
+        self.assertEqual(
+            [result["status"] for result in response.json["results"]],
+            ["exists", "inserted", "duplicate", "invalid", "inserted"],
+        )
+        self.assertIn("nameLabel", response.json["results"][3]["error"])
+        with self.app.app_context():
+            self.assertEqual(get_unittest_db().iv_scans.count_documents({}), 3)
+
+        updated = dict(self.sample_scan_1, comment="re-measured")
+        new_scan = dict(self.sample_scan_2, IVScanId="IVS004")
+        body = "\n".join([json.dumps(updated), "{not json", json.dumps(new_scan)]) + "\n"
+        response = self.client.post("/iv_scans/bulk?mode=upsert", data=body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["status"] for result in response.json["results"]], ["updated", "invalid", "inserted"])
+        self.assertEqual(response.json["results"][0]["IVScanId"], "IVS001")
+        self.assertEqual(self.client.get("/iv_scans/IVS001").json["comment"], "re-measured")
+        self.assertEqual(self.client.get("/iv_scans/IVS004").status_code, 200)
+
+        self.assertEqual(self.client.post("/iv_scans/bulk", json={"scans": [], "mode": "merge"}).status_code, 400)
+        self.assertEqual(self.client.post("/iv_scans/bulk", json={"scan": self.sample_scan_1}).status_code, 400)
+
+    def test_iv_trends(self):
+        """Test the trend points maintained on the IV scan writes, per scan and per session."""
+        volts = [-100.0 * i for i in range(8)]
+        scans = []
+        for i, (module, session, date, scale) in enumerate([
+            ("M1", "session1", "2024-01-15T10:00:00", 1.0),
+            ("M1", "session1", "2024-01-15T12:00:00", 3.0),
+            ("M1", "session2", "2024-02-20T10:00:00", 2.0),
+            ("M2", "session1", "2024-01-15T11:00:00", 1.0),
+        ]):
+            scans.append(dict(
+                self.sample_scan_1, nameLabel=module, sessionName=session, date=date, IVScanId=f"IVS_T{i}",
+                data={"VOLTS": volts, "CURRNT_NAMP": [-(100 + 0.1 * abs(v)) * scale for v in volts]},
+            ))
+        self.client.post("/iv_scans", json=scans[0])
+        self.client.post("/iv_scans/bulk", json=scans[1:])
+
+        response = self.client.post("/iv_trends", json={"modules": ["M1", "M2", "M3"]})
+        self.assertEqual(response.status_code, 200)
+        series = response.json["series"]
+        self.assertEqual([point["IVScanId"] for point in series["M1"]], ["IVS_T0", "IVS_T1", "IVS_T2"])
+        self.assertEqual(series["M3"], [])
+        self.assertAlmostEqual(series["M1"][0]["current"]["300"], 130.0)
+        self.assertAlmostEqual(series["M1"][0]["temperature"], self.sample_scan_1["averageTemperature"])
+        self.assertNotIn("data", series["M1"][0])
+
+        response = self.client.post("/iv_trends", json={"modules": ["M1"], "bucket": "session", "voltages": [300]})
+        points = response.json["series"]["M1"]
+        self.assertEqual([(point["sessionName"], point["scans"]) for point in points], [("session1", 2), ("session2", 1)])
+        self.assertAlmostEqual(points[0]["current"]["300"], 260.0)
+
+        # the points follow the writes of the scans
+        self.client.delete("/iv_scans/IVS_T1")
+        self.client.put("/iv_scans/IVS_T2", json={"sessionName": "session3"})
+        response = self.client.post("/iv_trends", json={"modules": ["M1"], "from": "2024-01-01T00:00:00"})
+        self.assertEqual(
+            [(point["IVScanId"], point["sessionName"]) for point in response.json["series"]["M1"]],
+            [("IVS_T0", "session1"), ("IVS_T2", "session3")],
+        )
+
+        # a point per scan, however many times the scan is written
+        self.client.put("/iv_scans/IVS_T0", json={"comment": "re-measured"})
+        self.client.post("/iv_scans/bulk?mode=upsert", json=[scans[0], scans[2]])
+        with self.app.app_context():
+            self.assertEqual(get_unittest_db().iv_trends.count_documents({"meta.IVScanId": "IVS_T0"}), 1)
+            self.assertEqual(get_unittest_db().iv_trends.count_documents({"meta.nameLabel": "M1"}), 2)
+        self.assertEqual(self.client.post("/iv_trends", json={"modules": []}).status_code, 400)
+        self.assertEqual(self.client.post("/iv_trends", json={"modules": ["M1"], "bucket": "year"}).status_code, 400)
+
 
 if __name__ == "__main__":
     unittest.main()
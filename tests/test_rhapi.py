@@ -0,0 +1,123 @@
+import unittest
+import sys
+import os
+import json
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+from rhapi import RhApi, RhApiRowCountError
+
+URL = "http://rhapi.test"
+HEADER = "NAME_LABEL,LOCATION"
+ROWS = [f"PS_26_IPG-1000{i},Pisa" for i in range(5)]
+
+
+class FakeResponse:
+    def __init__(self, url, text, content_type="text/plain"):
+        self.status_code = 200
+        self.url = url
+        self.headers = {"content-type": content_type}
+        self.text = text
+
+
+class FakeSession:
+    """Stands in for the requests.Session of RhApi: a query of ROWS, served by pages of rows_limit rows."""
+
+    def __init__(self, rows_limit, page_ends_with_newline=True):
+        self.rows_limit = rows_limit
+        self.page_ends_with_newline = page_ends_with_newline
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _respond(self, method, url, headers):
+        path = url[len(URL) + 1:].split("?")[0].split("/")
+        with self.lock:
+            self.calls.append((method, "/".join(path)))
+        if path == ["query"]:
+            return FakeResponse(url, "QID1")
+        if path == ["query", "QID1"]:
+            return FakeResponse(url, json.dumps({"rowsLimit": self.rows_limit}), "application/json")
+        if path == ["query", "QID1", "count"]:
+            return FakeResponse(url, str(len(ROWS)))
+        if path == ["query", "QID1", "cache"]:
+            return FakeResponse(url, "")
+        # query/QID1/page/<size>/<page>/data
+        size, page = int(path[3]), int(path[4])
+        rows = ROWS[(page - 1) * size:page * size]
+        if headers["Accept"] == "application/json":
+            data = {"data": [row.split(",") for row in rows]}
+            return FakeResponse(url, json.dumps(data), "application/json")
+        text = "\n".join([HEADER] + rows)
+        if self.page_ends_with_newline:
+            text += "\n"
+        return FakeResponse(url, text, "text/csv")
+
+    def get(self, url, headers=None, **kwargs):
+        return self._respond("GET", url, headers)
+
+    def post(self, url, headers=None, **kwargs):
+        return self._respond("POST", url, headers)
+
+    def delete(self, url, headers=None, **kwargs):
+        return self._respond("DELETE", url, headers)
+
+
+class TestRhApi(unittest.TestCase):
+    def api(self, session):
+        api = RhApi(URL, max_workers=2)
+        api.session = session
+        return api
+
+    def test_fetch_pages(self):
+        session = FakeSession(rows_limit=2)
+        count, pages = self.api(session).fetch_pages("select * from p", "text/csv", clean=True)
+        self.assertEqual(count, 5)
+        # the pages come back in order, whatever the order they were fetched in
+        self.assertEqual(pages, [
+            "\n".join([HEADER] + ROWS[0:2]) + "\n",
+            "\n".join([HEADER] + ROWS[2:4]) + "\n",
+            "\n".join([HEADER] + ROWS[4:5]) + "\n",
+        ])
+        # the query metadata is read once, not once per page
+        metadata = [call for call in session.calls if "page" not in call[1]]
+        self.assertEqual(metadata, [
+            ("POST", "query"),
+            ("DELETE", "query/QID1/cache"),
+            ("GET", "query/QID1"),
+            ("GET", "query/QID1/count"),
+        ])
+        self.assertEqual(
+            sorted(call[1] for call in session.calls if "page" in call[1]),
+            [f"query/QID1/page/2/{page}/data" for page in (1, 2, 3)]
+        )
+
+    def test_fetch_pages_single_page(self):
+        session = FakeSession(rows_limit=10)
+        count, pages = self.api(session).fetch_pages("select * from p", "text/csv")
+        self.assertEqual(count, 5)
+        self.assertEqual(pages, ["\n".join([HEADER] + ROWS) + "\n"])
+        self.assertNotIn(("DELETE", "query/QID1/cache"), session.calls)
+
+    def test_csv_all(self):
+        # one header line, then the rows of all the pages in order
+        expected = "\n".join([HEADER] + ROWS)
+        for page_ends_with_newline in (True, False):
+            session = FakeSession(rows_limit=2, page_ends_with_newline=page_ends_with_newline)
+            csv = self.api(session).csv_all("select * from p", clean=True)
+            self.assertEqual(csv.rstrip("\n"), expected)
+            self.assertEqual(csv.count(HEADER), 1)
+
+    def test_json_all(self):
+        session = FakeSession(rows_limit=2)
+        rows = self.api(session).json_all("select * from p")
+        self.assertEqual(rows, [row.split(",") for row in ROWS])
+
+        # a page missing rows is reported
+        api = self.api(FakeSession(rows_limit=2))
+        api.count = lambda qid, params=None, verbose=False: len(ROWS) + 1
+        with self.assertRaises(RhApiRowCountError):
+            api.json_all("select * from p")
+
+
+if __name__ == "__main__":
+    unittest.main()
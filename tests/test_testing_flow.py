@@ -0,0 +1,74 @@
+import unittest
+import datetime
+import sys
+
+sys.path.append("..")
+from app.testing_flow import build_testing_flow
+
+
+def make_test(module, hour, test_type="IV", status="done"):
+    return {
+        "type": "test",
+        "timestamp": datetime.datetime(2024, 1, 1, hour),
+        "module_name": module,
+        "test_type": test_type,
+        "run_status": status,
+    }
+
+
+def make_cycle(module, hour, cycle_name):
+    return {
+        "type": "cycle",
+        # cycle dates may be stored as strings
+        "timestamp": datetime.datetime(2024, 1, 1, hour).isoformat(),
+        "module_name": module,
+        "cycle_name": cycle_name,
+        "temperatures": {"low": -35, "high": 20},
+        "event_name": "Cycle -35°C/20°C",
+    }
+
+
+class TestTestingFlow(unittest.TestCase):
+    def test_no_cycles(self):
+        columns, flow_matrix = build_testing_flow(
+            ["M1", "M2"], [make_test("M1", 2), make_test("M1", 1, "full", "failed")], []
+        )
+        self.assertEqual([c["column_id"] for c in columns], ["seg_0_IV", "seg_0_full"])
+        self.assertEqual(columns[0]["start_time"], datetime.datetime(2024, 1, 1, 1))
+        self.assertEqual(flow_matrix[0]["columns"]["col_1"]["failed"], 1)
+        self.assertEqual(flow_matrix[1]["columns"]["col_0"], {"present": False})
+        self.assertNotIn("by_module", columns[0])
+
+    def test_segments_between_cycles(self):
+        tests = [
+            make_test("M1", 1),
+            make_test("M1", 3),
+            make_test("M2", 3, status="failed"),
+            # at the same time as the second cycle: not part of any group
+            make_test("M1", 5),
+            make_test("M2", 7),
+        ]
+        cycles = [
+            make_cycle("M1", 2, "cycle1"),
+            make_cycle("M2", 2, "cycle1"),
+            make_cycle("M2", 5, "cycle2"),
+        ]
+        columns, flow_matrix = build_testing_flow(["M1", "M2"], tests, cycles)
+        self.assertEqual(
+            [c["column_id"] for c in columns],
+            ["seg_0_IV", "seg_1_cycle", "seg_2_IV", "seg_3_cycle", "seg_4_IV"],
+        )
+        self.assertEqual(columns[1]["modules"], ["M1", "M2"])
+        self.assertEqual(len(columns[2]["test_events"]), 2)
+        self.assertEqual(columns[4]["test_events"], [tests[4]])
+
+        m1, m2 = flow_matrix
+        self.assertTrue(m1["columns"]["col_1"]["present"])
+        self.assertEqual(m1["columns"]["col_3"], {"present": False})
+        self.assertEqual(m2["columns"]["col_2"]["count"], 1)
+        self.assertEqual(m2["columns"]["col_2"]["failed"], 1)
+        self.assertEqual(m1["columns"]["col_4"], {"present": False})
+
+
+if __name__ == "__main__":
+    unittest.main()